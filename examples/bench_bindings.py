@@ -0,0 +1,34 @@
+import sys
+import time
+
+import explogger
+
+# enter()/leave() cost and meta_session size for many repetitions under bound users and equipment
+
+def bench(n, n_bindings):
+    with explogger.ExperimentLog(":memory:", ntp_sync=False) as e:
+        for i in range(n_bindings):
+            e.create("EQUIPMENT", "device_%d" % i)
+        e.cd("/Experiment")
+        for i in range(n_bindings):
+            e.bind("EQUIPMENT", "device_%d" % i)
+        e.cd("ConditionA")
+        start = time.perf_counter()
+        for i in range(n):
+            e.enter()
+            e.leave()
+        elapsed = (time.perf_counter() - start) / n
+        start = time.perf_counter()
+        e.enter()
+        bound = len(e.bindings)
+        lookup = time.perf_counter() - start
+        rows = e.cursor.execute("SELECT count(*) FROM meta_session").fetchone()[0]
+        return elapsed, lookup, bound, rows
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    n_bindings = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    elapsed, lookup, bound, rows = bench(n, n_bindings)
+    print("%d repetitions, %d bindings: %.1fus per enter()/leave(), %d meta_session rows, bindings lookup %.2fms (%d bound)" % (
+        n, n_bindings, elapsed * 1e6, rows, lookup * 1000, bound))
@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+import random
+import tempfile
+
+import numpy as np
+
+import explogger
+from explogger import extract
+from explogger.codec import Codec
+
+# database size against write and read throughput for each codec, on typical streams:
+# small mouse samples, larger eye tracker samples, and blocks of 16 bit audio
+
+def mouse(i):
+    return {"x": random.randint(0, 1919), "y": random.randint(0, 1079), "buttons": [0, int(i % 50 == 0), 0],
+            "device": "mouse", "pressure": round(random.random(), 3)}
+
+
+def eye(i):
+    return {"gaze": {"x": round(random.gauss(960, 200), 2), "y": round(random.gauss(540, 150), 2)},
+            "left_pupil": round(random.gauss(3.5, 0.2), 3), "right_pupil": round(random.gauss(3.5, 0.2), 3),
+            "validity": {"left": 0, "right": 0}, "fixation": i // 40, "event": "fixation" if i % 40 else "saccade",
+            "tracker": "eyetracker-120Hz", "calibration": "9-point"}
+
+
+def audio(n_blocks, block=4800):
+    t = np.arange(block) / 48000.0
+    for i in range(n_blocks):
+        tone = 3000 * np.sin(2 * np.pi * 440 * (t + i * block / 48000.0))
+        yield (tone + np.random.normal(0, 200, block)).astype(np.int16).reshape(-1, 1)
+
+
+def bench(codec, n):
+    fname = os.path.join(tempfile.mkdtemp(), "codec.db")
+    start = time.perf_counter()
+    with explogger.ExperimentLog(fname, ntp_sync=False, codec=codec) as e:
+        e.cd("/bench")
+        for i in range(0, n, 10000):
+            e.log_many(("mouse", None, mouse(j)) for j in range(i, min(i + 10000, n)))
+            e.log_many(("eye", None, eye(j)) for j in range(i, min(i + 10000, n)))
+        write = time.perf_counter() - start
+        start = time.perf_counter()
+        for samples in audio(n // 1000):
+            e.log_chunk("audio", samples, rate=48000)
+        write_audio = time.perf_counter() - start
+    size = os.path.getsize(fname)
+
+    cursor = extract.open_reader(fname).cursor()
+    start = time.perf_counter()
+    frame = extract.dumpflat(cursor)
+    read = time.perf_counter() - start
+    start = time.perf_counter()
+    extract.chunked_stream(cursor, "audio")
+    read_audio = time.perf_counter() - start
+    assert len(frame["mouse"]) == n and len(frame["eye"]) == n
+    return size, 2 * n / write, 2 * n / read, (n // 1000) / write_audio, (n // 1000) / read_audio
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    codecs = [None, Codec("zlib", binaries=True), Codec("lzma", level=1, binaries=True),
+              Codec("zlib-dict", binaries=True)]
+    base = None
+    for codec in codecs:
+        size, write, read, write_audio, read_audio = bench(codec, n)
+        base = base or size
+        print("%-10s %7.1f MB (%4.2fx)  json: %7.0f rows/s written %7.0f rows/s read   audio: %5.0f blocks/s written %5.0f blocks/s read" % (
+            codec.method if codec else "none", size / float(1 << 20), base / float(size), write, read, write_audio, read_audio))
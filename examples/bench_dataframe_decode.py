@@ -0,0 +1,57 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pandas as pd
+import six
+
+import explogger
+from explogger import extract, frames
+
+# rows/s of dump_flat_dataframe(), which parses the JSON of a stream in bulk and builds typed columns from
+# an inferred schema, against building the frames from per-row dicts typed by json_columns() (as
+# dump_flat_dataframe() used to)
+
+
+def make_log(fname, n, n_streams=4):
+    with explogger.ExperimentLog(fname, ntp_sync=False) as e:
+        for s in range(n_streams):
+            e.create("STREAM", "stream%d" % s)
+        for p in range(10):
+            e.cd("/condition%d" % p)
+            e.log_many([("stream%d" % (j % n_streams), None,
+                         {"x": j, "y": j * 0.5, "label": "target%d" % (j % 8), "hit": j % 3 == 0, "pos": [j, j + 1]})
+                        for j in range(n // 10)])
+
+
+def dict_frames(cursor):
+    dfs = {}
+    for key, samples in six.iteritems(extract.dumpflat(cursor)):
+        dfs[key] = pd.DataFrame(samples, columns=list(extract.json_columns(samples).keys()))
+    return dfs
+
+
+def bench(fn, cursor, n):
+    start = time.perf_counter()
+    fn(cursor)
+    return n / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    d = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(d, "decode.db")
+        make_log(fname, n)
+        cursor = extract.open_reader(fname).cursor()
+        print("per-row dicts + json_columns()   %8.0f rows/s" % bench(dict_frames, cursor, n))
+        if frames.orjson is not None:
+            print("bulk decoding (orjson)           %8.0f rows/s" % bench(extract.dump_flat_dataframe, cursor, n))
+        orjson, frames.orjson = frames.orjson, None
+        print("bulk decoding (json)             %8.0f rows/s" % bench(extract.dump_flat_dataframe, cursor, n))
+        frames.orjson = orjson
+        print(extract.dump_flat_dataframe(cursor)["stream0"].dtypes)
+    finally:
+        shutil.rmtree(d)
@@ -0,0 +1,49 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import explogger
+from explogger import extract
+from explogger.commit import CommitPolicy
+
+# session summaries, metadata bindings and the session tree of a study with many sessions:
+# each of these is read in a fixed number of queries, however many sessions there are
+
+
+def make_log(fname, n_sessions, per_session=2, n_users=100):
+    with explogger.ExperimentLog(fname, ntp_sync=False, commit_policy=CommitPolicy(every_n=10000, barriers=False)) as e:
+        e.create("STREAM", "response")
+        for u in range(n_users):
+            e.create("USER", "user%d" % u)
+        e.create("DEVICE", "tracker")
+        e.cd("/study")
+        e.bind("DEVICE", "tracker")
+        n_conditions = 10
+        for c in range(n_conditions):
+            e.cd("/study/condition%d" % c)
+            for s in range(c, n_sessions, n_conditions):
+                e.enter("trial%d" % (s % 100))
+                e.bind("USER", "user%d" % (s % n_users))
+                for i in range(per_session):
+                    e.log("response", data={"trial": s, "i": i})
+                e.leave()
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    d = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(d, "sessions.db")
+        start = time.perf_counter()
+        make_log(fname, n)
+        print("%d sessions written in %.1fs" % (n, time.perf_counter() - start))
+        cursor = extract.open_reader(fname).cursor()
+        for fn in [extract.dump_sessions, extract.dump_sessions_dataframe, extract.meta, extract.map_children_sessions,
+                   extract.dump, extract.dump_dataframe]:
+            start = time.perf_counter()
+            fn(cursor)
+            print("%-26s %8.3fs" % (fn.__name__, time.perf_counter() - start))
+    finally:
+        shutil.rmtree(d)
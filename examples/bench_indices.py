@@ -0,0 +1,86 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import explogger
+from explogger import extract
+
+# ingest time with the composite indices maintained during the run ("open"), built at the end ("end"),
+# or built in the background; and the time of the per-session and per-stream lookups with and without them
+
+QUERIES = [
+    ("samples of a session and stream", "SELECT id, time, json FROM log WHERE session=? AND stream=? ORDER BY time"),
+    ("samples of a stream in a time range", "SELECT id, time, json FROM log WHERE stream=? AND time>=? AND time<? ORDER BY time"),
+    ("entries of a stream", "SELECT count(id) FROM log WHERE stream=?"),
+    ("sessions of a path", "SELECT id FROM session WHERE path=?"),
+]
+
+
+def ingest(fname, indices, n, n_sessions, n_streams):
+    start = time.perf_counter()
+    with explogger.ExperimentLog(fname, ntp_sync=False, indices=indices) as e:
+        for s in range(n_streams):
+            e.create("STREAM", "stream%d" % s)
+        streams = ["stream%d" % s for s in range(n_streams)]
+        per_session = n // n_sessions
+        for i in range(n_sessions):
+            e.cd("/trial%d" % (i % 100))
+            e.log_many([(streams[j % n_streams], i * per_session + j, {"x": j}) for j in range(per_session)])
+            e.cd("..")
+        logged = time.perf_counter()
+    return logged - start, time.perf_counter() - logged
+
+
+def reopen(fname, indices):
+    """Time to open an existing, unindexed log until it is ready to log"""
+    start = time.perf_counter()
+    e = explogger.ExperimentLog(fname, ntp_sync=False, indices=indices)
+    ready = time.perf_counter() - start
+    e.close()
+    return ready
+
+
+def query(fname, n_sessions, repeats=20):
+    conn = extract.open_reader(fname)
+    c = conn.cursor()
+    stream = c.execute("SELECT id FROM stream LIMIT 1").fetchone()[0]
+    t0, t1 = c.execute("SELECT min(time), max(time) FROM log").fetchone()
+    params = [(n_sessions // 2, stream), (stream, t0 + (t1 - t0) * 0.5, t0 + (t1 - t0) * 0.51), (stream,), ("/trial7",)]
+    times = []
+    for (name, sql), p in zip(QUERIES, params):
+        start = time.perf_counter()
+        for i in range(repeats):
+            c.execute(sql, p).fetchall()
+        times.append((time.perf_counter() - start) / repeats)
+    scans = extract.full_scans(c)
+    conn.close()
+    return times, scans
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    n_sessions, n_streams = 1000, 10
+    d = tempfile.mkdtemp()
+    try:
+        for indices in [None, "open", "end", "background"]:
+            fname = os.path.join(d, "%s.db" % indices)
+            logging_time, closing_time = ingest(fname, indices, n, n_sessions, n_streams)
+            print("indices=%-10s ingest %6.2fs (%7.0f rows/s), closing %5.2fs" % (
+                indices, logging_time, n / logging_time, closing_time))
+
+        # indexing a log that already holds data
+        for indices in ["open", "background"]:
+            shutil.copy(os.path.join(d, "None.db"), os.path.join(d, "copy.db"))
+            print("reopening the unindexed log with indices=%-10s ready to log after %5.3fs" % (
+                indices, reopen(os.path.join(d, "copy.db"), indices)))
+
+        for indices in [None, "end"]:
+            times, scans = query(os.path.join(d, "%s.db" % indices), n_sessions)
+            print("\nindices=%s" % indices)
+            for (name, _), t in zip(QUERIES, times):
+                print("  %-40s %9.3fms" % (name, t * 1e3))
+            print("  full scans: %s" % (", ".join(sorted(scans)) or "none"))
+    finally:
+        shutil.rmtree(d)
@@ -0,0 +1,33 @@
+import sys
+import time
+
+import explogger
+from explogger.core import LOCKING_STRATEGIES
+
+# per-call overhead of log() with each locking strategy
+
+def bench(locking, n):
+    with explogger.ExperimentLog(":memory:", ntp_sync=False, locking=locking) as e:
+        e.create("STREAM", "sensor")
+        data = {"x": 1}
+        start = time.perf_counter()
+        for i in range(n):
+            e.log("sensor", data=data)
+        return (time.perf_counter() - start) / n
+
+
+def bench_lock(locking, n):
+    lock = LOCKING_STRATEGIES[locking]()
+    start = time.perf_counter()
+    for i in range(n):
+        with lock:
+            pass
+    return (time.perf_counter() - start) / n
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    strategies = sys.argv[2:] or ["multiprocessing", "threading", "none"]
+    for locking in strategies:
+        print("%-16s %6.2fus per log()  %6.3fus per lock acquire/release" % (
+            locking, bench(locking, n) * 1e6, bench_lock(locking, n) * 1e6))
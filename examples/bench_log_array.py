@@ -0,0 +1,47 @@
+import os
+import time
+import tempfile
+
+import numpy as np
+
+import explogger
+from explogger import extract
+from explogger.core import np_to_str, str_to_np
+
+# compare storing arrays with np.savez (np_to_str) against raw buffers (log_array)
+
+SIZES = [1 << 10, 1 << 14, 1 << 17, 1 << 20, 10 << 20]
+
+
+def bench(fname, nbytes, raw, repeats):
+    arr = np.random.uniform(-1, 1, nbytes // 8)
+    with explogger.ExperimentLog(fname, ntp_sync=False) as e:
+        start = time.perf_counter()
+        for i in range(repeats):
+            if raw:
+                e.log_array("frames", arr)
+            else:
+                e.log("frames", binary=np_to_str({"frame": arr}))
+        e.commit()
+        write = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if raw:
+            loaded = [a for _, _, _, a in extract.stream_arrays(e.cursor, "frames")]
+        else:
+            blobs = e.cursor.execute("SELECT binary.binary FROM log JOIN binary ON binary.id=log.binary").fetchall()
+            loaded = [str_to_np(b[0])["frame"] for b in blobs]
+        read = time.perf_counter() - start
+        assert len(loaded) == repeats and np.array_equal(loaded[-1], arr)
+    return write / repeats, read / repeats
+
+
+if __name__ == "__main__":
+    tmp = tempfile.mkdtemp()
+    print("%10s %8s %12s %12s" % ("size", "method", "write/array", "read/array"))
+    for nbytes in SIZES:
+        repeats = max(4, min(1000, (64 << 20) // nbytes))
+        for raw in [False, True]:
+            fname = os.path.join(tmp, "bench_%d_%d.db" % (nbytes, raw))
+            write, read = bench(fname, nbytes, raw, repeats)
+            print("%10d %8s %10.1fus %10.1fus" % (nbytes, "raw" if raw else "savez", write * 1e6, read * 1e6))
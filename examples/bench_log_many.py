@@ -0,0 +1,40 @@
+import os
+import sys
+import time
+import tempfile
+
+import explogger
+
+# compare per-sample log() calls with bulk log_many() ingestion
+
+def make_records(n, streams):
+    return [(streams[i % len(streams)], None, {"x": i, "y": i * 0.5, "z": -i}) for i in range(n)]
+
+
+def bench(fname, n, bulk):
+    streams = ["imu_%d" % i for i in range(4)]
+    records = make_records(n, streams)
+    with explogger.ExperimentLog(fname, ntp_sync=False, autocommit=1) as e:
+        for s in streams:
+            e.create("STREAM", s)
+        e.cd("/bench")
+        start = time.perf_counter()
+        if bulk:
+            e.log_many(records)
+        else:
+            for stream, t, data in records:
+                e.log(stream, t=t, data=data)
+        e.commit()
+        return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    tmp = tempfile.mkdtemp()
+    print("%d records" % n)
+    for label, fname in [("memory", ":memory:"), ("file", os.path.join(tmp, "bench.db"))]:
+        for bulk in [False, True]:
+            if fname != ":memory:" and os.path.exists(fname):
+                os.remove(fname)
+            elapsed = bench(fname, n, bulk)
+            print("%-7s %-10s %8.3fs %10.0f rows/s" % (label, "log_many()" if bulk else "log()", elapsed, n / elapsed))
@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import logging
+import tempfile
+import threading
+
+import explogger
+
+# caller-side cost of logging.info() with records stored in the database: one INSERT per record
+# on the calling thread, against the buffered SQLHandler from get_logger(). Another thread writes
+# large batches of samples meanwhile, holding the database lock for a while each time.
+
+class InsertHandler(logging.Handler):
+    def __init__(self, explog):
+        logging.Handler.__init__(self)
+        self.explog = explog
+
+    def emit(self, record):
+        with self.explog.db_lock:
+            self.explog._execute("INSERT INTO debug_logging(time,record,run,level) VALUES (?, ?, ?, ?)",
+                                 (self.explog.real_time(), self.format(record), self.explog.run_id, record.levelno))
+            self.explog.commit_policy.wrote()
+
+
+def bench(make_handler, n):
+    fname = os.path.join(tempfile.mkdtemp(), "log.db")
+    with explogger.ExperimentLog(fname, ntp_sync=False, locking="threading") as e:
+        handler = make_handler(e)
+        log = logging.getLogger("bench")
+        log.propagate = False
+        log.setLevel(logging.INFO)
+        log.addHandler(handler)
+
+        stop = threading.Event()
+        def samples():
+            while not stop.is_set():
+                e.log_many(("sensor", None, {"x": i}) for i in range(20000))
+        thread = threading.Thread(target=samples)
+        thread.start()
+
+        slowest = 0.0
+        start = time.perf_counter()
+        for i in range(n):
+            t = time.perf_counter()
+            log.info("sample %d of %d", i, n)
+            slowest = max(slowest, time.perf_counter() - t)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        thread.join()
+        e.flush()
+        log.removeHandler(handler)
+        written = e.cursor.execute("SELECT count(*) FROM debug_logging").fetchone()[0]
+    return elapsed / n, slowest, written
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, make_handler in [("INSERT per record", InsertHandler), ("SQLHandler", lambda e: e.get_logger())]:
+        per_call, slowest, written = bench(make_handler, n)
+        print("%-18s %6.2fus per logging call, slowest %6.1fms, %d records stored" % (
+            name, per_call * 1e6, slowest * 1000, written))
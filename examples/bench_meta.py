@@ -0,0 +1,30 @@
+import sys
+import time
+
+import explogger
+
+# cost of reading and writing dataset metadata through e.meta, with a large metadata dictionary
+
+def bench(n, meta_deltas):
+    with explogger.ExperimentLog(":memory:", ntp_sync=False, meta_deltas=meta_deltas) as e:
+        with e.meta.batch():
+            for i in range(500):
+                setattr(e.meta, "field_%d" % i, "x" * 40)
+        start = time.perf_counter()
+        for i in range(n):
+            e.meta.stage
+        read = (time.perf_counter() - start) / n
+        start = time.perf_counter()
+        for i in range(n):
+            e.meta.counter = i
+        write = (time.perf_counter() - start) / n
+        size = e.cursor.execute("SELECT sum(length(json)) FROM dataset").fetchone()[0]
+        return read, write, size
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for meta_deltas in (False, True):
+        read, write, size = bench(n, meta_deltas)
+        print("meta_deltas=%-5s %7.2fus per read  %7.1fus per write  %6.1f MB of metadata history" % (
+            meta_deltas, read * 1e6, write * 1e6, size / float(1 << 20)))
@@ -0,0 +1,63 @@
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import explogger
+from explogger import extract
+
+# time and output size of exporting a log with to_csv_flat() and to_parquet() (which needs pyarrow),
+# and of an incremental export after more data has been logged
+
+
+def log_rows(fname, n, n_streams=4, offset=0):
+    with explogger.ExperimentLog(fname, ntp_sync=False) as e:
+        for s in range(n_streams):
+            if e.find_metatable("STREAM", "stream%d" % s) is None:
+                e.create("STREAM", "stream%d" % s)
+        for p in range(10):
+            e.cd("/condition%d" % p)
+            e.log_many([("stream%d" % (j % n_streams), None,
+                         {"x": j, "y": j * 0.5, "label": "target%d" % (j % 8), "hit": j % 3 == 0})
+                        for j in range(offset, offset + n // 10)])
+
+
+def size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    d = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(d, "export.db")
+        log_rows(fname, n)
+        cursor = extract.open_reader(fname).cursor()
+        print("%d rows, database %.1f MB" % (n, os.path.getsize(fname) / 1e6))
+
+        csvdir = os.path.join(d, "csv")
+        os.makedirs(csvdir)
+        t, _ = timed(extract.to_csv_flat, cursor, csvdir)
+        print("to_csv_flat                 %6.2fs  %8.0f rows/s  %6.1f MB" % (t, n / t, size(csvdir) / 1e6))
+
+        for partition_by in [("path",), ("path", "session")]:
+            outdir = os.path.join(d, "parquet")
+            t, watermark = timed(extract.to_parquet, cursor, outdir, partition_by=partition_by)
+            print("to_parquet %-17s %6.2fs  %8.0f rows/s  %6.1f MB in %d files" % (
+                "/".join(partition_by), t, n / t, size(outdir) / 1e6, watermark["files"]))
+
+        log_rows(fname, n // 10, offset=n)
+        cursor = extract.open_reader(fname).cursor()
+        t, watermark = timed(extract.to_parquet, cursor, outdir, incremental=True)
+        print("incremental export of %d new rows: %.2fs" % (watermark["rows"], t))
+        print("peak RSS %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    finally:
+        shutil.rmtree(d)
@@ -0,0 +1,39 @@
+import os
+import time
+import tempfile
+
+import explogger
+
+# time cd() between deep session hierarchies, and enter()/leave() trial loops
+
+def bench_cd(e, depth, repeats):
+    a = "/" + "/".join("level%d" % i for i in range(depth)) + "/A"
+    b = "/" + "/".join("level%d" % i for i in range(depth)) + "/B"
+    e.cd(a)
+    e.cd(b)
+    start = time.perf_counter()
+    for i in range(repeats):
+        e.cd(a)
+        e.cd(b)
+    elapsed = time.perf_counter() - start
+    e.cd("/")
+    return elapsed / (2 * repeats)
+
+
+def bench_trials(e, repeats):
+    e.cd("/trials")
+    start = time.perf_counter()
+    for i in range(repeats):
+        e.enter()
+        e.leave()
+    elapsed = time.perf_counter() - start
+    e.cd("/")
+    return elapsed / repeats
+
+
+if __name__ == "__main__":
+    fname = os.path.join(tempfile.mkdtemp(), "bench.db")
+    with explogger.ExperimentLog(fname, ntp_sync=False) as e:
+        for depth in [2, 8, 32]:
+            print("cd() depth %2d: %8.1fus per cd" % (depth, bench_cd(e, depth, 200) * 1e6))
+        print("enter()/leave(): %8.1fus per trial" % (bench_trials(e, 2000) * 1e6))
@@ -0,0 +1,44 @@
+import os
+import sys
+import time
+import tempfile
+
+import explogger
+from explogger import extract
+
+# write throughput with and without size-bounded shards, and the cost of querying across the shards
+
+def count(cursor):
+    return cursor.execute("SELECT count(id) FROM log").fetchone()[0]
+
+
+def run(n, shards):
+    fname = os.path.join(tempfile.mkdtemp(), "shards.db")
+    start = time.perf_counter()
+    with explogger.ExperimentLog(fname, ntp_sync=False, shards=shards) as e:
+        e.cd("/bench")
+        for i in range(0, n, 10000):
+            e.log_many(("sensor", None, {"x": j, "y": j * 0.5, "label": "sample"}) for j in range(i, i + 10000))
+            e.commit()
+    write = time.perf_counter() - start
+
+    conn = extract.open_reader(fname, shards=False)
+    n_shards = len(extract.shard_files(conn.cursor()))
+    main_size = os.path.getsize(fname)
+    conn.close()
+
+    start = time.perf_counter()
+    total = count(extract.open_reader(fname).cursor()) if n_shards <= 10 else None
+    union = time.perf_counter() - start
+    fan = ""
+    if n_shards:
+        start = time.perf_counter()
+        total = sum(extract.fan_out(fname, count, group_size=1))
+        fan = ", fan_out %.0fms" % ((time.perf_counter() - start) * 1000)
+    print("shards=%-10s %8.0f rows/s written, %3d shards, main file %7.1f MB; count(id): union %.0fms%s (%d rows)" % (
+        shards, n / write, n_shards, main_size / float(1 << 20), union * 1000, fan, total))
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    run(n, None)
+    run(n, 16 << 20)
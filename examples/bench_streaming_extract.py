@@ -0,0 +1,58 @@
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import explogger
+from explogger import extract
+
+# peak memory and time of reading a whole log with dump_flat_dataframe(), against streaming it
+# with iter_dataframes(); each extraction runs in its own process so its peak RSS can be measured
+
+
+def make_log(fname, n, n_streams=4):
+    with explogger.ExperimentLog(fname, ntp_sync=False) as e:
+        for s in range(n_streams):
+            e.create("STREAM", "stream%d" % s)
+        e.cd("/trial")
+        chunk = 100000
+        for i in range(0, n, chunk):
+            e.log_many([("stream%d" % (j % n_streams), None, {"x": j, "y": j * 0.5, "label": "sample"})
+                        for j in range(i, min(n, i + chunk))])
+
+
+def extract_once(fname, method, batch_size):
+    conn = extract.open_reader(fname)
+    cursor = conn.cursor()
+    start = time.perf_counter()
+    rows = 0
+    if method == "dump_flat_dataframe":
+        for df in extract.dump_flat_dataframe(cursor).values():
+            rows += len(df)
+    else:
+        for stream, df in extract.iter_dataframes(cursor, batch_size=batch_size):
+            rows += len(df)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print("%-22s %9d rows  %6.2fs  peak RSS %7.1f MB" % (method, rows, elapsed, peak))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--extract":
+        extract_once(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        sys.exit(0)
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    d = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(d, "big.db")
+        make_log(fname, n)
+        print("%d rows, %.1f MB" % (n, os.path.getsize(fname) / 1e6))
+        for method in ["dump_flat_dataframe", "iter_dataframes"]:
+            subprocess.check_call([sys.executable, __file__, "--extract", fname, method, str(batch_size)])
+    finally:
+        shutil.rmtree(d)
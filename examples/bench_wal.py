@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+from multiprocessing import Process, Queue
+
+import explogger
+from explogger import extract
+from explogger.commit import CommitPolicy
+from explogger.wal import CheckpointScheduler
+
+# log at full rate while another process runs queries against the same database,
+# and report the WAL size and checkpoint durations
+
+def reader(fname, duration, results):
+    conn = extract.open_reader(fname)
+    queries, errors, slowest = 0, 0, 0.0
+    end = time.time() + duration
+    while time.time() < end:
+        start = time.time()
+        try:
+            conn.execute("SELECT count(id), max(time) FROM log").fetchone()
+            queries += 1
+        except sqlite3.OperationalError:
+            errors += 1
+        slowest = max(slowest, time.time() - start)
+        time.sleep(0.01)
+    results.put((queries, errors, slowest))
+
+
+def run(fname, wal, duration):
+    scheduler = CheckpointScheduler(interval=0.1, passive_size=1 << 20, truncate_size=16 << 20)
+    with explogger.ExperimentLog(fname, ntp_sync=False, wal=wal, checkpoint_scheduler=scheduler,
+                                 commit_policy=CommitPolicy(every_t=0.05)) as e:
+        e.cd("/bench")
+        e.commit()
+        results = Queue()
+        p = Process(target=reader, args=(fname, duration, results))
+        p.start()
+        n = 0
+        end = time.time() + duration
+        while time.time() < end:
+            e.log_many(("sensor", None, {"x": i, "y": i * 0.5}) for i in range(1000))
+            n += 1000
+        p.join()
+        queries, errors, slowest = results.get()
+        print("wal=%-5s %9.0f rows/s written, reader: %d queries, %d errors, slowest %.1fms" % (
+            wal, n / duration, queries, errors, slowest * 1000))
+        return e
+
+
+if __name__ == "__main__":
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    tmp = tempfile.mkdtemp()
+    run(os.path.join(tmp, "rollback.db"), False, duration)
+    e = run(os.path.join(tmp, "wal.db"), True, duration)
+    stats = e.checkpoint_scheduler.stats()
+    print("checkpoints: %d (%d busy), mean %.1fms, max %.1fms; max WAL size %.1f MB" % (
+        stats["checkpoints"], stats["busy"], stats["mean_duration"] * 1000, stats["max_duration"] * 1000,
+        stats["max_wal_size"] / float(1 << 20)))
@@ -0,0 +1,52 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from explogger import zmq_log
+
+# log() records published through LogProxyPub faster than the server can write them, with small
+# high-water marks: without flow control records are dropped (and counted by the server, in the
+# publisher_stats table); with credit-based flow control log() is slowed down instead
+
+SAMPLE = {"x": 0.25, "y": 0.75, "buttons": 1, "target": "circle"}
+
+
+def run(fname, n, hwm, credit=None, batch_size=1):
+    server = zmq_log.ZMQLog(fname, ntp_sync=False, rcvhwm=hwm)
+    pub = zmq_log.LogProxyPub(batch_size=batch_size, sndhwm=hwm, credit=credit)
+    # the first log() waits for the server to subscribe
+    pub.log("mouse", data=SAMPLE)
+    start = time.perf_counter()
+    for i in range(n):
+        pub.log("mouse", data=SAMPLE)
+    pub.flush()
+    published = time.perf_counter() - start
+    # waits for the server to receive everything published
+    pub.close()
+    proxy = zmq_log.LogProxy()
+    proxy.close()
+    server.process.join()
+
+    conn = sqlite3.connect(fname)
+    written = conn.execute("SELECT count(*) FROM log").fetchone()[0] - 1
+    dropped, dropped_records = conn.execute("SELECT sum(dropped), sum(dropped_records) FROM publisher_stats").fetchone()
+    conn.close()
+    return published, written, dropped, dropped_records
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    d = tempfile.mkdtemp()
+    try:
+        for name, hwm, credit, batch_size in [("no flow control", 100, None, 1), ("credit=50", 100, 50, 1),
+                                              ("no flow control, batches of 100", 10, None, 100),
+                                              ("credit=5, batches of 100", 10, 5, 100)]:
+            published, written, dropped, dropped_records = run(
+                os.path.join(d, "%s.db" % name.replace(" ", "").replace(",", "")), n, hwm, credit, batch_size)
+            print("%-32s hwm=%-4d log() %8.0f records/s; %6d written (%d lost, %d records counted dropped in %d messages)" % (
+                name, hwm, n / published, written, n - written, dropped_records or 0, dropped or 0))
+    finally:
+        shutil.rmtree(d)
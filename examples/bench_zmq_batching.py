@@ -0,0 +1,76 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from explogger import zmq_log
+
+# ingest rate of log() calls published through LogProxyPub, with and without batching, measured until
+# every record is in the database; and the delay before a lone record reaches the database
+
+
+SAMPLE = {"x": 0.25, "y": 0.75, "buttons": 1, "target": "circle"}
+
+
+def count(conn):
+    return conn.execute("SELECT count(*) FROM log").fetchone()[0]
+
+
+def wait_for(conn, n, idle=1.0):
+    # until n records are logged, or none have arrived for `idle` seconds (PUB drops records at its
+    # high-water mark); returns the time the last record arrived and the number logged
+    logged, last = count(conn), time.perf_counter()
+    while logged < n and time.perf_counter() - last < idle:
+        time.sleep(0.001)
+        now = count(conn)
+        if now != logged:
+            logged, last = now, time.perf_counter()
+    return last, logged
+
+
+def run(fname, n, batch_size, flush_interval=0.05, delays=20):
+    server = zmq_log.ZMQLog(fname, ntp_sync=False, wal=True)
+    pub = zmq_log.LogProxyPub(batch_size=batch_size, flush_interval=flush_interval)
+    # the first log() waits for the server to subscribe, and looks up the stream
+    pub.log("mouse", data=SAMPLE)
+    pub.flush()
+    conn = sqlite3.connect(fname, timeout=10)
+    logged = wait_for(conn, 1)[1]
+
+    start = time.perf_counter()
+    for i in range(n):
+        pub.log("mouse", data=SAMPLE)
+    pub.flush()
+    end, written = wait_for(conn, logged + n)
+    elapsed = end - start
+    lost = logged + n - written
+
+    # lone records, logged one at a time
+    worst = 0
+    for i in range(delays):
+        logged = count(conn)
+        start = time.perf_counter()
+        pub.log("mouse", data=SAMPLE)
+        end, written = wait_for(conn, logged + 1)
+        worst = max(worst, end - start)
+
+    conn.close()
+    pub.close()
+    proxy = zmq_log.LogProxy()
+    proxy.close()
+    server.process.join()
+    return elapsed, lost, worst
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    d = tempfile.mkdtemp()
+    try:
+        for batch_size in [1, 10, 100, 1000]:
+            elapsed, lost, worst = run(os.path.join(d, "batch%d.db" % batch_size), n, batch_size)
+            print("batch_size=%-5d %6.2fs %8.0f records/s (%d lost), lone record written within %5.1fms" % (
+                batch_size, elapsed, (n - lost) / elapsed, lost, worst * 1e3))
+    finally:
+        shutil.rmtree(d)
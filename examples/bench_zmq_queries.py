@@ -0,0 +1,73 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Event, Queue
+
+from explogger import zmq_log
+
+# log() calls through the ZMQ log server while another process runs slow queries (samples_dataframe() of
+# the whole log) in a loop: answered by query threads with their own read-only connections, or (with
+# query_workers=0) by the server loop, in between the writes
+
+SAMPLE = {"x": 0.25, "y": 0.75, "buttons": 1, "target": "circle"}
+
+
+def query_loop(stop, n_queries):
+    proxy = zmq_log.LogProxy()
+    while not stop.is_set():
+        proxy.samples_dataframe(streams=["mouse"])
+        n_queries.put(1)
+    proxy.disconnect()
+
+
+def run(fname, query_workers, preload, duration, round_size=100):
+    server = zmq_log.ZMQLog(fname, ntp_sync=False, wal=True, query_workers=query_workers)
+    proxy = zmq_log.LogProxy()
+    proxy.create("STREAM", "mouse")
+    for i in range(preload):
+        proxy.log("mouse", data=SAMPLE)
+    proxy.wait_acknowledged()
+    start = time.perf_counter()
+    proxy.samples_dataframe(streams=["mouse"])
+    query_time = time.perf_counter() - start
+
+    stop, n_queries = Event(), Queue()
+    querier = Process(target=query_loop, args=(stop, n_queries))
+    querier.start()
+    time.sleep(0.5)
+
+    # rounds of log() calls, each waiting until its calls are committed
+    latencies = []
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        t = time.perf_counter()
+        for i in range(round_size):
+            proxy.log("mouse", data=SAMPLE)
+        proxy.wait_acknowledged()
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    querier.join()
+    queries = 0
+    while not n_queries.empty():
+        queries += n_queries.get()
+
+    proxy.close()
+    server.process.join()
+    latencies.sort()
+    return query_time, len(latencies) * round_size / elapsed, latencies[len(latencies) // 2], latencies[-1], queries
+
+
+if __name__ == "__main__":
+    preload = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    d = tempfile.mkdtemp()
+    try:
+        for name, workers in [("queries in the server loop", 0), ("2 query threads", 2)]:
+            query_time, rate, median, worst, queries = run(os.path.join(d, "%d.db" % workers), workers, preload, duration)
+            print("%-28s query %.2fs; log() %7.0f msgs/s while querying, 100 calls committed in %5.1fms (median) "
+                  "%6.1fms (worst); %d queries" % (name, query_time, rate, median * 1e3, worst * 1e3, queries))
+    finally:
+        shutil.rmtree(d)
@@ -0,0 +1,72 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from multiprocessing import Process
+
+from explogger import zmq_log
+
+# messages/sec through the ZMQ log server: one round-trip per call (as with the old REQ/REP socket),
+# pipelined calls (call_async, waiting for the replies at the end), and fire-and-forget log() calls,
+# from one process and from several at once
+
+
+def lockstep(proxy, n):
+    for i in range(n):
+        proxy.call_async("log", "bench", data={"i": i}).result()
+
+
+def pipelined(proxy, n, window=1000):
+    for start in range(0, n, window):
+        pending = [proxy.call_async("log", "bench", data={"i": i}) for i in range(start, min(n, start + window))]
+        for p in pending:
+            p.result()
+
+
+def fire_and_forget(proxy, n):
+    for i in range(n):
+        proxy.log("bench", data={"i": i})
+    proxy.wait_acknowledged()
+
+
+def client(n):
+    proxy = zmq_log.LogProxy()
+    fire_and_forget(proxy, n)
+    proxy.disconnect()
+
+
+def run(fname, mode, n, n_clients=1):
+    server = zmq_log.ZMQLog(fname, ntp_sync=False)
+    proxy = server.get_proxy()
+    proxy.create("STREAM", "bench")
+    start = time.perf_counter()
+    if n_clients == 1:
+        mode(proxy, n)
+    else:
+        clients = [Process(target=client, args=(n // n_clients,)) for i in range(n_clients)]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+    elapsed = time.perf_counter() - start
+    proxy.close()
+    server.process.join()
+    conn = sqlite3.connect(fname)
+    logged = conn.execute("SELECT count(*) FROM log").fetchone()[0]
+    conn.close()
+    return elapsed, logged
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    d = tempfile.mkdtemp()
+    try:
+        for name, mode, n_clients in [("lockstep", lockstep, 1), ("pipelined", pipelined, 1),
+                                      ("fire-and-forget", fire_and_forget, 1), ("fire-and-forget x4", None, 4)]:
+            fname = os.path.join(d, "%s.db" % name.replace(" ", ""))
+            elapsed, logged = run(fname, mode, n, n_clients)
+            print("%-20s %6.2fs %8.0f msgs/s (%d entries logged)" % (name, elapsed, n / elapsed, logged))
+    finally:
+        shutil.rmtree(d)
@@ -0,0 +1,99 @@
+import os
+import pickle
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from explogger import zmq_log, wire
+
+# encoding cost and size of a log() call in each wire format, without the network; then log() calls and
+# log_array() calls through the ZMQ log server with each serializer
+
+SAMPLE = {"x": 0.25, "y": 0.75, "buttons": 1, "target": "circle"}
+STREAM_IDS = {"mouse": 1}
+STREAM_NAMES = {1: "mouse"}
+
+
+def encode_formats():
+    formats = [("pickled tuple (send_pyobj)", lambda: [pickle.dumps(("log", ("mouse",), {"data": SAMPLE}), protocol=-1)],
+                lambda frames: pickle.loads(frames[0]))]
+    for name in sorted(wire.SERIALIZERS):
+        try:
+            serializer = wire.get_serializer(name)
+        except ValueError:
+            continue
+        formats.append(("%s, stream name" % name, lambda s=serializer: wire.encode_call(s, "log", ("mouse",), {"data": SAMPLE}),
+                        lambda frames: wire.decode_call(frames, STREAM_NAMES.get)))
+        formats.append(("%s, LOG frame" % name,
+                        lambda s=serializer: wire.encode_call(s, "log", ("mouse",), {"data": SAMPLE}, STREAM_IDS.get),
+                        lambda frames: wire.decode_call(frames, STREAM_NAMES.get)))
+    return formats
+
+
+def bench_encoding(n):
+    for name, encode, decode in encode_formats():
+        frames = encode()
+        start = time.perf_counter()
+        for i in range(n):
+            encode()
+        encoded = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(n):
+            decode(frames)
+        decoded = time.perf_counter() - start
+        print("  %-28s %4d bytes  encode %8.0f calls/s  decode %8.0f calls/s" % (
+            name, sum(len(f) for f in frames), n / encoded, n / decoded))
+
+    arr = np.random.uniform(size=(1000, 128))
+    serializer = wire.get_serializer()
+    for name, encode in [("pickled tuple (send_pyobj)", lambda: pickle.dumps(("log_array", ("eeg", arr), {}), protocol=-1)),
+                         ("encode_call, out of band", lambda: wire.encode_call(serializer, "log_array", ("eeg", arr), {}))]:
+        start = time.perf_counter()
+        for i in range(200):
+            encode()
+        print("  1MB array, %-28s %7.0f MB/s" % (name, 200 * arr.nbytes / 1e6 / (time.perf_counter() - start)))
+
+
+def run_server(fname, serializer, n, arrays=0):
+    server = zmq_log.ZMQLog(fname, ntp_sync=False)
+    proxy = zmq_log.LogProxy(serializer=serializer)
+    proxy.create("STREAM", "mouse")
+    arr = np.random.uniform(size=(1000, 128))
+    start = time.perf_counter()
+    if arrays:
+        for i in range(arrays):
+            proxy.log_array("eeg", arr)
+    else:
+        for i in range(n):
+            proxy.log("mouse", data=SAMPLE)
+    proxy.wait_acknowledged()
+    elapsed = time.perf_counter() - start
+    proxy.close()
+    server.process.join()
+    conn = sqlite3.connect(fname)
+    logged = conn.execute("SELECT count(*) FROM log").fetchone()[0]
+    conn.close()
+    return elapsed, logged
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print("Encoding (msgpack %s):" % ("installed" if wire.msgpack is not None else "not installed"))
+    bench_encoding(100000)
+
+    d = tempfile.mkdtemp()
+    try:
+        print("Through the server:")
+        for serializer in sorted(wire.SERIALIZERS):
+            if serializer == "msgpack" and wire.msgpack is None:
+                continue
+            elapsed, logged = run_server(os.path.join(d, "%s.db" % serializer), serializer, n)
+            print("  log(), %-8s %6.2fs %8.0f msgs/s (%d entries logged)" % (serializer, elapsed, n / elapsed, logged))
+            elapsed, logged = run_server(os.path.join(d, "%s_arrays.db" % serializer), serializer, n, arrays=500)
+            print("  log_array() of 1MB, %-8s %6.2fs %6.0f MB/s" % (serializer, elapsed, 500 * 1.024 / elapsed))
+    finally:
+        shutil.rmtree(d)
@@ -24,6 +24,8 @@ def log_remote(name):
     for i in range(20):
         time.sleep(random.random()*0.1)
         logger.log(name, data={"name":name, "id":i})
+    # log() does not wait for the server; make sure everything has been written
+    logger.wait_acknowledged()
 
 if __name__=="__main__":
     # basic test if the remote logging is working...
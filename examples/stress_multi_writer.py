@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+from multiprocessing import Process, Queue
+
+import explogger
+
+# N processes logging to the same database file at once, each with its own ExperimentLog
+
+def writer(fname, name, n, results):
+    errors = 0
+    start = time.time()
+    try:
+        with explogger.ExperimentLog(fname, ntp_sync=False, multi_writer=True) as e:
+            e.cd("/stress/%s" % name)
+            for i in range(n):
+                try:
+                    e.log("sensor", data={"writer": name, "i": i})
+                except Exception:
+                    errors += 1
+                # a trial boundary every 1000 samples
+                if i % 1000 == 999:
+                    e.enter()
+                    e.leave()
+    except Exception:
+        # records lost by the background writer are reported when the log is closed
+        errors += 1
+    results.put((name, errors, time.time() - start))
+
+
+if __name__ == "__main__":
+    n_procs = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    fname = os.path.join(tempfile.mkdtemp(), "stress.db")
+
+    results = Queue()
+    start = time.time()
+    procs = [Process(target=writer, args=(fname, "w%d" % i, n, results)) for i in range(n_procs)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    elapsed = time.time() - start
+
+    errors = sum(results.get()[1] for p in procs)
+    conn = sqlite3.connect(fname)
+    written = conn.execute("SELECT count(*) FROM log").fetchone()[0]
+    runs, clean = conn.execute("SELECT count(*), sum(clean_exit) FROM runs").fetchone()
+    print("%d processes x %d records: %d written (expected %d), %d errors, %d/%d clean runs" % (
+        n_procs, n, written, n_procs * n, errors, clean, runs))
+    print("%.1fs, %.0f rows/s aggregate" % (elapsed, written / elapsed))
+    if written != n_procs * n or errors:
+        sys.exit("FAILED: %d of %d records missing, %d errors" % (n_procs * n - written, n_procs * n, errors))
@@ -12,13 +12,13 @@ logging.basicConfig()
 
 def f(name):
     print('hello', name)
-    with explogger.ExperimentLog('./exp.db', ntp_sync=False) as expl:
+    with explogger.ExperimentLog('./exp.db', ntp_sync=False, multi_writer=True) as expl:
         data = {'a':1, 'b':2}
         expl.log("data1", data=data)
 
 if __name__ == '__main__':
 
-    with explogger.ExperimentLog('./exp.db', ntp_sync=False) as expl:
+    with explogger.ExperimentLog('./exp.db', ntp_sync=False, multi_writer=True) as expl:
 
         data = {'a':3, 'b':4}
         expl.log("data0", data=data)
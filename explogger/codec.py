@@ -0,0 +1,200 @@
+import json
+import logging
+import struct
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+logger = logging.getLogger('explogger')
+
+# codec ids: the first byte of a compressed JSON payload (which is stored as a BLOB instead of TEXT),
+# and the codec column of the binary_codec table for compressed binary entries
+ZLIB = 1
+LZMA = 2        # xz container; no longer written, but still read
+ZLIB_DICT = 3
+LZMA_RAW = 4
+CODECS = {"zlib": ZLIB, "lzma": LZMA_RAW, "zlib-dict": ZLIB_DICT}
+
+# ZLIB_DICT payloads are [codec id][dictionary id, uint32][raw deflate stream]
+DICT_HEADER = struct.Struct(">BI")
+
+# window used with trained dictionaries; a small window makes each compressor cheap to set up
+DICT_WBITS = 13
+
+# raw LZMA2 streams carry no header (an xz container adds ~60 bytes, more than a short JSON payload
+# saves), so the dictionary size is fixed here, for both the encoder and the decoder. Setting up the
+# encoder costs time in proportion to it; larger dictionaries made each log() call ~50x slower.
+LZMA_DICT_SIZE = 1 << 16
+
+def lzma_filters(level=None):
+    """Filter chain for the raw LZMA2 streams of the "lzma" codec; the level is only needed to compress"""
+    lzma2 = {"id": lzma.FILTER_LZMA2, "dict_size": LZMA_DICT_SIZE}
+    if level is not None:
+        lzma2["preset"] = level
+    return [lzma2]
+
+
+class Codec(object):
+    """Compression of the JSON payloads (and optionally the binary entries) of a stream.
+
+    Each compressed payload records its codec, so logs can mix codecs (and uncompressed rows) freely,
+    and data written before compression was enabled stays readable.
+
+    Parameters:
+        method: "zlib", "lzma", or "zlib-dict": zlib with a dictionary trained on the stream's first
+                train_samples payloads, which compresses even short JSON payloads well. Payloads logged
+                before the dictionary is trained are stored uncompressed.
+        level: compression level (default 6)
+        min_size: payloads shorter than this many bytes are stored uncompressed
+        binaries: If True, binary entries (log(binary=...), log_array(), log_chunk()) are also compressed,
+                  with zlib (or lzma if that is the method)
+        train_samples: number of payloads used to train the dictionary ("zlib-dict")
+        dictionary_size: size of the trained dictionary in bytes (at most 8192)
+    """
+
+    def __init__(self, method="zlib", level=None, min_size=32, binaries=False, train_samples=1000,
+                 dictionary_size=4096):
+        if method not in CODECS:
+            raise ValueError("Unknown codec '%s'; should be one of %s" % (method, sorted(CODECS)))
+        if method == "lzma" and lzma is None:
+            raise ValueError("The lzma module is not available")
+        self.method = method
+        self.level = 6 if level is None else level
+        self.min_size = min_size
+        self.binaries = binaries
+        self.train_samples = train_samples
+        self.dictionary_size = min(dictionary_size, 1 << DICT_WBITS)
+        self.filters = lzma_filters(self.level) if method == "lzma" else None
+
+        # dictionary training state, for zlib-dict
+        self.samples = []
+        self.dictionary_id = None
+        self.compressor = None
+
+    @classmethod
+    def from_option(cls, codec):
+        """Codec for the codec options of ExperimentLog and create(): a method name, a Codec or None"""
+        if codec is None or isinstance(codec, Codec):
+            return codec
+        return cls(codec)
+
+    def params(self):
+        """Constructor parameters, stored in the stream_codec table"""
+        return {"method": self.method, "level": self.level, "min_size": self.min_size, "binaries": self.binaries,
+                "train_samples": self.train_samples, "dictionary_size": self.dictionary_size}
+
+    def copy(self):
+        """A new codec with the same parameters (and no trained dictionary), for another stream"""
+        return Codec(**self.params())
+
+    def __repr__(self):
+        return "Codec(%s)" % ", ".join("%s=%r" % kv for kv in sorted(self.params().items()))
+
+    def wants_dictionary(self):
+        """True once enough payloads have been seen to train the dictionary"""
+        return self.compressor is None and self.method == "zlib-dict" and len(self.samples) >= self.train_samples
+
+    def train(self):
+        """Build a dictionary from the sampled payloads. Deflate finds matches in the dictionary
+        nearest its end first, so the most recent samples go last."""
+        dictionary = b"".join(self.samples)[-self.dictionary_size:]
+        self.samples = []
+        return dictionary
+
+    def set_dictionary(self, dictionary_id, dictionary):
+        """Use the given (stored) dictionary for all further payloads"""
+        self.dictionary_id = dictionary_id
+        # every payload is compressed by a copy of this compressor, primed with the dictionary
+        self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -DICT_WBITS, 4, zlib.Z_DEFAULT_STRATEGY, dictionary)
+        self.samples = []
+
+    def encode_json(self, js):
+        """Return the value to store in log.json for a JSON string: the string itself, or a compressed BLOB"""
+        if js is None:
+            return js
+        data = js.encode("utf8")
+        if len(data) < self.min_size:
+            return js
+        if self.method == "zlib-dict":
+            if self.compressor is None:
+                if len(self.samples) < self.train_samples:
+                    self.samples.append(data)
+                return js
+            c = self.compressor.copy()
+            encoded = DICT_HEADER.pack(ZLIB_DICT, self.dictionary_id) + c.compress(data) + c.flush()
+        elif self.method == "zlib":
+            encoded = bytes(bytearray([ZLIB])) + zlib.compress(data, self.level)
+        else:
+            encoded = bytes(bytearray([LZMA_RAW])) + lzma.compress(data, lzma.FORMAT_RAW, filters=self.filters)
+        if len(encoded) >= len(data):
+            return js
+        return encoded
+
+    def encode_binary(self, buf):
+        """Return (value, codec id) to store for a binary entry; the codec id is None if it is stored as is"""
+        if not self.binaries or memoryview(buf).nbytes < self.min_size:
+            return buf, None
+        if self.method == "lzma":
+            return lzma.compress(buf, lzma.FORMAT_RAW, filters=self.filters), LZMA_RAW
+        return zlib.compress(buf, self.level), ZLIB
+
+
+class Decoder(object):
+    """Decodes values written by a Codec, loading the shared dictionaries from the
+    codec_dictionary table as they are needed.
+
+    Parameters:
+        cursor: cursor on the log database
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.dictionaries = {}
+
+    def json(self, value):
+        """Return the JSON text of a log.json value (uncompressed TEXT is returned as is)"""
+        if value is None or not isinstance(value, (bytes, bytearray, memoryview)):
+            return value
+        value = bytes(value)
+        codec = bytearray(value[:1])[0]
+        if codec == ZLIB:
+            data = zlib.decompress(value[1:])
+        elif codec == LZMA_RAW:
+            data = lzma.decompress(value[1:], lzma.FORMAT_RAW, filters=lzma_filters())
+        elif codec == LZMA:
+            data = lzma.decompress(value[1:])
+        elif codec == ZLIB_DICT:
+            _, dictionary_id = DICT_HEADER.unpack_from(value)
+            d = zlib.decompressobj(-15, self._dictionary(dictionary_id))
+            data = d.decompress(value[DICT_HEADER.size:]) + d.flush()
+        else:
+            raise ValueError("Unknown codec %d in JSON payload" % codec)
+        return data.decode("utf8")
+
+    def loads(self, value):
+        """Decode a log.json value to a Python object"""
+        js = self.json(value)
+        return json.loads(js) if js is not None else None
+
+    def binary(self, value, codec):
+        """Return the raw bytes of a binary entry, given its codec id from binary_codec (None if uncompressed)"""
+        if codec is None or value is None:
+            return value
+        if codec == ZLIB:
+            return zlib.decompress(value)
+        if codec == LZMA_RAW:
+            return lzma.decompress(value, lzma.FORMAT_RAW, filters=lzma_filters())
+        if codec == LZMA:
+            return lzma.decompress(value)
+        raise ValueError("Unknown codec %d for binary entry" % codec)
+
+    def _dictionary(self, dictionary_id):
+        if dictionary_id not in self.dictionaries:
+            row = self.cursor.connection.execute("SELECT dictionary FROM codec_dictionary WHERE id=?", (dictionary_id,)).fetchone()
+            if row is None:
+                raise KeyError("No codec dictionary %d" % dictionary_id)
+            self.dictionaries[dictionary_id] = bytes(row[0])
+        return self.dictionaries[dictionary_id]
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger('explogger')
+
+
+class CommitPolicy(object):
+    """Decides when an ExperimentLog commits. The same policy is used by log(), log_many(),
+    enter(), leave(), bind() and unbind(), so that writes are grouped into as few transactions as allowed.
+
+    Parameters:
+        every_n: Commit once this many statements (log entries, session changes) are uncommitted
+        every_t: Commit once the oldest uncommitted statement is this many seconds old. This is enforced
+                 by a timer thread, so it also applies when nothing else is being logged.
+        barriers: If True, session boundaries (enter, leave, bind, unbind) commit immediately.
+                  If False, they are grouped with the other writes.
+        crash_safe: If True, the log opens the database with synchronous writes, so that commits
+                    reach the disk, and session boundaries are always committed within max_delay
+                    seconds, even if barriers is False
+        max_delay: Longest time a session boundary can stay uncommitted in crash_safe mode
+
+    With no arguments, the policy commits only at session boundaries (and at explicit commit() calls).
+    A policy can only be used by one ExperimentLog at a time.
+    """
+
+    def __init__(self, every_n=None, every_t=None, barriers=True, crash_safe=False, max_delay=1.0):
+        self.every_n = every_n
+        self.every_t = every_t
+        self.barriers = barriers
+        self.crash_safe = crash_safe
+        self.max_delay = max_delay
+
+        self.explog = None
+        self.pending = 0
+        self.first_pending_time = None
+        # time by which a pending session boundary must be committed
+        self.deadline = None
+        self.commits = 0
+
+        self.timer = None
+        self.stopped = threading.Event()
+
+    @classmethod
+    def from_autocommit(cls, autocommit):
+        """Policy equivalent to the older `autocommit` option of ExperimentLog"""
+        if autocommit is True:
+            return cls(every_n=1)
+        return cls(every_t=autocommit)
+
+    def __repr__(self):
+        return "CommitPolicy(every_n=%s, every_t=%s, barriers=%s, crash_safe=%s, max_delay=%s)" % (
+            self.every_n, self.every_t, self.barriers, self.crash_safe, self.max_delay)
+
+    def attach(self, explog):
+        """Start applying this policy to the given log."""
+        if self.explog is not None:
+            raise ValueError("CommitPolicy is already in use by another ExperimentLog")
+        self.explog = explog
+
+        intervals = self._timer_intervals()
+        if intervals:
+            self.stopped.clear()
+            self.timer = threading.Thread(target=self._run_timer, args=(max(0.005, min(intervals) / 4.0),),
+                                          name="explogger-commit")
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _timer_intervals(self):
+        return [t for t in [self.every_t, self.max_delay if self.crash_safe else None] if t is not None]
+
+    def uses_timer(self):
+        """True if this policy commits from a background timer thread"""
+        return len(self._timer_intervals()) > 0
+
+    def detach(self):
+        """Stop the timer thread; the log should be committed afterwards."""
+        if self.timer is not None:
+            self.stopped.set()
+            self.timer.join()
+            self.timer = None
+        self.explog = None
+
+    # the methods below are called with the log's db_lock held
+
+    def wrote(self, n=1):
+        """Record that n statements have been written, committing if the policy requires it."""
+        if self.pending == 0:
+            self.first_pending_time = time.time()
+        self.pending += n
+        if self.every_n is not None and self.pending >= self.every_n:
+            self.explog.commit()
+
+    def barrier(self):
+        """Record a session boundary."""
+        self.wrote()
+        if self.pending == 0:
+            return
+        if self.barriers:
+            self.explog.commit()
+        elif self.crash_safe and self.deadline is None:
+            self.deadline = time.time() + self.max_delay
+
+    def committed(self):
+        """Reset the pending state after a commit."""
+        self.pending = 0
+        self.first_pending_time = None
+        self.deadline = None
+        self.commits += 1
+
+    def due(self, now):
+        """True if the pending statements must be committed by now."""
+        if self.pending == 0:
+            return False
+        if self.deadline is not None and now >= self.deadline:
+            return True
+        return self.every_t is not None and now - self.first_pending_time >= self.every_t
+
+    def _run_timer(self, interval):
+        while not self.stopped.wait(interval):
+            explog = self.explog
+            if explog is None:
+                break
+            with explog.db_lock:
+                if self.due(time.time()):
+                    logger.debug("Time-based commit")
+                    explog.commit()
@@ -6,7 +6,11 @@ import platform
 
 import traceback
 import collections
-from multiprocessing import RLock
+import contextlib
+import itertools
+import random
+import threading
+import multiprocessing
 
 import six
 
@@ -14,6 +18,13 @@ import numpy as np
 import sqlite3
 
 from .ntpsync import check_time_sync
+from .writer import LogWriter
+from .commit import CommitPolicy
+from .wal import CheckpointScheduler
+from .handler import SQLHandler
+from .shard import ShardPolicy
+from .codec import Codec
+from .indices import IndexManager, INDICES, build_indices
 
 def np_to_str(d):
     c = io.BytesIO()
@@ -25,6 +36,22 @@ def str_to_np(s):
     n = np.load(c)
     return n
 
+def array_header(arr):
+    """Return the (dtype, shape, fortran) description needed to rebuild an array from its raw buffer,
+    with dtype and shape as JSON strings"""
+    fortran = arr.flags.f_contiguous and not arr.flags.c_contiguous
+    return json.dumps(np.lib.format.dtype_to_descr(arr.dtype)), json.dumps(list(arr.shape)), int(fortran)
+
+def buffer_to_np(buf, dtype, shape, fortran=False):
+    """Return an array viewing the raw buffer stored by ExperimentLog.log_array(), without copying it.
+    dtype and shape are the JSON strings recorded in the binary_array table."""
+    descr = json.loads(dtype)
+    if isinstance(descr, list):
+        # structured dtypes come back from JSON as lists of lists
+        descr = [tuple(field) for field in descr]
+    dtype = np.lib.format.descr_to_dtype(descr)
+    return np.frombuffer(buf, dtype=dtype).reshape(json.loads(shape), order='F' if fortran else 'C')
+
 
 import logging
 logger = logging.getLogger('explogger')
@@ -51,6 +78,26 @@ def setup_logging(with_console=False):
 class ExperimentException(Exception):
     pass
 
+
+class NullLock(object):
+    """A lock which does nothing, for logs only ever used from a single thread"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        return False
+
+    def acquire(self, blocking=True, timeout=-1):
+        return True
+
+    def release(self):
+        pass
+
+# locks guarding the database connection, selected by ExperimentLog(locking=...)
+LOCKING_STRATEGIES = {"multiprocessing": multiprocessing.RLock,
+                      "threading": threading.RLock,
+                      "none": NullLock}
+
 def pretty_json(x):
     return json.dumps(x, sort_keys=True, indent=4, separators=(',', ': '))
 
@@ -59,89 +106,352 @@ class MetaProxy(object):
 
         def __init__(self, explog):
             self.__dict__['_explog'] = explog
+            # fields set inside a batch() block, not yet written
+            self.__dict__['_pending'] = None
 
         def __dir__(self):
             meta = self._explog.get_meta()
+            if self._pending:
+                meta.update(self._pending)
             return sorted(list(meta.keys()))
 
         def __getattr__(self, attr):
-            meta = self._explog.get_meta()
-            return meta[attr]
+            if self._pending and attr in self._pending:
+                return self._pending[attr]
+            return self._explog.get_meta_value(attr)
 
         def __setattr__(self, attr, value):
-            self._explog.set_meta(**{attr:value})
+            if self._pending is not None:
+                self._pending[attr] = value
+            else:
+                self._explog.set_meta(**{attr:value})
+
+        @contextlib.contextmanager
+        def batch(self):
+            """Group metadata updates: fields set inside the block are written as one update when it exits,
+            or discarded if it raises. For example:
+                with e.meta.batch():
+                    e.meta.stage = "setup"
+                    e.meta.title = "Pointing study"
+            """
+            if self._pending is not None:
+                # already inside a batch
+                yield self
+                return
+            self.__dict__['_pending'] = {}
+            try:
+                yield self
+                pending = self._pending
+            finally:
+                self.__dict__['_pending'] = None
+            if pending:
+                self._explog.set_meta(**pending)
+
+def read_dataset_meta(cursor):
+    """Return the current metadata for the entire dataset, from the last full snapshot in the dataset
+    table and any deltas (rows with type 'DELTA') written after it.
+
+    Returns:
+        (meta, n_deltas): the metadata dictionary, and the number of deltas applied on top of the snapshot
+    """
+    row = cursor.execute("SELECT id, json FROM dataset WHERE type IS NOT 'DELTA' ORDER BY id DESC LIMIT 1").fetchone()
+    if row is None:
+        meta, since = {}, 0
+    else:
+        meta, since = json.loads(row[1]), row[0]
+    deltas = cursor.execute("SELECT json FROM dataset WHERE type='DELTA' AND id>? ORDER BY id", (since,)).fetchall()
+    for delta in deltas:
+        meta.update(json.loads(delta[0]))
+    return meta, len(deltas)
 
 MetaTuple = collections.namedtuple('MetaTuple', ['mtype', 'name', 'type', 'description', 'json'])
 
-
-# class SQLLogger(logging.Handler):
-#     """Simple class to direct logging output to the database"""
-#     def emit(self, record):
-#         log_entry = self.format(record)
-#         self.db._insert_log(log_entry, record.levelno)
+# defaults for the (stream, t, data, tag, valid, binary) records accepted by log_many()
+_RECORD_DEFAULTS = (None, None, None, "", True, None)
+
+# column types that can be declared in a stream schema, and the SQL types they are stored as
+SCHEMA_TYPES = {int: "INTEGER", float: "REAL", str: "TEXT",
+                "int": "INTEGER", "integer": "INTEGER",
+                "float": "REAL", "real": "REAL",
+                "str": "TEXT", "text": "TEXT"}
+
+# one level of the session hierarchy; ExperimentLog keeps a stack of these from the root to the current session
+SessionFrame = collections.namedtuple('SessionFrame', ['id', 'path', 'parent', 'subcount'])
+
+# a stream with a declared schema, stored in its own table with one typed column per field
+TypedStream = collections.namedtuple('TypedStream', ['table', 'columns', 'column_set', 'insert'])
+
+# resolution of bindings: a binding of a meta entry to a session applies to all of its descendants,
+# unless a descendant unbinds it (a meta_session row with session NULL and unbound_session set).
+# The nearest row to a session decides, and the newest row wins at the same session.
+
+# the bindings rows of a session and all of its ancestors, nearest first (parameter: session id)
+SESSION_BINDINGS = """WITH RECURSIVE ancestors(id, depth) AS (
+        SELECT ?, 0
+        UNION ALL
+        SELECT session.parent, ancestors.depth+1 FROM session JOIN ancestors ON session.id=ancestors.id
+        WHERE session.parent IS NOT NULL)
+    SELECT meta_session.meta, meta_session.session IS NOT NULL, ancestors.depth, meta_session.id
+        FROM ancestors JOIN meta_session ON meta_session.session=ancestors.id
+    UNION ALL
+    SELECT meta_session.meta, 0, ancestors.depth, meta_session.id
+        FROM ancestors JOIN meta_session ON meta_session.unbound_session=ancestors.id
+    ORDER BY 3, 4 DESC"""
+
+# prefix for queries over every session a meta entry is bound to, as the CTE `bound`
+# (parameters: meta id, meta id)
+BOUND_SESSIONS = """WITH RECURSIVE bound(id) AS (
+        SELECT session FROM meta_session WHERE meta=? AND session IS NOT NULL
+        UNION
+        SELECT session.id FROM session JOIN bound ON session.parent=bound.id
+        WHERE session.id NOT IN (SELECT unbound_session FROM meta_session WHERE meta=? AND session IS NULL)) """
+
+
+def resolve_bindings(cursor, session_id):
+    """Return the set of meta ids bound to the given session, directly or through its ancestors"""
+    seen = set()
+    bound = set()
+    for meta, is_bound, depth, id in cursor.execute(SESSION_BINDINGS, (session_id,)).fetchall():
+        if meta not in seen:
+            seen.add(meta)
+            if is_bound:
+                bound.add(meta)
+    return bound
+
+
+def typed_table_name(stream_id):
+    """Name of the table holding the typed columns for a stream"""
+    return "log_%d" % stream_id
+
+def typed_table_sql(schema, stream_id, columns):
+    """CREATE TABLE statement for the typed columns [(column, SQL type), ...] of a stream, in the given schema"""
+    return "CREATE TABLE IF NOT EXISTS %s.%s (id INTEGER PRIMARY KEY, %s, FOREIGN KEY(id) REFERENCES log(id))" % (
+        schema, typed_table_name(stream_id), ", ".join("%s %s" % (quote_identifier(c), t) for c, t in columns))
+
+# statements writing the sample data; these go to the attached shard (see shard.py) when the log is sharded
+DataStatements = collections.namedtuple('DataStatements', ['log', 'binary', 'binary_array', 'chunk', 'binary_codec'])
+
+def data_statements(schema):
+    return DataStatements("INSERT INTO %s.log(session, valid, time, stream, tag, json, binary) VALUES (?, ?, ?, ?, ?, ?, ?)" % schema,
+                          "INSERT INTO %s.binary(binary) VALUES (?)" % schema,
+                          "INSERT INTO %s.binary_array(id, dtype, shape, fortran) VALUES (?, ?, ?, ?)" % schema,
+                          "INSERT INTO %s.chunk(id, n, rate, timestamps) VALUES (?, ?, ?, ?)" % schema,
+                          "INSERT INTO %s.binary_codec(id, codec) VALUES (?, ?)" % schema)
+
+def quote_identifier(name):
+    return '"%s"' % name.replace('"', '""')
 
 
 # setup_logging()
 
 class ExperimentLog(object):
 
-    def __init__(self, fname, autocommit=None, ntp_sync=True, ntp_servers=None, run_config={}, test_run=False):
+    def __init__(self, fname, autocommit=None, ntp_sync=True, ntp_servers=None, run_config={}, test_run=False,
+                 async_writes=False, queue_size=100000, queue_policy="block", commit_policy=None,
+                 wal=False, busy_timeout=5.0, checkpoint_scheduler=None, multi_writer=False, max_retries=20,
+                 locking="multiprocessing", meta_deltas=False, meta_snapshot_every=100, shards=None, codec=None,
+                 indices=None):
         """
         autocommit: If None, never autocommits. If an integer, autocommits every n seconds. If True,
-                    autocommits on *every* write (not recommended)
+                    autocommits on *every* write (not recommended). Ignored if commit_policy is given.
+        commit_policy: A CommitPolicy deciding when writes are committed (by statement count, by a timer,
+                       at session boundaries, with bounded crash-safety). Defaults to committing at
+                       session boundaries, plus the autocommit interval if one is given.
+        async_writes: If True, log() only timestamps and queues each record; a background thread
+                      writes the queued records to the database in bulk. log() then returns None
+                      instead of the log entry id.
+        queue_size: Maximum number of records waiting to be written when async_writes is True
+        queue_policy: What log() does when the queue is full: "block" until there is space,
+                      "drop" the record, or "spill" it into an unbounded overflow list
+        wal: If True, use SQLite's write-ahead log, so that other processes (e.g. analysis notebooks
+             using extract.open_reader()) can read the database while it is being written.
+        busy_timeout: Seconds to wait for a lock held by another connection before failing
+        checkpoint_scheduler: The CheckpointScheduler used to checkpoint the WAL in the background when
+                              wal is True. Defaults to CheckpointScheduler() with its default thresholds.
+        multi_writer: If True, several processes can log to the same database file at once, each with
+                      its own ExperimentLog. This implies wal and async_writes: log() records are staged
+                      in-process and merged into the database in bulk, and every write is a short
+                      BEGIN IMMEDIATE transaction, retried with jittered backoff if the database is locked.
+                      The default commit policy commits after every write.
+        max_retries: Number of times a locked write is retried in multi_writer mode before giving up
+        locking: Lock guarding the database connection: "multiprocessing" (the default), "threading"
+                 (cheaper, if the log is not shared with forked processes) or "none" (for logs only
+                 used from one thread). "none" is upgraded to "threading" if the log starts
+                 background threads (async_writes, multi_writer, timed commits).
+        meta_deltas: If True, updates to the dataset metadata (e.meta) store only the changed fields,
+                     with a full snapshot every meta_snapshot_every updates, so the history grows linearly
+                     rather than quadratically.
+        shards: If set, the sample data (log, binary, arrays, chunks and typed columns) is written to separate
+                shard files next to the main database, which keeps sessions, metadata, runs and a catalog
+                of the shards. "run" starts a new shard for every run; an integer starts a new shard once
+                the current one is larger than that many bytes; or pass a ShardPolicy.
+                Use extract.open_reader() or extract.fan_out() to query across the shards. A sharded log
+                reopened without this option continues writing to its last shard.
+        codec: Compress the JSON payloads of every stream (and optionally binary entries): "zlib", "lzma",
+               "zlib-dict" (zlib with a dictionary trained on each stream's first samples) or a Codec.
+               Streams can also be given their own codec with create(). Compressed rows record their codec,
+               and the extract functions decode them transparently.
+        indices: Build the composite indices used by the extract functions (see indices.INDICES): "open" when the
+                 log is opened, "end" when the run ends (keeping ingest fast), "background" from a background
+                 thread once the log is opened, or an IndexManager. None leaves indexing to add_indices().
                     """
         logger.debug("Opening database '%s'. Autocommit: '%s'" % (fname, autocommit))
 
-        self.db_lock = RLock()
+        self.multi_writer = multi_writer
+        self.max_retries = max_retries
+        if multi_writer:
+            wal = True
+            async_writes = True
+            if commit_policy is None:
+                # keep write transactions short, so other processes are never locked out for long
+                commit_policy = CommitPolicy(every_n=1)
+        if commit_policy is None:
+            commit_policy = CommitPolicy.from_autocommit(autocommit)
+
+        if locking not in LOCKING_STRATEGIES:
+            raise ExperimentException("Unknown locking strategy '%s'; should be one of %s" % (locking, sorted(LOCKING_STRATEGIES)))
+        indices = IndexManager.from_option(indices)
+        if locking == "none" and (async_writes or commit_policy.uses_timer() or
+                                  (indices is not None and indices.when == "background")):
+            logger.warning("Background threads need a lock; using threading locks instead of none")
+            locking = "threading"
+        self.locking = locking
+        self.db_lock = LOCKING_STRATEGIES[locking]()
+
+        if shards is not None and not isinstance(shards, ShardPolicy):
+            shards = ShardPolicy.from_option(shards)
+        if shards is not None and (multi_writer or fname == ":memory:"):
+            raise ExperimentException("Sharding needs a database file written by a single ExperimentLog")
+        self.shard_policy = None
+        self.index_manager = None
 
         with self.db_lock:
-            self.conn = sqlite3.connect(fname)
+            # the connection is shared with background threads; all access is guarded by db_lock
+            # multiple writers take the write lock as soon as a transaction starts, so that
+            # lock waits happen (under the busy timeout) at BEGIN and never part-way through a transaction
+            self.conn = sqlite3.connect(fname, check_same_thread=False, timeout=busy_timeout,
+                                        isolation_level="IMMEDIATE" if multi_writer else "")
             self.cursor = self.conn.cursor()
+            self.fname = fname
 
             self.time_offset = 0
             if ntp_sync:
                 # synchronise the (global) time
                 self.time_offset = check_time_sync(n_queries=10, servers=ntp_servers)
 
-            # extend the cache size and disable synchronous writing
-            self.execute("PRAGMA cache_size=2000000;")
-            self.execute("PRAGMA synchronous=OFF;")
+            self.commit_policy = commit_policy
+            logger.debug("Commit policy: %s" % commit_policy)
+
+            # extend the cache size and disable synchronous writing (unless commits must be crash-safe)
+            self._execute("PRAGMA cache_size=2000000;")
+            self._execute("PRAGMA busy_timeout=%d;" % int(busy_timeout * 1000))
+            self.checkpoint_scheduler = None
+            if wal:
+                journal_mode = self._execute("PRAGMA journal_mode=WAL;").fetchone()[0]
+                if journal_mode.lower() != "wal":
+                    # e.g. in-memory databases
+                    logger.warning("Could not enable WAL mode for '%s'; using journal mode '%s'" % (fname, journal_mode))
+                    wal = False
+            self.wal = wal
+            if wal:
+                # a WAL database stays consistent with NORMAL; only commits since the last checkpoint can be lost
+                self.synchronous = "FULL" if commit_policy.crash_safe else "NORMAL"
+                self._execute("PRAGMA synchronous=%s;" % self.synchronous)
+                # checkpoints are run by the scheduler, off the writing thread
+                self._execute("PRAGMA wal_autocheckpoint=0;")
+                self.checkpoint_scheduler = checkpoint_scheduler or CheckpointScheduler()
+                self.checkpoint_scheduler.start(fname)
+                logger.debug("WAL mode, checkpointing with %s" % self.checkpoint_scheduler)
+            else:
+                self.synchronous = "FULL" if commit_policy.crash_safe else "OFF"
+                self._execute("PRAGMA synchronous=%s;" % self.synchronous)
 
-            # allow simple access to the metadata
+            # allow simple access to the metadata, cached in-process
             self.meta = MetaProxy(self)
+            self.meta_deltas = meta_deltas
+            self.meta_snapshot_every = meta_snapshot_every
+            self._meta_cache = None
+            self._meta_n_deltas = 0
+            self._meta_data_version = None
 
             # create the tables
-            table_exists = self.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='runs'").fetchone()[0]
+            if multi_writer:
+                # only one process may create the tables
+                self._execute("BEGIN IMMEDIATE")
+            table_exists = self._execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='runs'").fetchone()[0]
 
             if not table_exists:
                 self.create_tables()
             else:
                 logger.debug("Tables already created.")
+            self.upgrade_tables()
+            if multi_writer:
+                self.conn.commit()
 
-            self.autocommit = autocommit
-            self.last_commit_time = self.real_time()
             self.in_run = False
             self.stream_cache = {}
+            # PATH metadata entries known to exist
+            self.path_cache = set()
+            self.session_stack = []
+            self.set_data_schema("main")
+            self.default_codec = Codec.from_option(codec)
+            self.stream_codecs = self._load_stream_codecs()
             self.opened = True
+            self.writer = None
+            self.log_handler = None
 
             # start in the root session
-            root_id = self.execute("SELECT id FROM session where name='[ROOT]'").fetchone()[0]
+            root_id = self._execute("SELECT id FROM session where name='[ROOT]'").fetchone()[0]
             self.resume_session(root_id)
 
+            # the policy's commit timer starts from here
+            self.commit_policy.attach(self)
+
             # start the run
             self._start(run_config=run_config, test_run=test_run)
 
+            if shards is None and self._execute("SELECT count(*) FROM shards").fetchone()[0]:
+                # a sharded log keeps its sample data in the shards, whose ids would clash with new rows
+                # in the main database; keep writing to the last shard
+                if multi_writer:
+                    raise ExperimentException("'%s' is sharded; sharded logs cannot be written with multi_writer" % fname)
+                logger.debug("'%s' is sharded; continuing its last shard" % fname)
+                shards = ShardPolicy(per_run=False)
+
+            if shards is not None:
+                # opens (or reuses) a shard and switches the sample data writes to it
+                self.shard_policy = shards
+                shards.attach(self)
+
+            if indices is not None:
+                self.index_manager = indices
+                indices.attach(self)
+
+            if async_writes:
+                self.writer = LogWriter(self, queue_size=queue_size, policy=queue_policy)
+
     def resume_session(self, id):
         """Jump into a new session given by the ID"""
         with self.db_lock:
-            self.session_id = id
+            # load the chain of ancestors of this session, root first
+            rows = self._execute("""WITH RECURSIVE ancestors(id, path, parent, subcount, depth) AS
+                                    (SELECT id, path, parent, subcount, 0 FROM session WHERE id=?
+                                     UNION ALL
+                                     SELECT session.id, session.path, session.parent, session.subcount, ancestors.depth+1
+                                     FROM session JOIN ancestors ON session.id=ancestors.parent)
+                                   SELECT id, path, parent, subcount FROM ancestors ORDER BY depth DESC""", (id,)).fetchall()
+            if not rows:
+                raise ExperimentException("No session with ID %d" % id)
+            self.session_stack = [SessionFrame(*row) for row in rows]
             logger.debug("Resuming from session %d '%s'" % (id,self.session_path))
 
+    @property
+    def session_id(self):
+        return self.session_stack[-1].id
+
     @property
     def session_path(self):
-        with self.db_lock:
-            path = self.execute("SELECT path FROM session where id=?", (self.session_id,)).fetchone()[0]
-            return path
+        return self.session_stack[-1].path
 
     def __enter__(self):
         """Start when using a context-manager"""
@@ -168,7 +478,7 @@ class ExperimentLog(object):
 
         logger.debug("Creating tables.")
 
-        self.execute('''CREATE TABLE IF NOT EXISTS meta
+        self._execute('''CREATE TABLE IF NOT EXISTS meta
                      (id INTEGER PRIMARY KEY, mtype TEXT, name TEXT, type TEXT, description TEXT, json TEXT, meta INTEGER)''')
 
         # record variables of a particular experiment or trial
@@ -180,7 +490,7 @@ class ExperimentLog(object):
         # Complete indicates if the trial was finished successfully
         # notes indicates any special notes for this trial
         # parent indicates the hierarchy of this session
-        self.execute('''CREATE TABLE IF NOT EXISTS session
+        self._execute('''CREATE TABLE IF NOT EXISTS session
                     (id INTEGER PRIMARY KEY, start_time REAL, end_time REAL,
                     test_run INT, random_seed INT,
                     valid INT, complete INT, description TEXT,
@@ -191,16 +501,16 @@ class ExperimentLog(object):
                     )''')
 
         # text tags which are recorded throughout the trial stream
-        self.execute('''CREATE TABLE IF NOT EXISTS log
+        self._execute('''CREATE TABLE IF NOT EXISTS log
                     (id INTEGER PRIMARY KEY, session INT, valid INT, time REAL, stream INT, tag TEXT, json TEXT, binary INT,
                     FOREIGN KEY(stream) REFERENCES meta(id),
                     FOREIGN KEY(session) REFERENCES session(id),
                     FOREIGN KEY(binary) REFERENCES binary(id))
                     ''')
 
-        self.execute('''CREATE TABLE IF NOT EXISTS binary (id INTEGER PRIMARY KEY, binary BLOB)''')
+        self._execute('''CREATE TABLE IF NOT EXISTS binary (id INTEGER PRIMARY KEY, binary BLOB)''')
 
-        self.execute('''CREATE TABLE IF NOT EXISTS sync_ext
+        self._execute('''CREATE TABLE IF NOT EXISTS sync_ext
                     (id INTEGER PRIMARY KEY,
                     fname TEXT,
                     description TEXT,
@@ -218,7 +528,7 @@ class ExperimentLog(object):
         # uname records the details of the machine this was run was executed on
         # ntp_clock_offset records the clock offset that was in effect for this run (all timestamps already incorporate this value)
         # json records any per-run configuration
-        self.execute('''CREATE TABLE IF NOT EXISTS runs
+        self._execute('''CREATE TABLE IF NOT EXISTS runs
                     (id INTEGER PRIMARY KEY,
                     start_time REAL,
                     end_time REAL,
@@ -230,73 +540,147 @@ class ExperimentLog(object):
                     ''')
 
         # maps software runs to experimental sessions
-        self.execute('''CREATE TABLE IF NOT EXISTS run_session (id INTEGER PRIMARY KEY, session INT, run INT, FOREIGN KEY(session) REFERENCES session(id), FOREIGN KEY(run) REFERENCES runs(id))''')
+        self._execute('''CREATE TABLE IF NOT EXISTS run_session (id INTEGER PRIMARY KEY, session INT, run INT, FOREIGN KEY(session) REFERENCES session(id), FOREIGN KEY(run) REFERENCES runs(id))''')
 
 
         # stores the logging data from the custom handler
-        self.execute('''CREATE TABLE IF NOT EXISTS debug_logging (id INTEGER PRIMARY KEY, time REAL, record TEXT, run INT,  level int, FOREIGN KEY(run) REFERENCES runs(id))''')
+        self._execute('''CREATE TABLE IF NOT EXISTS debug_logging (id INTEGER PRIMARY KEY, time REAL, record TEXT, run INT,  level int, FOREIGN KEY(run) REFERENCES runs(id))''')
 
 
         # map (many) users/equipment/configs to (many) sessions
-        self.execute('''CREATE TABLE IF NOT EXISTS meta_session
+        self._execute('''CREATE TABLE IF NOT EXISTS meta_session
                     (id INTEGER PRIMARY KEY, meta INT, session INT,  json TEXT, time REAL, unbound_session INT,
                     FOREIGN KEY(meta) REFERENCES meta(id)
                     FOREIGN KEY(session) REFERENCES session(id)
                     )''')
 
         # insert the root session
-        self.execute('''INSERT INTO session(name, start_time, path, subcount) VALUES (?,?,?,?)''', ("[ROOT]", self.real_time(),'/',0))
+        self._execute('''INSERT INTO session(name, start_time, path, subcount) VALUES (?,?,?,?)''', ("[ROOT]", self.real_time(),'/',0))
 
         # create the convenience views
-        self.execute('''CREATE VIEW IF NOT EXISTS users AS SELECT * FROM meta WHERE mtype="USER"''')
-        self.execute('''CREATE VIEW IF NOT EXISTS session_meta AS SELECT * FROM meta WHERE mtype="SESSION"''')
-        self.execute('''CREATE VIEW IF NOT EXISTS stream AS SELECT * FROM meta WHERE mtype="STREAM"''')
-        self.execute('''CREATE VIEW IF NOT EXISTS path AS SELECT * FROM meta WHERE mtype="PATH"''')
-        self.execute('''CREATE VIEW IF NOT EXISTS equipment AS SELECT * FROM meta WHERE mtype="EQUIPMENT"''')
-        self.execute('''CREATE VIEW IF NOT EXISTS dataset AS SELECT * FROM meta WHERE mtype="DATASET"''')
+        self._execute('''CREATE VIEW IF NOT EXISTS users AS SELECT * FROM meta WHERE mtype="USER"''')
+        self._execute('''CREATE VIEW IF NOT EXISTS session_meta AS SELECT * FROM meta WHERE mtype="SESSION"''')
+        self._execute('''CREATE VIEW IF NOT EXISTS stream AS SELECT * FROM meta WHERE mtype="STREAM"''')
+        self._execute('''CREATE VIEW IF NOT EXISTS path AS SELECT * FROM meta WHERE mtype="PATH"''')
+        self._execute('''CREATE VIEW IF NOT EXISTS equipment AS SELECT * FROM meta WHERE mtype="EQUIPMENT"''')
+        self._execute('''CREATE VIEW IF NOT EXISTS dataset AS SELECT * FROM meta WHERE mtype="DATASET"''')
         self.meta.stage = "init"
 
+    def upgrade_tables(self):
+        """Create the tables added in later versions of the logger, so that older databases can still be opened"""
+        # dtype/shape of arrays stored as raw buffers in the binary table by log_array()
+        self._execute('''CREATE TABLE IF NOT EXISTS binary_array
+                    (id INTEGER PRIMARY KEY, dtype TEXT, shape TEXT, fortran INT,
+                    FOREIGN KEY(id) REFERENCES binary(id))''')
+
+        # blocks of samples logged by log_chunk(); the samples (and per-sample timestamps, if any) are arrays
+        # in the binary table, and the sample times are log.time + i/rate when there are no timestamps
+        self._execute('''CREATE TABLE IF NOT EXISTS chunk
+                    (id INTEGER PRIMARY KEY, n INT, rate REAL, timestamps INT,
+                    FOREIGN KEY(id) REFERENCES log(id),
+                    FOREIGN KEY(timestamps) REFERENCES binary(id))''')
+
+        # column schemas for streams stored as typed columns; each stream has a table log_<stream id>
+        self._execute('''CREATE TABLE IF NOT EXISTS stream_schema
+                    (id INTEGER PRIMARY KEY, stream INT, name TEXT, type TEXT,
+                    FOREIGN KEY(stream) REFERENCES meta(id))''')
+
+        # bindings are stored once, at the session they were made in, and resolved through the session
+        # parents; these keep both directions of that lookup proportional to the depth of the tree
+        self._execute("CREATE INDEX IF NOT EXISTS session_parent ON session(parent)")
+        self._execute("CREATE INDEX IF NOT EXISTS meta_session_session ON meta_session(session)")
+        self._execute("CREATE INDEX IF NOT EXISTS meta_session_unbound ON meta_session(unbound_session)")
+        self._execute("CREATE INDEX IF NOT EXISTS meta_session_meta ON meta_session(meta)")
+        # every new repetition session adds a PATH entry, which enter() looks up by name
+        self._execute("CREATE INDEX IF NOT EXISTS meta_name ON meta(name, mtype)")
+
+        # records from the logging handler are read back by run and time range
+        self._execute("CREATE INDEX IF NOT EXISTS debug_logging_run ON debug_logging(run, time)")
+
+        # catalog of the shard files holding the sample data, when the log is sharded (see shard.py);
+        # fname is relative to the directory of this database
+        # compression (see codec.py): codecs declared for streams with create(), dictionaries trained for
+        # the zlib-dict codec, and the codec of each compressed binary entry. Compressed JSON payloads are
+        # stored in log.json as BLOBs, and identify their own codec.
+        self._execute('''CREATE TABLE IF NOT EXISTS stream_codec
+                    (stream INTEGER PRIMARY KEY, json TEXT, FOREIGN KEY(stream) REFERENCES meta(id))''')
+        self._execute('''CREATE TABLE IF NOT EXISTS codec_dictionary
+                    (id INTEGER PRIMARY KEY, stream INT, dictionary BLOB, created REAL, FOREIGN KEY(stream) REFERENCES meta(id))''')
+        self._execute('''CREATE TABLE IF NOT EXISTS binary_codec
+                    (id INTEGER PRIMARY KEY, codec INT, FOREIGN KEY(id) REFERENCES binary(id))''')
+
+        self._execute('''CREATE TABLE IF NOT EXISTS shards
+                    (id INTEGER PRIMARY KEY, fname TEXT, run INT, created REAL, closed REAL, first_log INT, first_binary INT,
+                    FOREIGN KEY(run) REFERENCES runs(id))''')
+
+        # messages (and the log records in them) received by the log server from each publisher in a run
+        # (see zmq_log.py), and those lost, counted from the gaps in the publisher's sequence numbers
+        self._execute('''CREATE TABLE IF NOT EXISTS publisher_stats
+                    (id INTEGER PRIMARY KEY, run INT, publisher TEXT, messages INT, records INT,
+                    dropped INT, dropped_records INT, first_time REAL, last_time REAL,
+                    FOREIGN KEY(run) REFERENCES runs(id))''')
+
     @property
     def random_seed(self):
         """Return the current random seed"""
         with self.db_lock:
-            return self.execute("SELECT random_seed FROM session WHERE id=?", (self.session_id,)).fetchone()[0]
+            return self._execute("SELECT random_seed FROM session WHERE id=?", (self.session_id,)).fetchone()[0]
 
     def set_meta(self, **kwargs):
         """Update the global metadata for this entire dataset"""
         with self.db_lock:
-            current = self.get_meta()
+            current = dict(self._dataset_meta())
             for arg,value in six.iteritems(kwargs):
                 current[arg] = value
-            self.execute('INSERT INTO meta(json,mtype) VALUES (?, "DATASET")', (json.dumps(current),))
+            if self.meta_deltas and self._meta_n_deltas < self.meta_snapshot_every:
+                self._execute('INSERT INTO meta(json,mtype,type) VALUES (?, "DATASET", "DELTA")', (json.dumps(kwargs),))
+                self._meta_n_deltas += 1
+            else:
+                self._execute('INSERT INTO meta(json,mtype) VALUES (?, "DATASET")', (json.dumps(current),))
+                self._meta_n_deltas = 0
+            self._meta_cache = current
 
 
     def get_meta(self):
         """Return the metadata for the entire dataset as a dictionary"""
         with self.db_lock:
-            row = self.execute("SELECT json FROM dataset WHERE id=(SELECT MAX(id) FROM dataset)").fetchone()
-            if row is not None:
-                return json.loads(row[0])
-            return {}
-
-
-    # def get_logger(self):
-    #     pass
-    #     # return self.logger
+            return dict(self._dataset_meta())
 
-
-    def _insert_log(self, record, levelno):
-        """Used by the custom logging module to store records into the database"""
-        self.execute("INSERT INTO debug_logging(time,record,run, level) VALUES (?, ?, ?, ?)",
-                           (self.real_time(),
-                           record,
-                           self.run_id,
-                           levelno
-                           ))
+    def get_meta_value(self, name):
+        """Return one field of the dataset metadata (raises KeyError if it is not set)"""
+        with self.db_lock:
+            return self._dataset_meta()[name]
+
+    def _dataset_meta(self):
+        """The cached dataset metadata; reloaded if another connection may have changed it."""
+        if self.multi_writer:
+            # other processes write to the same file; data_version changes whenever they commit
+            version = self._execute("PRAGMA data_version").fetchone()[0]
+            if version != self._meta_data_version:
+                self._meta_data_version = version
+                self._meta_cache = None
+        if self._meta_cache is None:
+            self._meta_cache, self._meta_n_deltas = read_dataset_meta(self.cursor)
+        return self._meta_cache
+
+
+    def get_logger(self, **kwargs):
+        """Return a logging.Handler which stores log records in the debug_logging table, tagged with
+        the current run. The same handler is returned on every call; keyword arguments (see SQLHandler)
+        only apply when it is first created. For example:
+            logging.getLogger().addHandler(e.get_logger(level=logging.INFO))
+        """
+        if self.log_handler is None:
+            if isinstance(self.db_lock, NullLock):
+                # the handler writes from its own thread; safe to swap here, as no other thread is running yet
+                self.locking = "threading"
+                self.db_lock = LOCKING_STRATEGIES["threading"]()
+            self.log_handler = SQLHandler(self, **kwargs)
+        return self.log_handler
 
     def _start(self, run_config={}, test_run=False):
         """Create a new run entry in the runs table."""
-        self.execute("INSERT INTO runs(start_time,clean_exit, ntp_clock_offset, uname, json, test_run) VALUES (?, ?, ?, ?, ?, ?)",
+        self._execute("INSERT INTO runs(start_time,clean_exit, ntp_clock_offset, uname, json, test_run) VALUES (?, ?, ?, ?, ?, ?)",
                            (self.real_time(),
                            0,
                            self.time_offset,
@@ -309,18 +693,21 @@ class ExperimentLog(object):
         logger.debug("Run config logged as '%s'" % pretty_json(run_config))
         self.commit()
         self.in_run = True
-        # self.logger = SQLLogger()
-        # self.logger.db = self
 
     def end(self):
         """Update the run entry to mark this as a clean exit and reflect the end time."""
+        # all queued records must be written before the run can be marked clean
+        self.flush()
         with self.db_lock:
             logger.debug("Marking end of run [%08d]." % self.run_id)
-            self.execute("UPDATE runs SET end_time=?, clean_exit=? WHERE id=?",
+            self._execute("UPDATE runs SET end_time=?, clean_exit=? WHERE id=?",
                                (self.real_time(),
                                1,
                                self.run_id))
             self.in_run = False
+        # outside the lock, which a background index build may be waiting for
+        if self.index_manager is not None:
+            self.index_manager.end()
 
     def sync_ext(self, fname, start_time=None, duration=None, media_start_time=0, time_rate=1.0, description=None, data={}):
         """Synchronise an external file (e.g. a video or audio recording) with the main log file.
@@ -331,55 +718,227 @@ class ExperimentLog(object):
             start_time = self.real_time()
         with self.db_lock:
             logger.debug("Syncing %s to %f:%s (%s) " % (fname, start_time, description))
-            self.execute("INSERT INTO sync_ext(fname, start_time, duration, media_start_time, time_rate, description, json) VALUES  (?,?,?,?,?,?)",
+            self._execute("INSERT INTO sync_ext(fname, start_time, duration, media_start_time, time_rate, description, json) VALUES  (?,?,?,?,?,?)",
                 (fname, start_time, duration,  media_start_time, time_rate, description, json.dumps(data)))
 
-    def add_indices(self):
-        """Add indices to the log"""
+    def add_indices(self, indices=INDICES):
+        """Add the indices used by the extract functions to the log (and the current shard), now.
+        Indices that already exist are left alone.
+
+        Returns:
+            list of indices.BuiltIndex, for the indices that were created
+        """
         with self.db_lock:
-            self.execute("CREATE INDEX log_session_ix ON log(session)")
-            self.execute("CREATE INDEX log_tag_ix ON log(tag)")
-            self.execute("CREATE INDEX log_stream_ix ON log(stream)")
-            self.execute("CREATE INDEX log_valid_ix ON log(valid)")
+            self.conn.commit()
+            built = build_indices(self.cursor, "main", indices)
+            if self.data_schema != "main":
+                built += build_indices(self.cursor, self.data_schema, indices, data_only=True)
+            return built
 
     def close(self):
-        # auto end the run
-        with self.db_lock:
+        # if the background writer lost records, the run is left marked unclean
+        # and the error is raised once the log has been closed
+        writer_error = None
+        try:
+            # auto end the run
             self.end()
+        except Exception as e:
+            writer_error = e
+        if self.writer is not None:
+            try:
+                self.writer.stop()
+            except Exception as e:
+                writer_error = writer_error or e
+            self.writer = None
+        if self.log_handler is not None:
+            self.log_handler.close()
+        self.commit_policy.detach()
+        with self.db_lock:
+            if self.shard_policy is not None:
+                self.shard_policy.close()
             self.commit()
+            if self.checkpoint_scheduler is not None:
+                self.checkpoint_scheduler.stop()
             logger.debug("Database closed.")
             self.opened = False
+        if writer_error is not None:
+            raise writer_error
+
+    def wal_stats(self):
+        """Return the WAL size and checkpoint statistics (see CheckpointScheduler.stats()),
+        or None if the log is not in WAL mode"""
+        if self.checkpoint_scheduler is None:
+            return None
+        return self.checkpoint_scheduler.stats()
 
     def commit(self):
         """Force all changes to be stored to the database."""
         with self.db_lock:
             logger.debug("<Commit>")
             self.conn.commit()
+            self.commit_policy.committed()
+            if self.shard_policy is not None:
+                self.shard_policy.check()
+
+    def flush(self):
+        """Wait until all records queued by log() and the logging handler have been written, then commit.
+        Does nothing unless async_writes is enabled or get_logger() has been called."""
+        if self.log_handler is not None:
+            self.log_handler.flush()
+        if self.writer is not None:
+            self.writer.flush()
+        if self.log_handler is not None or self.writer is not None:
+            self.commit()
+
 
+    def create(self, mtype, name, stype="", description="", data=None, force_update=False, schema=None, codec=None):
+        """Register a new metadata object.
 
-    def create(self, mtype, name, stype="", description="", data=None, force_update=False):
-        """Register a new metadata object."""
+        For streams, schema can declare the fields of each sample as a dictionary of
+        name -> type (int, float or str, or "int", "float", "text"). Those fields are then stored
+        in real INTEGER/REAL/TEXT columns of a per-stream table instead of as JSON text; any
+        other fields in a sample are still stored as JSON in the log table.
+
+        Streams can also be given a codec ("zlib", "lzma", "zlib-dict" or a Codec) to compress their
+        samples with, overriding the codec of the log.
+        """
         with self.db_lock:
             id = self.find_metatable(mtype, name)
             if id is None:
                 logger.debug("Registering '%s' of type '%s', with data [%s]" % (name, mtype, json.dumps(data)))
-                self.execute("INSERT INTO meta(name,type,description,json,mtype) VALUES (?,?,?,?,?)", (name, stype, description, json.dumps(data), mtype))
+                self._execute("INSERT INTO meta(name,type,description,json,mtype) VALUES (?,?,?,?,?)", (name, stype, description, json.dumps(data), mtype))
                 id = self.cursor.lastrowid
             else:
+                id = id[0]
                 if not force_update:
                     raise ExperimentException("%s:%s already exists; not updating" % (mtype,name))
                 else:
                     logger.warn("%s:%s exists; force updating" % (mtype,name))
-                    self.execute("UPDATE meta SET name=?,type=?,description=?,json=? where meta.id=%d"%id[0], (name, stype, description, json.dumps(data), ))
+                    self._execute("UPDATE meta SET name=?,type=?,description=?,json=? where meta.id=%d"%id, (name, stype, description, json.dumps(data), ))
 
             if mtype=="STREAM":
                 self.stream_cache[name] = id
-                self.execute("CREATE VIEW IF NOT EXISTS %s AS SELECT * FROM log WHERE stream=%d" % (name, id))
+                if schema is not None:
+                    self._create_typed_stream(id, name, schema)
+                else:
+                    self._execute("CREATE VIEW IF NOT EXISTS %s AS SELECT * FROM log WHERE stream=%d" % (name, id))
+                if codec is not None:
+                    codec = Codec.from_option(codec)
+                    self._execute("INSERT OR REPLACE INTO stream_codec(stream, json) VALUES (?, ?)", (id, json.dumps(codec.params())))
+                    self.stream_codecs[id] = codec
+
+    def _load_stream_codecs(self):
+        """Read the per-stream codecs from the database, along with any dictionaries already trained for them"""
+        codecs = {}
+        for stream_id, js in self._execute("SELECT stream, json FROM stream_codec").fetchall():
+            codecs[stream_id] = Codec(**json.loads(js))
+        for dictionary_id, stream_id, dictionary in self._execute("SELECT id, stream, dictionary FROM codec_dictionary ORDER BY id").fetchall():
+            codec = self._stream_codec(stream_id, codecs)
+            if codec is not None and codec.method == "zlib-dict":
+                codec.set_dictionary(dictionary_id, bytes(dictionary))
+        return codecs
+
+    def _stream_codec(self, stream_id, codecs=None):
+        """The codec of a stream, or None if its samples are stored uncompressed"""
+        if codecs is None:
+            codecs = self.stream_codecs
+        codec = codecs.get(stream_id)
+        if codec is None and self.default_codec is not None:
+            codec = codecs[stream_id] = self.default_codec.copy()
+        return codec
+
+    def _encode_json(self, codec, stream_id, js):
+        """Compress a JSON payload with the stream's codec, storing a trained dictionary once it is ready"""
+        if codec.wants_dictionary():
+            dictionary = codec.train()
+            self._execute("INSERT INTO codec_dictionary(stream, dictionary, created) VALUES (?, ?, ?)",
+                          (stream_id, dictionary, self.real_time()))
+            codec.set_dictionary(self.cursor.lastrowid, dictionary)
+            logger.debug("Trained a %d byte codec dictionary for stream %d" % (len(dictionary), stream_id))
+        return codec.encode_json(js)
+
+    def _insert_binary(self, codec, buf):
+        """Write a binary entry, compressed if the stream's codec asks for it, returning its id"""
+        codec_id = None
+        if codec is not None:
+            buf, codec_id = codec.encode_binary(buf)
+        self._execute(self.data_statements.binary, (buf,))
+        binary_id = self.cursor.lastrowid
+        if codec_id is not None:
+            self._execute(self.data_statements.binary_codec, (binary_id, codec_id))
+        return binary_id
+
+    def _create_typed_stream(self, stream_id, name, schema):
+        """Create the typed column table for a stream, and a view joining it to the log"""
+        if stream_id in self.typed_streams:
+            raise ExperimentException("Stream %s already has a schema; it cannot be changed" % name)
+        columns = []
+        for column, ctype in six.iteritems(schema):
+            sql_type = SCHEMA_TYPES.get(ctype.lower() if isinstance(ctype, six.string_types) else ctype)
+            if sql_type is None:
+                raise ExperimentException("Unsupported type %s for column %s of stream %s" % (ctype, column, name))
+            columns.append((column, sql_type))
+
+        table = typed_table_name(stream_id)
+        logger.debug("Creating typed table %s for stream %s: %s" % (table, name, columns))
+        self._execute(typed_table_sql("main", stream_id, columns))
+        if self.data_schema != "main":
+            self._execute(typed_table_sql(self.data_schema, stream_id, columns))
+        self.cursor.executemany("INSERT INTO stream_schema(stream, name, type) VALUES (?,?,?)",
+                                [(stream_id, c, t) for c, t in columns])
+
+        # the stream view shows the typed columns alongside the log entries
+        self._execute("DROP VIEW IF EXISTS %s" % name)
+        self._execute("CREATE VIEW %s AS SELECT log.*, %s FROM log LEFT JOIN %s ON %s.id=log.id WHERE log.stream=%d" %
+                     (name, ", ".join("%s.%s" % (table, quote_identifier(c)) for c, _ in columns), table, table, stream_id))
+        self.typed_streams[stream_id] = self._typed_stream(stream_id, [c for c, _ in columns])
+
+    def _create_typed_tables(self, schema):
+        """Create the typed column table of every stream with a schema in the given (attached) schema"""
+        columns = collections.defaultdict(list)
+        for stream_id, column, sql_type in self._execute("SELECT stream, name, type FROM main.stream_schema ORDER BY id").fetchall():
+            columns[stream_id].append((column, sql_type))
+        for stream_id, cols in six.iteritems(columns):
+            self._execute(typed_table_sql(schema, stream_id, cols))
+
+    def _typed_stream(self, stream_id, columns):
+        table = typed_table_name(stream_id)
+        insert = "INSERT INTO %s.%s(id, %s) VALUES (?, %s)" % (self.data_schema, table, ", ".join(quote_identifier(c) for c in columns),
+                                                               ", ".join("?" * len(columns)))
+        return TypedStream(table, columns, frozenset(columns), insert)
+
+    def set_data_schema(self, schema):
+        """Direct the sample data writes to the tables of the given (attached) schema; used by ShardPolicy.
+        The caller must hold db_lock."""
+        self.data_schema = schema
+        self.data_statements = data_statements(schema)
+        self.typed_streams = self._load_typed_streams()
+        if self.index_manager is not None:
+            self.index_manager.data_schema_changed()
+
+    def _load_typed_streams(self):
+        """Read the declared stream schemas from the database"""
+        columns = collections.defaultdict(list)
+        for stream_id, column in self._execute("SELECT stream, name FROM stream_schema ORDER BY id").fetchall():
+            columns[stream_id].append(column)
+        return {stream_id: self._typed_stream(stream_id, cols) for stream_id, cols in six.iteritems(columns)}
+
+    def _split_typed(self, typed, data):
+        """Split a sample into the values for the typed columns, and the JSON for any remaining fields"""
+        if data is None:
+            return [None] * len(typed.columns), None
+        if not isinstance(data, dict):
+            return [None] * len(typed.columns), json.dumps(data)
+        values = [data.get(column) for column in typed.columns]
+        extra = {k: v for k, v in six.iteritems(data) if k not in typed.column_set}
+        return values, (json.dumps(extra) if extra else None)
 
     @property
     def bindings(self):
+        """The meta entries bound to the current session, either directly or through one of its parents"""
         with self.db_lock:
-            bound = self.execute("SELECT mtype, name, type, description, meta.json FROM meta JOIN meta_session on meta_session.meta=meta.id WHERE meta_session.session=?", (self.session_id,)).fetchall()
+            ids = resolve_bindings(self.cursor, self.session_id)
+            bound = [self._execute("SELECT mtype, name, type, description, json FROM meta WHERE id=?", (id,)).fetchone() for id in ids]
             return set([MetaTuple(*meta) for meta in bound])
 
 
@@ -429,59 +988,59 @@ class ExperimentLog(object):
                 raise ExperimentException("No run started; cannot start session")
 
             # find the parent details
-            parent_id = self.session_id
-            path = self.session_path
+            parent = self.session_stack[-1]
+            parent_id = parent.id
+            path = parent.path
             logger.debug("Parent session %s" % path)
 
             # find the prototype ID
             if name is None:
-                # this is a counted repetition; increment the counter
-                result = self.execute("SELECT subcount FROM session WHERE id=?", (self.session_id,))
-                sub_id = result.fetchone()[0]
-                self.execute("UPDATE session SET subcount=? WHERE id=?", (sub_id + 1,self.session_id))
-                name = str(sub_id)
+                # this is a counted repetition; increment the counter in the database, not from the cached
+                # count, as other writers (multi_writer) may have entered the same parent. The update takes
+                # the write lock and returns the new count in the same statement.
+                subcount = self._execute("UPDATE session SET subcount=coalesce(subcount, 0)+1 WHERE id=? RETURNING subcount",
+                                         (parent_id,)).fetchone()[0]
+                self.session_stack[-1] = parent._replace(subcount=subcount)
+                name = str(subcount - 1)
 
             new_path = path+str(name)+"/"
             logger.debug("Entering session '%s'" % new_path )
 
             # log this path
-            path_id = self.execute("SELECT id FROM path WHERE name=?", (new_path,)).fetchone()
-            if path_id is None:
-                self.execute("INSERT INTO meta(name,mtype) VALUES (?, 'PATH')", (new_path,))
+            if new_path not in self.path_cache:
+                path_id = self._execute("SELECT id FROM path WHERE name=?", (new_path,)).fetchone()
+                if path_id is None:
+                    self._execute("INSERT INTO meta(name,mtype) VALUES (?, 'PATH')", (new_path,))
+                self.path_cache.add(new_path)
 
             # 64 bit random seed
             seed = int(self.real_time() * 1000 * self.session_id) & ((1<<64)-1)
 
-            self.execute("INSERT INTO session(name, start_time,  test_run, json, description, parent, path, complete, subcount, random_seed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            self._execute("INSERT INTO session(name, start_time,  test_run, json, description, parent, path, complete, subcount, random_seed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                                (name,
                                t,
                                test_run,
                                json.dumps(data),
                                description,
-                               self.session_id, new_path, False, 0, seed))
+                               parent_id, new_path, False, 0, seed))
 
-            self.session_id = self.cursor.lastrowid
+            self.session_stack.append(SessionFrame(self.cursor.lastrowid, new_path, parent_id, 0))
 
             # map the session<->run table
-            self.execute("INSERT INTO run_session(session, run) VALUES (?,?)", (self.session_id, self.run_id))
+            self._execute("INSERT INTO run_session(session, run) VALUES (?,?)", (self.session_id, self.run_id))
 
             # bind a passed session, if we got one
             if session is not None:
                 id = self.find_metatable("SESSION", session)
                 if id is not None:
-                    self.execute("INSERT INTO meta_session(meta,session,time) VALUES (?,?,?)", (id[0], self.session_id, self.real_time()))
+                    self._execute("INSERT INTO meta_session(meta,session,time) VALUES (?,?,?)", (id[0], self.session_id, self.real_time()))
                 else:
                     logger.warn("Tried to bind to a session prototype (%s) that doesn't exist")
 
-            # apply all parent bindings to this new session
-            bindings = self.execute("SELECT meta, json FROM meta_session WHERE session=?", (parent_id,)).fetchall()
-            if bindings is not None:
-                for meta, js in bindings:
-                    self.execute("INSERT INTO meta_session(meta,json,session,time) VALUES (?,?,?,?)", (meta, js, self.session_id, self.real_time()))
-
+            # parent bindings are not copied; they are resolved through the session's ancestors
 
             logger.debug("New session ID [%08d]" % self.session_id)
-            self.commit()
+            self.commit_policy.barrier()
 
     def last_session(self, include_completed=False):
         """Return the ID of the last incomplete session in the database. If include_completed is True, returns
@@ -491,9 +1050,9 @@ class ExperimentLog(object):
         """
         with self.db_lock:
             if include_completed:
-                result = self.execute("SELECT id FROM session WHERE start_time=(SELECT max(start_time) FROM session)").fetchone()
+                result = self._execute("SELECT id FROM session WHERE start_time=(SELECT max(start_time) FROM session)").fetchone()
             else:
-                result = self.execute("SELECT id FROM session WHERE start_time=(SELECT max(start_time) FROM session) AND complete=0").fetchone()
+                result = self._execute("SELECT id FROM session WHERE start_time=(SELECT max(start_time) FROM session) AND complete=0").fetchone()
             if result==None:
                 return None
             else:
@@ -502,23 +1061,30 @@ class ExperimentLog(object):
 
     def find_metatable(self, mtype, name):
         with self.db_lock:
-            return self.execute("SELECT id FROM meta WHERE name=? AND mtype=?", (name,mtype)).fetchone()
+            return self._execute("SELECT id FROM meta WHERE name=? AND mtype=?", (name,mtype)).fetchone()
 
     def bind(self, mtype, name, data={}):
         with self.db_lock:
             id = self.find_metatable(mtype, name)
             if id is not None:
-                self.execute("INSERT INTO meta_session(meta, session, time, json) VALUES (?,?,?,?)", (id[0], self.session_id, self.real_time(), json.dumps(data)))
+                self._execute("INSERT INTO meta_session(meta, session, time, json) VALUES (?,?,?,?)", (id[0], self.session_id, self.real_time(), json.dumps(data)))
                 logger.debug("Binding meta table %s:%s to %s" % (mtype, name, self.session_path))
+                self.commit_policy.barrier()
             else:
                 logger.warn("Tried to bind non-existent meta table %s:%s" % (mtype, name))
 
     def unbind(self, mtype, name):
+        """Unbind a meta entry from the current session and its descendants, whether it was bound
+        here or inherited from a parent session"""
         with self.db_lock:
             id = self.find_metatable(mtype, name)
             if id is not None:
-                self.execute("UPDATE meta_session SET unbound_session=session, session=NULL WHERE (meta=? AND session=?)", (id[0],self.session_id))
+                self._execute("UPDATE meta_session SET unbound_session=session, session=NULL WHERE (meta=? AND session=?)", (id[0],self.session_id))
+                if id[0] in resolve_bindings(self.cursor, self.session_id):
+                    # inherited from a parent; record an unbinding to hide it here
+                    self._execute("INSERT INTO meta_session(meta, unbound_session, time) VALUES (?,?,?)", (id[0], self.session_id, self.real_time()))
                 logger.debug("Unbinding meta table %s:%s from %s" % (mtype, name, self.session_path))
+                self.commit_policy.barrier()
             else:
                 logger.warn("Tried to unbind non-existent meta table %s:%s" % (mtype, name))
 
@@ -528,23 +1094,64 @@ class ExperimentLog(object):
         with self.db_lock:
             logger.debug("Leaving session '%s'" % self.session_path)
             t = self.real_time()
-            parent_id = self.execute("SELECT parent FROM session WHERE id=?", (self.session_id,)).fetchone()[0]
-            if parent_id is None:
+            if self.session_stack[-1].parent is None:
                 logger.warn("Tried to leave the root session.")
             else:
-                self.execute("UPDATE session SET end_time=?,  valid=?, complete=? WHERE id=?",
+                self._execute("UPDATE session SET end_time=?,  valid=?, complete=? WHERE id=?",
                                (t,
                                valid,
                                complete,
                                self.session_id))
-                self.session_id = parent_id
-            # force a commit
-            self.commit()
+                self.session_stack.pop()
+            self.commit_policy.barrier()
 
 
     def execute(self, query, parameters=()):
         with self.db_lock:
-            return self.cursor.execute(query, parameters)
+            return self._execute(query, parameters)
+
+    def _execute(self, query, parameters=()):
+        """Execute a statement; the caller must already hold db_lock."""
+        if self.multi_writer:
+            return self._retry(self.cursor.execute, query, parameters)
+        return self.cursor.execute(query, parameters)
+
+    def _retry(self, fn, *args):
+        """Call fn(*args), retrying with jittered exponential backoff while another process holds the database lock.
+        Only statements which start a new transaction are retried; the lock is always taken at BEGIN."""
+        delay = 0.002
+        for attempt in itertools.count():
+            try:
+                return fn(*args)
+            except sqlite3.OperationalError as e:
+                locked = "locked" in str(e) or "busy" in str(e)
+                if not locked or self.conn.in_transaction or attempt >= self.max_retries:
+                    raise
+                logger.debug("Database locked; retrying in %.1fms (attempt %d)" % (delay * 1000, attempt + 1))
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, 0.5)
+
+    def _stream_id(self, stream):
+        """Return the ID of the named stream, creating a blank stream entry if it has not been registered."""
+        # check if we already know what kind of stream this is; otherwise,
+        # look it up from the DB and cache it for later use
+        if stream in self.stream_cache:
+            return self.stream_cache[stream]
+
+        stream_id = self._execute("SELECT id FROM stream WHERE stream.name=?", (stream,)).fetchone()
+        # if there is no such stream ID, create a new one and use that
+        if stream_id is None:
+            logger.warn("No stream %s registered; creating a new blank entry" % stream)
+            # the existence check is part of the insert, which runs in the write transaction, so that when
+            # several writers (multi_writer) create the same stream at once, only one entry is made
+            self._execute("INSERT INTO meta(name,type,description,json,mtype) SELECT ?, 'AUTO', '', ?, 'STREAM' "
+                          "WHERE NOT EXISTS (SELECT 1 FROM meta WHERE name=? AND mtype='STREAM')",
+                          (stream, json.dumps(None), stream))
+            stream_id = self._execute("SELECT id FROM stream WHERE stream.name=?", (stream,)).fetchone()
+            self._execute("CREATE VIEW IF NOT EXISTS %s AS SELECT * FROM log WHERE stream=%d" % (stream, stream_id[0]))
+        stream_id = stream_id[0]
+        self.stream_cache[stream] = stream_id
+        return stream_id
 
     def log(self, stream, t=None, valid=True, data=None, tag="", binary=None):
         """Log the given data in the currently active session
@@ -556,51 +1163,238 @@ class ExperimentLog(object):
             data: Dictionary of data entries to be written to the log.
 
         Returns:
-            id: The id of this log entry (e.g. if you want to store additional table in another table)
+            id: The id of this log entry (e.g. if you want to store additional table in another table).
+                None if async_writes is enabled, as the entry has not been written yet.
             """
         t = t or self.real_time()
-        with self.db_lock:
+        if self.writer is not None:
             if not self.in_run:
                 raise ExperimentException("No run active; cannot log data")
+            self.writer.put(self.session_id, (stream, t, data, tag, valid, binary))
+            return None
 
-
-            # check if we already know what kind of stream this is; otherwise,
-            # look it up from the DB and cache it for later use
-            if stream in self.stream_cache:
-                stream_id = self.stream_cache[stream]
-            else:
-                stream_id = self.execute("SELECT id FROM stream WHERE stream.name=?", (stream,)).fetchone()
-                # if there is no such stream ID, create a new one and use that
-                if stream_id is None:
-                    logger.warn("No stream %s registered; creating a new blank entry" % stream)
-                    self.create("STREAM", stream, stype="AUTO")
-                    stream_id = self.execute("SELECT id FROM stream WHERE stream.name=?", (stream,)).fetchone()
-                stream_id = stream_id[0]
-                self.stream_cache[stream] = stream_id
+        with self.db_lock:
+            if not self.in_run:
+                raise ExperimentException("No run active; cannot log data")
 
             # attach binaries if needed
             if binary is not None:
-                self.execute("INSERT INTO binary(binary) VALUES (?)", (binary,))
-                binary_id = self.cursor.lastrowid
+                binary_id = self._insert_binary(self._stream_codec(self._stream_id(stream)), binary)
             else:
                 binary_id = None
 
-            self.execute("INSERT INTO log(session, valid, time, stream, tag, json, binary) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                               (self.session_id,
-                               valid, t, stream_id, tag,
-                               json.dumps(data), binary_id))
+            id = self._insert_row(stream, t, valid, data, tag, binary_id)
+
+            # deal with autocommits to the log
+            self.commit_policy.wrote()
+
+            return id
+
+    def log_array(self, stream, arr, t=None, valid=True, data=None, tag=""):
+        """Log a NumPy array in the currently active session. The array's raw buffer is written
+        directly to the binary table (no intermediate copy for contiguous arrays), with its dtype and shape
+        recorded in the binary_array table. Use extract.load_array() to read it back.
+
+        Parameters are as for log(); the array cannot contain Python objects.
+
+        Returns:
+            id: The id of this log entry
+        """
+        t = t or self.real_time()
+        arr = np.asarray(arr)
+        self._flush_writer()
+        with self.db_lock:
+            if not self.in_run:
+                raise ExperimentException("No run active; cannot log data")
+            binary_id = self._insert_array(stream, arr)
+            id = self._insert_row(stream, t, valid, data, tag, binary_id)
+            self.commit_policy.wrote()
+            return id
+
+    def log_chunk(self, stream, samples, t=None, rate=None, timestamps=None, valid=True, data=None, tag=""):
+        """Log a block of samples from a high-rate stream as a single log entry.
 
-            id = self.cursor.lastrowid
+        Parameters:
+            stream: stream to write to
+            samples: array of samples, with samples along the first axis (e.g. N x channels)
+            t: Time of the first sample. If None, the block is assumed to end now.
+            rate: Sample rate in Hz; sample i is at time t + i/rate
+            timestamps: Alternatively, a vector of N per-sample timestamps
+            valid, data, tag: as for log()
 
-             # deal with autocommits to the log
-            now = self.real_time()
-            if self.autocommit is not None and now - self.last_commit_time > self.autocommit:
-                logger.debug("Time-based autocommit")
-                self.last_commit_time = now
-                self.commit()
+        Use extract.chunked_stream() to read the blocks of a stream back as one contiguous array per session.
 
+        Returns:
+            id: The id of this log entry
+        """
+        samples = np.asarray(samples)
+        n = samples.shape[0] if samples.ndim > 0 else 1
+        if timestamps is not None:
+            timestamps = np.asarray(timestamps, dtype=np.float64)
+            if timestamps.shape != (n,):
+                raise ExperimentException("Expected %d timestamps, got shape %s" % (n, timestamps.shape))
+            if n > 0:
+                t = timestamps[0]
+        elif rate is None:
+            raise ExperimentException("log_chunk() needs either a sample rate or per-sample timestamps")
+        if t is None:
+            t = self.real_time() - (n - 1) / float(rate or 1)
+
+        self._flush_writer()
+        with self.db_lock:
+            if not self.in_run:
+                raise ExperimentException("No run active; cannot log data")
+            binary_id = self._insert_array(stream, samples)
+            id = self._insert_row(stream, float(t), valid, data, tag, binary_id)
+            timestamps_id = self._insert_array(stream, timestamps) if timestamps is not None else None
+            self._execute(self.data_statements.chunk, (id, n, rate, timestamps_id))
+            self.commit_policy.wrote()
             return id
 
+    def _flush_writer(self):
+        """Write the records queued by log() (with async_writes) before a write which bypasses the queue,
+        so that entries keep the order they were logged in. Must not be called with db_lock held, which
+        the writer thread needs."""
+        if self.writer is not None:
+            self.writer.flush()
+
+    def _insert_array(self, stream, arr):
+        """Write an array's raw buffer to the binary table, returning the binary id."""
+        if arr.dtype.hasobject:
+            raise ExperimentException("Cannot log arrays of Python objects; use np_to_str() and log(binary=...)")
+        dtype, shape, fortran = array_header(arr)
+        # a contiguous array is flattened as a view; anything else is copied once here
+        buf = arr.ravel(order='F' if fortran else 'C')
+        binary_id = self._insert_binary(self._stream_codec(self._stream_id(stream)), buf)
+        self._execute(self.data_statements.binary_array, (binary_id, dtype, shape, fortran))
+        return binary_id
+
+    def _insert_row(self, stream, t, valid, data, tag, binary_id):
+        """Insert a single log entry (and its typed columns), returning its id."""
+        stream_id = self._stream_id(stream)
+        typed = self.typed_streams.get(stream_id)
+        if typed is None:
+            js = json.dumps(data)
+        else:
+            values, js = self._split_typed(typed, data)
+        codec = self._stream_codec(stream_id)
+        if codec is not None:
+            js = self._encode_json(codec, stream_id, js)
+
+        self._execute(self.data_statements.log,
+                           (self.session_id,
+                           valid, t, stream_id, tag,
+                           js, binary_id))
+
+        id = self.cursor.lastrowid
+        if typed is not None:
+            self._execute(typed.insert, [id] + values)
+        return id
+
+    def log_many(self, records, chunk_size=10000):
+        """Log a batch of samples in the currently active session, using one bulk insert per chunk
+        instead of one statement per sample.
+        Parameters:
+            records: sequence or iterable (e.g. a generator) of (stream, t, data, tag, valid, binary) tuples.
+                     Trailing fields can be omitted, and default as in log(). Records with no timestamp
+                     are stamped with the time their chunk is written.
+            chunk_size: number of records written per bulk insert; iterables are consumed one chunk at a time
+
+        Returns:
+            (first_id, last_id): The (inclusive) range of ids assigned to the log entries, in the order
+                                 the records were given, or None if there were no records
+        """
+        records = iter(records)
+        first_id, last_id = None, None
+        self._flush_writer()
+        with self.db_lock:
+            if not self.in_run:
+                raise ExperimentException("No run active; cannot log data")
+
+            while True:
+                chunk = list(itertools.islice(records, chunk_size))
+                if not chunk:
+                    break
+                if self.multi_writer:
+                    chunk_first, last_id = self._retry(self._insert_many, chunk)
+                else:
+                    chunk_first, last_id = self._insert_many(chunk)
+                if first_id is None:
+                    first_id = chunk_first
+                self.commit_policy.wrote(len(chunk))
+
+        if first_id is None:
+            return None
+        return first_id, last_id
+
+    def _insert_many(self, records, session_id=None):
+        """Insert a list of log records with executemany(), returning the (first, last) log ids assigned.
+        Records are logged in the current session, unless session_id is given."""
+        t_now = self.real_time()
+        if session_id is None:
+            session_id = self.session_id
+        stream_cache = self.stream_cache
+        typed_streams = self.typed_streams
+        dumps = json.dumps
+        compressed = self.default_codec is not None or len(self.stream_codecs) > 0
+
+        rows = []
+        binaries = []
+        # (binary index, codec id) for compressed binary entries
+        binary_codecs = []
+        # (row index, typed stream, values) for samples of streams with a schema
+        typed_rows = []
+        for record in records:
+            stream, t, data, tag, valid, binary = tuple(record) + _RECORD_DEFAULTS[len(record):]
+            stream_id = stream_cache.get(stream)
+            if stream_id is None:
+                stream_id = self._stream_id(stream)
+            codec = self._stream_codec(stream_id) if compressed else None
+            if binary is not None:
+                if codec is not None:
+                    binary, codec_id = codec.encode_binary(binary)
+                    if codec_id is not None:
+                        binary_codecs.append((len(binaries) + 1, codec_id))
+                binaries.append((binary,))
+                # placeholder; replaced with the real binary id once the blobs are inserted
+                binary = len(binaries)
+            typed = typed_streams.get(stream_id)
+            if typed is None:
+                js = dumps(data)
+            else:
+                values, js = self._split_typed(typed, data)
+                typed_rows.append((len(rows), typed, values))
+            if codec is not None:
+                js = self._encode_json(codec, stream_id, js)
+            rows.append([session_id, valid, t or t_now, stream_id, tag, js, binary])
+
+        if binaries:
+            self.cursor.executemany(self.data_statements.binary, binaries)
+            # rows inserted in a single statement within one transaction get consecutive ids
+            binary_offset = self._last_insert_rowid() - len(binaries)
+            for row in rows:
+                if row[6] is not None:
+                    row[6] += binary_offset
+            if binary_codecs:
+                self.cursor.executemany(self.data_statements.binary_codec,
+                                        [(index + binary_offset, codec_id) for index, codec_id in binary_codecs])
+
+        self.cursor.executemany(self.data_statements.log, rows)
+        last_id = self._last_insert_rowid()
+        first_id = last_id - len(rows) + 1
+
+        if typed_rows:
+            by_stream = collections.defaultdict(list)
+            for index, typed, values in typed_rows:
+                by_stream[typed.insert].append([first_id + index] + values)
+            for insert, values in six.iteritems(by_stream):
+                self.cursor.executemany(insert, values)
+
+        return first_id, last_id
+
+    def _last_insert_rowid(self):
+        return self.cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+
 
 if __name__=="__main__":
     from sqlexperiment import pseudo
@@ -1,17 +1,192 @@
 import json
 import logging
 import os
-from collections import defaultdict
+import re
+import sqlite3
+from collections import defaultdict, namedtuple, OrderedDict, deque
 import pandas as pd
 import base64
+import itertools
 import six
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from six.moves.urllib.parse import quote
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from .core import typed_table_name, quote_identifier, buffer_to_np
+from .shard import shard_path
+from .codec import Decoder
+from .indices import explain, table_names
+from .frames import parse_json, samples_frame
+
+def open_reader(fname, busy_timeout=5.0, shards=True):
+    """Open a read-only connection to a log database, for use with the functions in this module.
+    If the log was opened with wal=True, readers can query while logging continues.
+    If the log is sharded, all of its shards are attached (see attach_shards()), unless shards is False;
+    use fan_out() for logs with more shards than SQLite can attach at once."""
+    # the path is quoted, so that characters such as ?, # and % are not read as part of the URI
+    uri = "file:%s?mode=ro" % quote(os.path.abspath(fname))
+    conn = sqlite3.connect(uri, uri=True, timeout=busy_timeout, check_same_thread=False)
+    conn.execute("PRAGMA busy_timeout=%d" % int(busy_timeout * 1000))
+    if shards:
+        cursor = conn.cursor()
+        files = shard_files(cursor)
+        if files:
+            attach_shards(cursor, files)
+    return conn
+
+
+def shard_files(cursor):
+    """Return the shards of a sharded log as a list of (shard id, path); empty if the log is not sharded"""
+    if not _has_table(cursor, "shards"):
+        return []
+    main = [row[2] for row in cursor.execute("PRAGMA database_list").fetchall() if row[1] == "main"][0]
+    return [(id, shard_path(main, fname)) for id, fname in cursor.execute("SELECT id, fname FROM shards ORDER BY id").fetchall()]
+
+
+def _attach_limit(conn):
+    """Number of databases which can be attached to a connection"""
+    if hasattr(conn, "getlimit"):
+        return conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    return 10
+
+
+def attach_shards(cursor, shards, include_main=True):
+    """Attach shards [(shard id, path), ...] to a connection, and create TEMP views with the names of the
+    sample data tables (log, binary, binary_array, chunk and log_<stream>) and of the stream views, over the
+    union of the attached shards (and the main database's own tables, if include_main is True).
+    The other functions in this module then see the samples in every attached shard."""
+    if len(shards) > _attach_limit(cursor.connection):
+        raise ValueError("Cannot attach %d shards to one connection (the limit is %d); use fan_out()" % (
+            len(shards), _attach_limit(cursor.connection)))
+    schemas = ["main"] if include_main else []
+    for id, path in shards:
+        schema = "shard_%d" % id
+        cursor.execute("ATTACH DATABASE ? AS %s" % schema, (path,))
+        schemas.append(schema)
+
+    tables = ["log", "binary", "binary_array", "chunk", "binary_codec"]
+    tables += [typed_table_name(stream_id) for stream_id, _ in stream_schemas(cursor).values()]
+    for table in tables:
+        parts = ["SELECT * FROM %s.%s" % (schema, table) for schema in schemas if _has_table(cursor, table, schema)]
+        cursor.execute("DROP VIEW IF EXISTS temp.%s" % table)
+        if parts:
+            cursor.execute("CREATE TEMP VIEW %s AS %s" % (table, " UNION ALL ".join(parts)))
+
+    # views stored in the main database only ever read its own tables; TEMP copies read the union views instead
+    for name, sql in cursor.execute("SELECT name, sql FROM main.sqlite_master WHERE type='view'").fetchall():
+        if re.search(r"\blog\b", sql):
+            cursor.execute("DROP VIEW IF EXISTS temp.%s" % quote_identifier(name))
+            cursor.execute(re.sub(r"^CREATE VIEW", "CREATE TEMP VIEW", sql, flags=re.IGNORECASE))
+
+
+def fan_out(fname, fn, *args, **kwargs):
+    """Call fn(cursor, *args, **kwargs) on groups of the shards of a log in parallel threads, and combine
+    the results: DataFrames are concatenated, dictionaries merged (recursively, joining lists and DataFrames) and lists joined;
+    anything else is returned as a list with one result per group. Samples stored in the main database
+    (before the log was sharded) are included in the first group.
+
+    Keyword parameters (removed from kwargs):
+        threads: number of threads (default 4)
+        group_size: number of shards attached per call (default: shared evenly between the threads)
+    """
+    threads = kwargs.pop("threads", 4)
+    group_size = kwargs.pop("group_size", None)
+    conn = open_reader(fname, shards=False)
+    shards = shard_files(conn.cursor())
+    limit = _attach_limit(conn)
+    conn.close()
+
+    if group_size is None:
+        group_size = max(1, -(-len(shards) // threads))
+    group_size = min(group_size, limit)
+    groups = [shards[i:i + group_size] for i in range(0, len(shards), group_size)] or [[]]
+
+    def run(i):
+        conn = open_reader(fname, shards=False)
+        try:
+            cursor = conn.cursor()
+            attach_shards(cursor, groups[i], include_main=(i == 0))
+            return fn(cursor, *args, **kwargs)
+        finally:
+            conn.close()
+
+    pool = ThreadPool(min(threads, len(groups)))
+    try:
+        results = pool.map(run, range(len(groups)))
+    finally:
+        pool.close()
+    return _combine(results)
+
+
+def _combine(results):
+    """Combine the results of the calls made by fan_out()"""
+    if isinstance(results[0], pd.DataFrame):
+        return _concat_frames(results)
+    if isinstance(results[0], dict):
+        combined = {}
+        for result in results:
+            _merge_into(combined, result)
+        return combined
+    if isinstance(results[0], list):
+        return list(itertools.chain.from_iterable(results))
+    return results
+
+
+def _concat_frames(frames):
+    # Categoricals with different categories would be concatenated as plain objects
+    categorical = [c for df in frames for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)]
+    df = pd.concat(frames, ignore_index=True)
+    for column in categorical:
+        df[column] = df[column].astype("category")
+    return df
+
+
+def _merge_into(target, source):
+    for key, value in six.iteritems(source):
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge_into(target[key], value)
+        elif isinstance(value, list) and isinstance(target.get(key), list):
+            target[key] = target[key] + value
+        elif isinstance(value, pd.DataFrame) and isinstance(target.get(key), pd.DataFrame):
+            target[key] = _concat_frames([target[key], value])
+        else:
+            target[key] = value
+
+
+# one record stored by the logging handler (ExperimentLog.get_logger())
+LogRecord = namedtuple('LogRecord', ['time', 'level', 'run', 'record'])
+
 
-def get_logs(cursor, run=None):
-    if run is None:
-        logs = cursor.execute("SELECT record FROM debug_logging").fetchall()
-    else:
-        logs = cursor.execute("SELECT record FROM debug_logging WHERE run=?", str(run)).fetchall()
-    return "\n".join([l[0] for l in logs])
+def get_logs(cursor, run=None, level=None, start=None, end=None, batch_size=1000):
+    """Iterate over the records stored by the logging handler, in time order, as LogRecord tuples.
+    Rows are fetched batch_size at a time, so the whole log is never held in memory.
+
+    Parameters:
+        run: only records from this run id
+        level: only records at or above this level (e.g. logging.WARNING)
+        start, end: only records with start <= time < end
+    """
+    conditions, parameters = [], []
+    for condition, value in [("run=?", run), ("level>=?", level), ("time>=?", start), ("time<?", end)]:
+        if value is not None:
+            conditions.append(condition)
+            parameters.append(value)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    # a separate cursor, so that the caller can keep using theirs while iterating
+    c = cursor.connection.cursor()
+    c.execute("SELECT time, level, run, record FROM debug_logging%s ORDER BY time, id" % where, parameters)
+    while True:
+        rows = c.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield LogRecord(*row)
 
 
 def dump_json(cursor, file):
@@ -79,6 +254,128 @@ def dump_json(cursor, file):
 
 
 
+def _has_table(cursor, name, schema="main"):
+    return cursor.execute("SELECT count(*) FROM %s.sqlite_master WHERE type='table' AND name=?" % schema, (name,)).fetchone()[0] > 0
+
+
+def stream_schemas(cursor):
+    """Return the streams which have a declared column schema, as a dictionary
+    stream name -> (stream id, [(column, SQL type), ...])"""
+    schemas = {}
+    if not _has_table(cursor, "stream_schema"):
+        return schemas
+    rows = cursor.execute("SELECT meta.id, meta.name, stream_schema.name, stream_schema.type FROM stream_schema JOIN meta ON meta.id=stream_schema.stream ORDER BY stream_schema.id").fetchall()
+    for stream_id, stream, column, ctype in rows:
+        schemas.setdefault(stream, (stream_id, []))[1].append((column, ctype))
+    return schemas
+
+
+def typed_stream_dataframe(cursor, stream):
+    """Return every sample of a stream with a declared schema as a DataFrame, read directly from
+    the typed columns without any JSON decoding.
+
+    The frame has id, session, path, t, valid and tag columns, followed by the schema columns.
+    """
+    stream_id, columns = stream_schemas(cursor)[stream]
+    table = typed_table_name(stream_id)
+    names = [c for c, _ in columns]
+    rows = cursor.execute("SELECT log.id, log.session, session.path, log.time, log.valid, log.tag, %s FROM log JOIN %s ON %s.id=log.id JOIN session ON session.id=log.session ORDER BY log.id" %
+                          (", ".join("%s.%s" % (table, quote_identifier(c)) for c in names), table, table)).fetchall()
+    df = pd.DataFrame.from_records(rows, columns=["id", "session", "path", "t", "valid", "tag"] + names)
+    for column, ctype in columns:
+        if ctype == "REAL":
+            df[column] = df[column].astype(float)
+        elif ctype == "INTEGER":
+            # nullable integers, as samples may omit fields
+            df[column] = df[column].astype("Int64")
+    return df
+
+
+def _binary_codec(cursor, alias):
+    """SQL for the codec of the binary entry `alias`, and the join it needs (always NULL in logs
+    written before compression was supported)"""
+    if _has_table(cursor, "binary_codec"):
+        return "%s_codec.codec" % alias, " LEFT JOIN binary_codec %s_codec ON %s_codec.id=%s.id" % (alias, alias, alias)
+    return "NULL", ""
+
+
+def load_array(cursor, binary_id):
+    """Return the array stored by ExperimentLog.log_array() in the given binary entry.
+    The array is a read-only view of the stored buffer."""
+    codec, join = _binary_codec(cursor, "binary")
+    row = cursor.execute("SELECT binary.binary, %s, binary_array.dtype, binary_array.shape, binary_array.fortran FROM binary JOIN binary_array ON binary_array.id=binary.id%s WHERE binary.id=?" % (codec, join), (binary_id,)).fetchone()
+    if row is None:
+        raise KeyError("No array stored in binary entry %s" % binary_id)
+    return buffer_to_np(Decoder(cursor).binary(row[0], row[1]), *row[2:])
+
+
+def stream_arrays(cursor, stream):
+    """Return all arrays logged with log_array() to the given stream, as a list of
+    (log id, session, time, array) tuples in log order"""
+    codec, join = _binary_codec(cursor, "binary")
+    decoder = Decoder(cursor)
+    rows = cursor.execute("SELECT log.id, log.session, log.time, binary.binary, %s, binary_array.dtype, binary_array.shape, binary_array.fortran FROM log JOIN stream ON stream.id=log.stream JOIN binary ON binary.id=log.binary JOIN binary_array ON binary_array.id=log.binary%s WHERE stream.name=? ORDER BY log.id" % (codec, join), (stream,)).fetchall()
+    return [(log_id, session, t, buffer_to_np(decoder.binary(buf, codec_id), dtype, shape, fortran)) for log_id, session, t, buf, codec_id, dtype, shape, fortran in rows]
+
+
+def _chunk_times(t0, counts, rates, timestamps):
+    """Reconstruct the time of every sample in a sequence of chunks, given the start time, sample count
+    and rate of each chunk (or an explicit timestamp vector, where one was logged)"""
+    counts = np.asarray(counts, dtype=np.int64)
+    starts = np.cumsum(counts) - counts
+    rates = np.array([r if r else np.nan for r in rates], dtype=np.float64)
+    offsets = np.arange(counts.sum()) - np.repeat(starts, counts)
+    times = np.repeat(np.asarray(t0, dtype=np.float64), counts) + offsets / np.repeat(rates, counts)
+    for start, n, stamps in zip(starts, counts, timestamps):
+        if stamps is not None:
+            times[start:start + n] = stamps
+    return times
+
+
+def chunked_stream(cursor, stream):
+    """Return the sample blocks logged with log_chunk() to a stream, joined into one contiguous
+    array per session.
+
+    Returns:
+        dictionary mapping session id -> (t, samples), where t is a vector of sample times and
+        samples is the concatenation of the blocks along the first axis
+    """
+    codec, join = _binary_codec(cursor, "b")
+    tcodec, tjoin = _binary_codec(cursor, "tb")
+    decoder = Decoder(cursor)
+    rows = cursor.execute("""SELECT log.session, log.time, chunk.n, chunk.rate,
+                                    b.binary, ba.dtype, ba.shape, ba.fortran,
+                                    tb.binary, tba.dtype, tba.shape, tba.fortran, %s, %s
+                             FROM log JOIN stream ON stream.id=log.stream
+                             JOIN chunk ON chunk.id=log.id
+                             JOIN binary b ON b.id=log.binary JOIN binary_array ba ON ba.id=log.binary
+                             LEFT JOIN binary tb ON tb.id=chunk.timestamps LEFT JOIN binary_array tba ON tba.id=chunk.timestamps%s%s
+                             WHERE stream.name=? ORDER BY log.session, log.time, log.id""" % (codec, tcodec, join, tjoin), (stream,)).fetchall()
+    sessions = {}
+    for session, chunks in itertools.groupby(rows, key=lambda row: row[0]):
+        chunks = list(chunks)
+        samples = [buffer_to_np(decoder.binary(row[4], row[12]), *row[5:8]) for row in chunks]
+        stamps = [buffer_to_np(decoder.binary(row[8], row[13]), *row[9:12]) if row[8] is not None else None for row in chunks]
+        t = _chunk_times([row[1] for row in chunks], [row[2] for row in chunks], [row[3] for row in chunks], stamps)
+        sessions[session] = (t, np.concatenate(samples))
+    return sessions
+
+
+def chunked_stream_dataframe(cursor, stream, columns=None):
+    """Return the samples logged with log_chunk() to a stream as a single DataFrame, with
+    session and t columns followed by one column per channel. columns optionally names the channels."""
+    frames = []
+    for session, (t, samples) in sorted(six.iteritems(chunked_stream(cursor, stream))):
+        samples = samples.reshape(len(t), -1)
+        df = pd.DataFrame(samples, columns=columns)
+        df.insert(0, "t", t)
+        df.insert(0, "session", session)
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=["session", "t"] + list(columns or []))
+    return pd.concat(frames, ignore_index=True)
+
+
 def json_columns(json_seq):
     # get the datatype of all entries in this column
     columns = {}
@@ -167,19 +464,15 @@ class AutoVivification(dict):
 def dump(cursor):
     c = cursor
     all = AutoVivification()
-    paths = c.execute("SELECT DISTINCT(path) FROM session").fetchall()
-    for path in paths:
-        sessions = c.execute("SELECT id, valid FROM session WHERE path=?", path).fetchall()
-        for session, svalid in sessions:
-            rows = c.execute("SELECT log.stream,log.time,log.json,log.valid,stream.name FROM log JOIN stream ON stream.id=log.stream WHERE session=? ", (session,)).fetchall()
-            frame = defaultdict(list)
-            for stream, time, js, valid, stream_name in rows:
-                d = json.loads(js)
-                d['t'] = time
-                d['valid'] = valid
-                d['session_valid'] = svalid
-                frame[stream_name].append(d)
-            all[path[0]][session[0]] = frame
+    # every session appears, even those without entries
+    for session, path, svalid in c.execute("SELECT id, path, valid FROM session ORDER BY id").fetchall():
+        all[path][session] = defaultdict(list)
+    # one pass over the log, rather than a query per session
+    for batch in iter_samples(c):
+        for stream_name, d in batch:
+            path = d.pop('path')
+            session = d.pop('session')
+            all[path][session][stream_name].append(d)
     return all
 
 
@@ -211,53 +504,317 @@ def to_csv(cursor):
                         csvfile.writerow(s)
 
 
-def dumpflat(cursor):
-    """Return a dictionary of stream entries for the **whole** dataset. Each entry has the t, valid, path, and session fields filled in,
+def _sample_filter(streams=None, sessions=None, paths=None, start=None, end=None, after=None):
+    """WHERE clause and parameters selecting log entries by stream name, session id, session path and time,
+    and (after) entries with ids above a given one"""
+    conditions, parameters = [], []
+    for column, values in [("stream.name", streams), ("log.session", sessions), ("session.path", paths)]:
+        if values is not None:
+            values = list(values)
+            conditions.append("%s IN (%s)" % (column, ", ".join("?" * len(values))))
+            parameters += values
+    for condition, value in [("log.time>=?", start), ("log.time<?", end), ("log.id>?", after)]:
+        if value is not None:
+            conditions.append(condition)
+            parameters.append(value)
+    return (" WHERE " + " AND ".join(conditions) if conditions else ""), parameters
+
+
+# fields of the rows read by _sample_rows(), by the name of the DataFrame column made from each
+_ROW_FIELDS = {"id": 0, "stream": 2, "t": 3, "valid": 5, "session": 6, "path": 7, "session_valid": 8, "tag": 9}
+
+# the fields dumpflat() adds to each sample, and the columns samples_dataframe() puts before the sample fields
+FLAT_COLUMNS = ["t", "valid", "session_valid", "path", "session"]
+SAMPLE_COLUMNS = ["id", "stream", "session", "path", "t", "valid", "session_valid", "tag"]
+
+# columns stored as pandas Categoricals in the DataFrames built here
+CATEGORICAL_COLUMNS = ("stream", "path", "tag")
+
+
+def _sample_rows(cursor, streams=None, sessions=None, paths=None, start=None, end=None, batch_size=10000, after=None,
+                 ordered=False):
+    """Read the log entries matching the filters, joined with their stream, session and typed columns.
+    If ordered, SQLite returns them sorted by id (log order).
+
+    Returns:
+        (typed, batches): typed maps the id of each stream with a schema to the offset of its columns in the
+        rows and their names; batches is a generator of lists of at most batch_size rows
+    """
+    # typed column values are joined in, rather than read up front as dumpflat() once did
+    select = ["log.id", "log.stream", "stream.name", "log.time", "log.json", "log.valid", "log.session", "session.path",
+              "session.valid", "log.tag"]
+    joins, typed = [], {}
+    for name, (stream_id, columns) in six.iteritems(stream_schemas(cursor)):
+        if streams is not None and name not in streams:
+            continue
+        table = typed_table_name(stream_id)
+        names = [c for c, _ in columns]
+        typed[stream_id] = (len(select), names)
+        select += ["%s.id" % table] + ["%s.%s" % (table, quote_identifier(c)) for c in names]
+        joins.append(" LEFT JOIN %s ON %s.id=log.id" % (table, table))
+    where, parameters = _sample_filter(streams, sessions, paths, start, end, after)
+    # a separate cursor, so that the caller can keep using theirs while iterating
+    c = cursor.connection.cursor()
+    c.execute("SELECT %s FROM log JOIN stream ON stream.id=log.stream JOIN session ON session.id=log.session%s%s%s" %
+              (", ".join(select), "".join(joins), where, " ORDER BY log.id" if ordered else ""), parameters)
+
+    def batches():
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    return typed, batches()
+
+
+def _typed_values(row, typed):
+    offset, names = typed[row[1]]
+    if row[offset] is None:
+        return ()
+    return zip(names, row[offset + 1:offset + 1 + len(names)])
+
+
+def iter_samples(cursor, streams=None, sessions=None, paths=None, start=None, end=None, batch_size=10000):
+    """Generator over the entries of the dataset, in the format of dumpflat(), reading and decoding
+    batch_size rows at a time. The filters are applied in SQL, so memory use depends only on batch_size.
+
+    Parameters:
+        streams: only entries of these stream names
+        sessions: only entries of these session ids
+        paths: only entries of sessions with these paths
+        start, end: only entries with start <= time < end
+
+    Yields:
+        lists of (stream name, sample dict) pairs, each dict having the t, valid, session_valid, path
+        and session fields along with the stored data
+    """
+    decoder = Decoder(cursor)
+    typed, batches = _sample_rows(cursor, streams, sessions, paths, start, end, batch_size)
+    for rows in batches:
+        batch = []
+        for row in rows:
+            d = decoder.loads(row[4])
+            if d is None:
+                # entries logged without data (e.g. binaries and chunks)
+                d = {}
+            if row[1] in typed:
+                d.update(_typed_values(row, typed))
+            d['t'] = row[3]
+            d['valid'] = row[5]
+            d['session_valid'] = row[8]
+            d['path'] = row[7]
+            d['session'] = row[6]
+            batch.append((row[2], d))
+        yield batch
+
+
+def _rows_frame(rows, typed, decoder, columns=FLAT_COLUMNS):
+    """DataFrame of rows read by _sample_rows(): the JSON of all the rows is parsed in one go, and each
+    field becomes a typed column (see frames.samples_frame()), followed by the given row columns"""
+    objs = parse_json([decoder.json(row[4]) for row in rows])
+    if typed:
+        for i, row in enumerate(rows):
+            if row[1] in typed:
+                objs[i] = dict(objs[i] or {}, **dict(_typed_values(row, typed)))
+    return samples_frame(objs, [(name, [row[_ROW_FIELDS[name]] for row in rows]) for name in columns],
+                         categorical=CATEGORICAL_COLUMNS)
+
+
+def iter_dataframes(cursor, streams=None, sessions=None, paths=None, start=None, end=None, batch_size=10000):
+    """Generator over the entries of the dataset as per-stream DataFrames of (at most) batch_size rows,
+    in the format of dump_flat_dataframe(). Takes the same filters as iter_samples(); at most batch_size
+    rows per stream are held in memory at once.
+
+    Yields:
+        (stream name, DataFrame) pairs. The frames of a stream follow log order; their columns are those
+        of the samples in each frame, so they can differ between frames if the samples do.
+    """
+    return _iter_frames(cursor, streams, sessions, paths, start, end, batch_size)
+
+
+def _iter_frames(cursor, streams=None, sessions=None, paths=None, start=None, end=None, batch_size=10000,
+                 after=None, columns=FLAT_COLUMNS):
+    decoder = Decoder(cursor)
+    typed, batches = _sample_rows(cursor, streams, sessions, paths, start, end, batch_size, after)
+    pending = defaultdict(list)
+    for batch in batches:
+        for row in batch:
+            rows = pending[row[2]]
+            rows.append(row)
+            if len(rows) >= batch_size:
+                yield row[2], _rows_frame(rows, typed, decoder, columns)
+                pending[row[2]] = []
+    for stream, rows in six.iteritems(pending):
+        if rows:
+            yield stream, _rows_frame(rows, typed, decoder, columns)
+
+
+def dumpflat(cursor, streams=None, sessions=None, paths=None, start=None, end=None):
+    """Return a dictionary of stream entries for the **whole** dataset (or the entries matching the filters of
+    iter_samples()). Each entry has the t, valid, path, and session fields filled in,
     along with the columns stored in the JSON entries"""
-    c = cursor
-    rows = c.execute("SELECT log.stream,log.time,log.json,log.valid,stream.name,log.session,session.path,session.valid FROM log JOIN stream ON stream.id=log.stream JOIN session on log.session=session.id").fetchall()
     frame = defaultdict(list)
-    for stream, time, js, valid, stream_name,session,path,svalid in rows:
-        d = json.loads(js)
-        d['t'] = time
-        d['valid'] = valid
-        d['session_valid'] = svalid
-        d['path'] = path
-        d['session'] = session
-        frame[stream_name].append(d)
+    for batch in iter_samples(cursor, streams, sessions, paths, start, end):
+        for stream_name, d in batch:
+            frame[stream_name].append(d)
     return frame
 
 
-def dump_flat_dataframe(cursor):
-    frame = dumpflat(cursor)
+def dump_flat_dataframe(cursor, streams=None, sessions=None, paths=None, start=None, end=None):
+    """Return a dictionary mapping each stream name to a DataFrame of its entries (those matching the filters
+    of iter_samples()), with one typed column per sample field, followed by the fields of dumpflat().
+    Integer fields with missing values are nullable Int64 columns, and the path is a Categorical."""
+    decoder = Decoder(cursor)
+    typed, batches = _sample_rows(cursor, streams, sessions, paths, start, end)
+    stream_rows = defaultdict(list)
+    for batch in batches:
+        for row in batch:
+            stream_rows[row[2]].append(row)
     dfs = {}
-    for key, df in six.iteritems(frame):
-        columns = json_columns(df)
-        dfs[key] = pd.DataFrame(df, columns=list(columns.keys()))
+    for stream, rows in six.iteritems(stream_rows):
+        dfs[stream] = _rows_frame(rows, typed, decoder)
     return dfs
 
 
-def to_csv_flat(cursor, csvdir):
-    """Write each stream type to an individual CSV file in the given directory, in the same format as dumpflat() does"""
-    streams = dumpflat(cursor)
-    # write out each stream independently
-    for stream_name, stream_data in six.iteritems(streams):
-        with open(os.path.join(csvdir,"%s.csv" % (stream_name)), 'w') as f:
-            csvfile = csv.DictWriter(f, delimiter=",", fieldnames=list(stream_data[0].keys()))
-            csvfile.writeheader()
-            for s in stream_data:
-                csvfile.writerow(s)
+def samples_dataframe(cursor, streams=None, sessions=None, paths=None, start=None, end=None):
+    """Return the entries of every stream (or those matching the filters of iter_samples()) as one DataFrame,
+    in log order. The id, stream, session, path, t, valid, session_valid and tag columns come first, with
+    stream, path and tag as Categoricals, followed by one typed column per sample field."""
+    decoder = Decoder(cursor)
+    typed, batches = _sample_rows(cursor, streams, sessions, paths, start, end, ordered=True)
+    rows = list(itertools.chain.from_iterable(batches))
+    df = _rows_frame(rows, typed, decoder, columns=SAMPLE_COLUMNS)
+    return df[SAMPLE_COLUMNS + [c for c in df.columns if c not in SAMPLE_COLUMNS]]
+
+
+def to_csv_flat(cursor, csvdir, streams=None, sessions=None, paths=None, start=None, end=None):
+    """Write each stream type to an individual CSV file in the given directory, in the same format as dumpflat() does.
+    The entries are streamed to the files, batch by batch."""
+    files, writers = {}, {}
+    try:
+        for batch in iter_samples(cursor, streams, sessions, paths, start, end):
+            for stream_name, d in batch:
+                if stream_name not in writers:
+                    files[stream_name] = open(os.path.join(csvdir, "%s.csv" % (stream_name)), 'w')
+                    writers[stream_name] = csv.DictWriter(files[stream_name], delimiter=",", fieldnames=list(d.keys()))
+                    writers[stream_name].writeheader()
+                writers[stream_name].writerow(d)
+    finally:
+        for f in six.itervalues(files):
+            f.close()
+
+
+# columns written by to_parquet() after the sample fields; the partition columns are left out of the files
+EXPORT_COLUMNS = ["id", "t", "valid", "session_valid", "tag", "path", "session"]
+
+# file in a to_parquet() directory recording what has been exported; pyarrow datasets skip files named _*
+WATERMARK_FILE = "_watermark.json"
+
+
+def _read_watermark(outdir):
+    try:
+        with open(os.path.join(outdir, WATERMARK_FILE)) as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return {"last_id": 0, "exports": 0}
+
+
+def _part_files(outdir):
+    """The files written by to_parquet() under outdir, with the number of the export that wrote each"""
+    for root, dirs, files in os.walk(outdir):
+        for fname in files:
+            match = re.match(r"part-(\d+)-\d+\.parquet$", fname)
+            if match:
+                yield os.path.join(root, fname), int(match.group(1))
+
+
+def _arrow_table(df):
+    """pyarrow Table of a frame; object columns with values pyarrow cannot type (e.g. mixed JSON) are stored as JSON text"""
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        df = df.copy()
+        for column in df.columns:
+            if df[column].dtype == object:
+                try:
+                    pa.array(df[column], from_pandas=True)
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    df[column] = [json.dumps(v) if v is not None else None for v in df[column]]
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def to_parquet(cursor, outdir, streams=None, sessions=None, paths=None, start=None, end=None,
+               partition_by=("path", "session"), compression="zstd", batch_size=100000, incremental=False):
+    """Export the entries of each stream (or those matching the filters of iter_samples()) as Parquet files,
+    using pyarrow (which must be installed). Each stream is written under outdir/<stream>/, partitioned into
+    path=<path>/session=<session>/ directories (hive partitioning, with URL-quoted values), so that
+    e.g. pyarrow.dataset.dataset(os.path.join(outdir, "mouse"), partitioning="hive") reads a stream back.
+
+    The entries are read and written batch_size rows at a time, with one typed column per sample field
+    (as in dump_flat_dataframe()), followed by the id, t, valid, session_valid and tag columns. Memory use
+    depends only on batch_size.
+
+    Parameters:
+        partition_by: the columns to partition by: ("path", "session"), ("path",) or ()
+        compression: the Parquet compression codec
+        incremental: If True, only export the entries logged since the last export to outdir (those with
+                     log ids above its watermark). If False, replace any earlier export in outdir.
+
+    Returns:
+        the new watermark, also stored in outdir/_watermark.json: a dictionary with the last log id exported
+        (last_id), the number of exports made to outdir (exports), and the rows and files written by this export
+    """
+    if pq is None:
+        raise ImportError("to_parquet() needs pyarrow")
+    partition_by = list(partition_by)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    watermark = _read_watermark(outdir) if incremental else {"last_id": 0, "exports": 0}
+    export = watermark["exports"] + 1
+    for fname, n in list(_part_files(outdir)):
+        # everything, for a full export; otherwise only the files of an export that did not finish
+        if not incremental or n >= export:
+            os.remove(fname)
+    for root, dirs, files in os.walk(outdir, topdown=False):
+        if root != outdir and not os.listdir(root):
+            os.rmdir(root)
+
+    last_id, rows, files = watermark["last_id"], 0, 0
+    after = last_id if incremental else None
+    for stream, df in _iter_frames(cursor, streams, sessions, paths, start, end, batch_size, after, EXPORT_COLUMNS):
+        last_id = max(last_id, int(df["id"].max()))
+        rows += len(df)
+        parts = df.groupby(partition_by, observed=True, sort=False) if partition_by else [((), df)]
+        for key, part in parts:
+            key = key if isinstance(key, tuple) else (key,)
+            directory = os.path.join(outdir, quote(stream, safe=""),
+                                     *["%s=%s" % (column, quote(str(value), safe="")) for column, value in zip(partition_by, key)])
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            files += 1
+            pq.write_table(_arrow_table(part.drop(columns=partition_by)),
+                           os.path.join(directory, "part-%06d-%06d.parquet" % (export, files)), compression=compression)
+
+    # only recorded once every file is written, so an interrupted export is redone by the next one
+    watermark = {"last_id": last_id, "exports": export, "rows": rows, "files": files}
+    tmp = os.path.join(outdir, WATERMARK_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(watermark, f)
+    os.replace(tmp, os.path.join(outdir, WATERMARK_FILE))
+    return watermark
 
 
 def dump_sessions(cursor):
     c = cursor
     sessions = {}
+    summary = {session: (last_time, count) for session, last_time, count in
+               c.execute("SELECT session, max(time), count(id) FROM log GROUP BY session").fetchall()}
     ss = c.execute("SELECT id, start_time, end_time, test_run, random_seed, valid, complete, description, json, subcount, parent, path, name FROM session").fetchall()
     for session in ss:
-        last_time, count = c.execute("SELECT max(log.time), count(log.id) FROM log JOIN session ON session.id=log.session WHERE session.id=?", (session[0],)).fetchone()
+        last_time, count = summary.get(session[0], (None, 0))
         sessions[session[0]] = dict(id=session[0], start_time=session[1], end_time=session[2],
         test_run=session[3], random_seed=session[4], valid=session[5],
-        complete=session[6], description=session[7], json=json.loads(session[8] or 'null'),
+        complete=session[6], description=session[7], json=json.loads(session[8]) if session[8] not in (None, 'null') else None,
         subcount=session[9], parent=session[10], path=session[11], name=session[12], log_count=count, last_time=last_time)
     return sessions
 
@@ -274,16 +831,17 @@ def map_children_sessions(cursor):
     """
     full_tree = defaultdict(list)
     path_tree = defaultdict(list)
-    sessions = cursor.execute("SELECT id FROM session").fetchall()
-    for session in sessions:
-        s = session[0]
-        orig = s
-        parent,path = cursor.execute("SELECT parent,path FROM session WHERE id=?", (s,)).fetchone()
+    sessions = cursor.execute("SELECT id, parent, path FROM session").fetchall()
+    # the ancestors are followed in memory, rather than with a query per step
+    nodes = {s: (parent, path) for s, parent, path in sessions}
+    for orig, _, _ in sessions:
+        s = orig
+        parent, path = nodes[s]
         while parent!=None:
             full_tree[parent].append(orig)
             path_tree[path].append(orig)
             s = parent
-            parent,path = cursor.execute("SELECT parent,path FROM session WHERE id=?", (s,)).fetchone()
+            parent, path = nodes[s]
     return full_tree, path_tree
 
 
@@ -302,24 +860,23 @@ def paths(cursor):
 
 def dump_dataframe(cursor):
     c = cursor
+    frames = OrderedDict()
+    for session, path in c.execute("SELECT id, path FROM session ORDER BY id").fetchall():
+        frames[session] = (path, defaultdict(list))
+    # one pass over the log, rather than a query per session
+    for batch in iter_samples(c):
+        for stream_name, d in batch:
+            del d['session_valid']
+            del d['path']
+            frames[d.pop('session')][1][stream_name].append(d)
     all = defaultdict(list)
-    paths = c.execute("SELECT DISTINCT(path) FROM session").fetchall()
-    for path in paths:
-        sessions = c.execute("SELECT id FROM session WHERE path=?", path).fetchall()
-        for session in sessions:
-            rows = c.execute("SELECT log.stream,log.time,log.json,log.valid,stream.name FROM log JOIN stream ON stream.id=log.stream WHERE session=? ", session).fetchall()
-            frame = defaultdict(list)
-            for stream, time, js, valid, stream_name in rows:
-                d = json.loads(js)
-                d['t'] = time
-                d['valid'] = valid
-                frame[stream_name].append(d)
-            # convert to pandas
-            dfs = {}
-            for k,v in six.iteritems(frame):
-                columns = json_columns(v)
-                dfs[k] = pd.DataFrame(v, columns=list(columns.keys()))
-            all[path].append(dfs)
+    for path, frame in six.itervalues(frames):
+        # convert to pandas
+        dfs = {}
+        for k,v in six.iteritems(frame):
+            dfs[k] = samples_frame(v, [])
+        # keyed by (path,) tuples, as this function always has been
+        all[(path,)].append(dfs)
     return all
 
 
@@ -341,14 +898,11 @@ def meta(cursor):
 
     c = cursor
     meta = c.execute("SELECT id,name,description,type,mtype,json FROM meta").fetchall()
+    bound_sessions = _bound_sessions(c)
     metas = defaultdict(list)
     bound_ix = defaultdict(list)
     for id,name,description,stype,mtype,js in meta:
-        session = c.execute("SELECT session FROM meta_session WHERE meta_session.meta=?", (id,)).fetchall()
-        if session is not None:
-            bound = [s[0] for s in session]
-        else:
-            bound = []
+        bound = bound_sessions.get(id, [])
         if js is None:
             js = 'null'
         meta_dict = {'name':name, 'description':description, 'type':stype, 'data':json.loads(js), 'bound':bound}
@@ -358,6 +912,35 @@ def meta(cursor):
     return metas, bound_ix
 
 
+def _bound_sessions(cursor):
+    """Map each meta id to every session it is bound to (as core.BOUND_SESSIONS resolves them for one entry),
+    from a single read of the session tree and the bindings"""
+    children = defaultdict(list)
+    for id, parent in cursor.execute("SELECT id, parent FROM session ORDER BY id").fetchall():
+        children[parent].append(id)
+    starts, unbound = defaultdict(list), defaultdict(set)
+    for meta, session, unbound_session in cursor.execute("SELECT meta, session, unbound_session FROM meta_session ORDER BY id").fetchall():
+        if session is not None:
+            starts[meta].append(session)
+        elif unbound_session is not None:
+            unbound[meta].add(unbound_session)
+    bound = {}
+    for meta, sessions in six.iteritems(starts):
+        # a binding covers the descendants of the session, except below an unbinding
+        hidden = unbound.get(meta, ())
+        seen, order = set(), []
+        queue = deque(sessions)
+        while queue:
+            s = queue.popleft()
+            if s in seen:
+                continue
+            seen.add(s)
+            order.append(s)
+            queue.extend(child for child in children.get(s, ()) if child not in hidden)
+        bound[meta] = order
+    return bound
+
+
 def meta_dataframe(cursor):
     c = cursor
     metas, _ = meta(c)
@@ -367,6 +950,38 @@ def meta_dataframe(cursor):
 
     return frames
 
+
+# the per-session and per-stream lookups made by this module, report.py and ExperimentLog, for query_plans()
+QUERIES = [
+    ("iter_samples: samples of a session", "SELECT log.id, stream.name, log.time, log.json FROM log JOIN stream ON stream.id=log.stream JOIN session ON session.id=log.session WHERE log.session IN (?)"),
+    ("iter_samples: samples of a path", "SELECT log.id, stream.name, log.time, log.json FROM log JOIN stream ON stream.id=log.stream JOIN session ON session.id=log.session WHERE session.path IN (?)"),
+    ("iter_samples: samples of a stream in a time range", "SELECT log.id, stream.name, log.time, log.json FROM log JOIN stream ON stream.id=log.stream JOIN session ON session.id=log.session WHERE stream.name IN (?) AND log.time>=? AND log.time<?"),
+    ("session samples by stream, in time order", "SELECT id, time, json FROM log WHERE session=? AND stream=? ORDER BY time"),
+    ("dump_sessions: entries per session", "SELECT session, max(time), count(id) FROM log GROUP BY session"),
+    ("stream_arrays", "SELECT log.id, log.session, log.time, binary.binary FROM log JOIN stream ON stream.id=log.stream JOIN binary ON binary.id=log.binary JOIN binary_array ON binary_array.id=log.binary WHERE stream.name=? ORDER BY log.id"),
+    ("chunked_stream", "SELECT log.session, log.time, chunk.n FROM log JOIN stream ON stream.id=log.stream JOIN chunk ON chunk.id=log.id WHERE stream.name=? ORDER BY log.session, log.time, log.id"),
+    ("report: entries of a stream", "SELECT count(id) FROM log WHERE stream=?"),
+    ("get_logs: records of a run", "SELECT time, level, run, record FROM debug_logging WHERE run=? ORDER BY time, id"),
+    ("last_session", "SELECT id FROM session WHERE start_time=(SELECT max(start_time) FROM session) AND complete=0"),
+    ("find_metatable", "SELECT id FROM meta WHERE name=? AND mtype=?"),
+]
+
+
+def query_plans(cursor, queries=QUERIES):
+    """Run EXPLAIN QUERY PLAN on the lookups the extract and report functions make (or the given
+    list of (name, sql) queries), to check which of them read whole tables in this database.
+
+    Returns:
+        list of indices.QueryPlan; the full_scans of each lists the tables it scans without an index
+    """
+    tables = table_names(cursor)
+    return [explain(cursor, name, sql, tables) for name, sql in queries]
+
+
+def full_scans(cursor, queries=QUERIES):
+    """Return {query name: [tables]} for the queries of query_plans() which make full table scans"""
+    return {plan.name: plan.full_scans for plan in query_plans(cursor, queries) if plan.full_scans}
+
 if __name__=="__main__":
     import sqlite3
     import sys
@@ -0,0 +1,114 @@
+import itertools
+import json
+
+import numpy as np
+import pandas as pd
+import six
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# kinds of value in a JSON column, as inferred by infer_schema()
+BOOLEAN, INTEGER, FLOAT, TEXT, JSON = "BOOLEAN", "INTEGER", "FLOAT", "TEXT", "JSON"
+
+
+def parse_json(texts):
+    """Parse a list of JSON texts (None for entries without data) into a list of objects.
+
+    Uses orjson if it is installed; otherwise the texts are joined into one JSON array, so that the
+    standard parser is called once rather than once per text.
+    """
+    if orjson is not None:
+        loads = orjson.loads
+        return [loads(t) if t is not None else None for t in texts]
+    return json.loads("[%s]" % ",".join(t if t is not None else "null" for t in texts))
+
+
+def _kind(value):
+    if isinstance(value, bool):
+        return BOOLEAN
+    if isinstance(value, six.integer_types):
+        return INTEGER
+    if isinstance(value, float):
+        return FLOAT
+    if isinstance(value, str):
+        return TEXT
+    return JSON
+
+
+def infer_schema(objs, sample_size=1000):
+    """Infer the columns of a list of decoded samples (dicts), and the kind of value in each, from an
+    evenly spaced sample of the rows.
+
+    Returns:
+        dictionary column -> kind (BOOLEAN, INTEGER, FLOAT, TEXT or JSON), in order of first appearance
+        over all the rows; columns only seen outside the sample have kind None
+    """
+    # every column, in the order json_columns() gives them, found without a Python loop over the keys
+    columns = dict.fromkeys(itertools.chain.from_iterable(objs))
+    step = max(1, len(objs) // sample_size)
+    kinds = {}
+    for obj in itertools.islice(objs, 0, None, step):
+        for key, value in obj.items():
+            if value is None:
+                continue
+            kind = _kind(value)
+            seen = kinds.get(key)
+            if seen is None or seen == kind:
+                kinds[key] = kind
+            elif {seen, kind} == {INTEGER, FLOAT}:
+                kinds[key] = FLOAT
+            else:
+                kinds[key] = JSON
+    for key in columns:
+        columns[key] = kinds.get(key)
+    return columns
+
+
+def typed_column(values, kind):
+    """Convert a list of values to a typed array: integer columns with missing values become nullable
+    Int64 and boolean ones nullable boolean. Anything else, or any value not matching the inferred kind,
+    is left to pandas' type inference."""
+    if kind == INTEGER:
+        # no dtype given, so that floats or strings outside the sample are not cast to integers
+        array = np.array(values)
+        if array.dtype.kind == "i":
+            return array
+        try:
+            return pd.array(values, dtype="Int64")
+        except (TypeError, ValueError):
+            pass
+    elif kind == BOOLEAN:
+        array = np.array(values)
+        if array.dtype.kind == "b":
+            return array
+        try:
+            return pd.array(values, dtype="boolean")
+        except (TypeError, ValueError):
+            pass
+    series = pd.Series(values, dtype=object).infer_objects()
+    return series.values
+
+
+def samples_frame(objs, columns, sample_size=1000, categorical=()):
+    """Build a DataFrame with a typed column for each field of a list of decoded samples (dicts, or None
+    for samples without data), followed by the given extra columns.
+
+    Parameters:
+        objs: list of decoded samples
+        columns: list of (name, values) pairs, added after (and replacing) the sample fields
+        sample_size: number of rows used to infer the column types
+        categorical: names of columns stored as pandas Categoricals
+    """
+    # samples which are not JSON objects are kept in a `value` column
+    objs = [obj if isinstance(obj, dict) else ({} if obj is None else {"value": obj}) for obj in objs]
+    extra = [name for name, _ in columns]
+    data = {}
+    for key, kind in infer_schema(objs, sample_size).items():
+        if key not in extra:
+            data[key] = typed_column([obj.get(key) for obj in objs], kind)
+    for name, values in columns:
+        data[name] = pd.Categorical(values) if name in categorical else values
+    return pd.DataFrame(data, index=pd.RangeIndex(len(objs)))
@@ -0,0 +1,115 @@
+import collections
+import logging
+import threading
+
+logger = logging.getLogger('explogger')
+
+
+class SQLHandler(logging.Handler):
+    """logging.Handler which stores records in the debug_logging table of an ExperimentLog.
+
+    emit() only formats the record and appends it to an in-memory buffer; a background thread
+    takes the database lock and inserts the buffered records in one batch, so logging never
+    waits for SQLite.
+
+    Parameters:
+        explog: the ExperimentLog to write to
+        level: minimum level of records to store
+        capacity: write the buffer once it holds this many records
+        flush_interval: write the buffer at least this often (seconds)
+        flush_level: records at or above this level are written (and committed) straight away
+        max_buffer: largest number of records held in memory; beyond this the oldest are
+                    discarded (counted in `dropped`)
+    """
+
+    def __init__(self, explog, level=logging.NOTSET, capacity=1000, flush_interval=1.0,
+                 flush_level=logging.ERROR, max_buffer=100000):
+        logging.Handler.__init__(self, level)
+        self.explog = explog
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self.buffer = collections.deque(maxlen=max_buffer)
+        self.buffer_lock = threading.Lock()
+        self.dropped = 0
+        self.written = 0
+        # set when an error-level record is waiting, so that the batch is committed
+        self.urgent = False
+
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="explogger-logging")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle(self, record):
+        # emit() is thread-safe by itself. Skipping the handler lock means the writer thread's own
+        # logging never waits on a thread that is flushing or closing this handler.
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        # records produced while writing (e.g. the logger's own debug output) would feed back forever
+        if self.explog is None or record.thread == self.thread.ident:
+            return
+        try:
+            entry = (record.created + self.explog.time_offset, self.format(record), self.explog.run_id, record.levelno)
+        except Exception:
+            self.handleError(record)
+            return
+        with self.buffer_lock:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append(entry)
+            n = len(self.buffer)
+            if record.levelno >= self.flush_level:
+                self.urgent = True
+        if n >= self.capacity or record.levelno >= self.flush_level:
+            self.wake.set()
+
+    def flush(self):
+        """Write all buffered records now, from the calling thread."""
+        explog = self.explog
+        if explog is None:
+            return
+        with self.buffer_lock:
+            entries = list(self.buffer)
+            self.buffer.clear()
+            urgent, self.urgent = self.urgent, False
+        if not entries:
+            return
+        with explog.db_lock:
+            if explog.multi_writer:
+                explog._retry(self._insert, explog, entries)
+            else:
+                self._insert(explog, entries)
+            self.written += len(entries)
+            if urgent:
+                explog.commit()
+            else:
+                explog.commit_policy.wrote(len(entries))
+
+    def _insert(self, explog, entries):
+        explog.cursor.executemany("INSERT INTO debug_logging(time, record, run, level) VALUES (?, ?, ?, ?)", entries)
+
+    def close(self):
+        """Stop the background thread and write any remaining records."""
+        if not self.stopped.is_set():
+            self.stopped.set()
+            self.wake.set()
+            self.thread.join()
+            self.flush()
+            self.explog = None
+        logging.Handler.close(self)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # the records are lost, but the caller must never see this
+                logger.debug("Could not write logging records: %s" % e)
@@ -0,0 +1,210 @@
+import collections
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from six.moves import queue
+
+logger = logging.getLogger('explogger')
+
+# one index: its name, table and column list. Indices on the sample data tables (data=True) are also
+# built in each shard, where those tables live when the log is sharded.
+IndexSpec = collections.namedtuple('IndexSpec', ['name', 'table', 'columns', 'data'])
+
+# the access patterns of the extract and report queries:
+#   samples of a session (by stream, in time order); samples of a stream in time order;
+#   sessions by path; the last (incomplete) session, as found by last_session()
+# an index also holds the rowid, so e.g. counting the entries of a stream is answered from log_stream_time alone
+INDICES = [
+    IndexSpec("log_session_stream_time", "log", "session, stream, time", True),
+    IndexSpec("log_stream_time", "log", "stream, time", True),
+    IndexSpec("session_path", "session", "path", False),
+    IndexSpec("session_start_complete", "session", "start_time, complete", False),
+]
+
+# when IndexManager builds its indices
+INDEX_MODES = ("open", "end", "background")
+
+# one built index: where, which, and how long it took (0 if it already existed)
+BuiltIndex = collections.namedtuple('BuiltIndex', ['schema', 'name', 'duration'])
+
+# the plan of one query: its name and SQL, the plan steps, and the tables it scans without an index
+QueryPlan = collections.namedtuple('QueryPlan', ['name', 'sql', 'plan', 'full_scans'])
+
+
+def index_sql(schema, spec):
+    return "CREATE INDEX IF NOT EXISTS %s.%s ON %s(%s)" % (schema, spec.name, spec.table, spec.columns)
+
+
+def has_index(cursor, schema, name):
+    return cursor.execute("SELECT count(*) FROM %s.sqlite_master WHERE type='index' AND name=?" % schema,
+                          (name,)).fetchone()[0] > 0
+
+
+def build_indices(cursor, schema, indices, data_only=False):
+    """Create the given indices (that do not exist yet) in one schema, committing after each one.
+
+    Returns:
+        list of BuiltIndex
+    """
+    built = []
+    for spec in indices:
+        if data_only and not spec.data:
+            continue
+        if has_index(cursor, schema, spec.name):
+            continue
+        start = time.time()
+        cursor.execute(index_sql(schema, spec))
+        cursor.connection.commit()
+        built.append(BuiltIndex(schema, spec.name, time.time() - start))
+        logger.debug("Built index %s.%s in %.3fs" % (schema, spec.name, built[-1].duration))
+    return built
+
+
+def table_names(cursor):
+    """Names of the tables in all schemas of a connection"""
+    tables = set()
+    for row in cursor.execute("PRAGMA database_list").fetchall():
+        tables.update(name for name, in cursor.execute("SELECT name FROM %s.sqlite_master WHERE type='table'" % row[1]).fetchall())
+    return tables
+
+
+def explain(cursor, name, sql, tables=None):
+    """Run EXPLAIN QUERY PLAN on a query (all its parameters bound to NULL).
+
+    Returns:
+        QueryPlan, listing the tables the query reads with a full scan (rather than an index search or scan)
+    """
+    if tables is None:
+        tables = table_names(cursor)
+    rows = cursor.execute("EXPLAIN QUERY PLAN " + sql, [None] * sql.count("?")).fetchall()
+    plan = [row[-1] for row in rows]
+    # views and CTEs evaluated into temporary results, which are then scanned under the same name
+    subqueries = set(m.group(1) for m in (re.match(r"(?:MATERIALIZE|CO-ROUTINE) (\S+)$", step) for step in plan) if m)
+    scans = []
+    for step in plan:
+        match = re.match(r"SCAN (\S+)(.*)$", step)
+        if match is None or "INDEX" in match.group(2) or match.group(1) in subqueries:
+            continue
+        # tables in attached databases are given as schema.table
+        table = match.group(1).split(".")[-1]
+        if table in tables:
+            scans.append(match.group(1))
+    return QueryPlan(name, sql, plan, scans)
+
+
+class IndexManager(object):
+    """Creates the composite indices used by the extract and report queries, idempotently
+    (an index that already exists is left alone).
+
+    Parameters:
+        when: "open" builds the indices when the log is opened (and in every new shard), so they are
+              maintained by every write; "end" builds them when the run ends (and when a shard is closed),
+              which keeps ingest as fast as without indices; "background" builds them from a background
+              thread straight after the log is opened, one index at a time, so opening the log does not wait
+              for indices on existing data (writes wait while each index is built; with async_writes log()
+              only queues the records)
+        indices: the IndexSpecs to build (defaults to INDICES)
+
+    The indices an IndexManager has built are listed in `built`.
+    """
+
+    def __init__(self, when="end", indices=None):
+        if when not in INDEX_MODES:
+            raise ValueError("Unknown index mode '%s'; should be one of %s" % (when, INDEX_MODES))
+        self.when = when
+        self.indices = list(INDICES if indices is None else indices)
+        self.built = []
+
+        self.explog = None
+        self.thread = None
+        self.queue = queue.Queue()
+
+    @classmethod
+    def from_option(cls, indices):
+        """Manager for the `indices` option of ExperimentLog: "open", "end", "background" or an IndexManager"""
+        if indices is None or isinstance(indices, IndexManager):
+            return indices
+        return cls(when=indices)
+
+    def __repr__(self):
+        return "IndexManager(when=%s, indices=%s)" % (self.when, [spec.name for spec in self.indices])
+
+    def attach(self, explog):
+        """Start managing the indices of a log (called with its db_lock held)."""
+        self.explog = explog
+        if self.when == "open":
+            self.build()
+        elif self.when == "background":
+            self.thread = threading.Thread(target=self._run, name="explogger-indices")
+            self.thread.daemon = True
+            self.thread.start()
+            self.queue.put(None)
+
+    def build(self):
+        """Build the missing indices in the main database and the schema receiving the sample data, now."""
+        explog = self.explog
+        with explog.db_lock:
+            explog.conn.commit()
+            self.built += build_indices(explog.cursor, "main", self.indices)
+            if explog.data_schema != "main":
+                self.built += build_indices(explog.cursor, explog.data_schema, self.indices, data_only=True)
+
+    # the methods below are called by ExperimentLog and ShardPolicy, with the log's db_lock held
+
+    def data_schema_changed(self):
+        """Called when the sample data starts going to a new (attached) schema."""
+        if self.when == "open" and self.explog.data_schema != "main":
+            self.explog.conn.commit()
+            self.built += build_indices(self.explog.cursor, self.explog.data_schema, self.indices, data_only=True)
+
+    def shard_closing(self, schema, path):
+        """Called before a shard is detached, with no transaction open; no more data will be written to it."""
+        if self.when == "end":
+            self.built += build_indices(self.explog.cursor, schema, self.indices, data_only=True)
+        elif self.when == "background":
+            # built from a connection of its own, as the log no longer has the shard attached
+            self.queue.put(path)
+
+    def end(self):
+        """Called when the run ends: builds any indices that are still missing."""
+        self.stop()
+        if self.when != "open":
+            self.build()
+
+    def stop(self):
+        """Stop the background thread, once it has built the indices it was asked to."""
+        if self.thread is not None:
+            self.queue.put(False)
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while True:
+            target = self.queue.get()
+            if target is False:
+                break
+            try:
+                if target is None:
+                    self._build_each()
+                else:
+                    conn = sqlite3.connect(target)
+                    try:
+                        self.built += build_indices(conn.cursor(), "main", self.indices, data_only=True)
+                    finally:
+                        conn.close()
+            except Exception as e:
+                # end() builds whatever is missing
+                logger.debug("Could not build indices in the background: %s" % e)
+
+    def _build_each(self):
+        # take the log's lock for one index at a time, so writes are only held up while each one is built
+        explog = self.explog
+        for spec in self.indices:
+            with explog.db_lock:
+                explog.conn.commit()
+                self.built += build_indices(explog.cursor, "main", [spec])
+                if explog.data_schema != "main":
+                    self.built += build_indices(explog.cursor, explog.data_schema, [spec], data_only=True)
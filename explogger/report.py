@@ -6,6 +6,8 @@ import json
 # import cStringIO
 import io
 
+from .core import read_dataset_meta, BOUND_SESSIONS
+
 def pretty_json(x):
     return (u"\n"+json.dumps(x, sort_keys=True, indent=4, separators=(',', ': '))+"\n").replace(u"\n", "\n        ")
 
@@ -49,7 +51,7 @@ def make_readme(cursor, f, fname="none"):
             return [row[0] for row in result.fetchall()]
 
 
-    meta = json.loads(sqlresult(u"SELECT json FROM dataset WHERE id=(SELECT MAX(id) FROM dataset)"))
+    meta, _ = read_dataset_meta(cursor)
 
     f.write(u"# %s\n" % meta.get(u"title", "---"))
     f.write(u"#### %s\n" % meta.get(u"short_description", ""))
@@ -127,7 +129,7 @@ def make_report(cursor, f, fname="none"):
     for id, name, jsons in cursor.execute(u"SELECT id,name,json FROM users").fetchall():
         f.write(u"\n\n#### %s\n" % name)
         f.write(u"**JSON** \n %s\n" % pretty_json(json.loads(jsons)))
-        f.write(u"Duration recorded: %s seconds\n" % sqlresult(u"SELECT sum(session.end_time-session.start_time) FROM session JOIN meta_session ON meta_session.session=session.id JOIN users ON meta_session.meta=users.id WHERE users.id=%d"%id))
+        f.write(u"Duration recorded: %s seconds\n" % cursor.execute(BOUND_SESSIONS + u"SELECT sum(session.end_time-session.start_time) FROM session WHERE id IN bound", (id, id)).fetchone()[0])
 
     f.write(u"\n----------------------------------------\n")
     f.write(u"\n## Log\n")
@@ -0,0 +1,157 @@
+import logging
+import os
+import time
+
+from .wal import wal_size
+
+logger = logging.getLogger('explogger')
+
+# name the current shard is attached under in the writing connection
+SHARD_SCHEMA = "shard"
+
+# tables holding the sample data, which are moved out of the main database into the shards.
+# ids continue from one shard to the next (AUTOINCREMENT, seeded from the previous shard), so that
+# log and binary ids stay unique across the whole dataset
+SHARD_TABLES = [
+    '''CREATE TABLE IF NOT EXISTS %(schema)s.log
+       (id INTEGER PRIMARY KEY AUTOINCREMENT, session INT, valid INT, time REAL, stream INT, tag TEXT, json TEXT, binary INT)''',
+    '''CREATE TABLE IF NOT EXISTS %(schema)s.binary (id INTEGER PRIMARY KEY AUTOINCREMENT, binary BLOB)''',
+    '''CREATE TABLE IF NOT EXISTS %(schema)s.binary_array (id INTEGER PRIMARY KEY, dtype TEXT, shape TEXT, fortran INT)''',
+    '''CREATE TABLE IF NOT EXISTS %(schema)s.chunk (id INTEGER PRIMARY KEY, n INT, rate REAL, timestamps INT)''',
+    '''CREATE TABLE IF NOT EXISTS %(schema)s.binary_codec (id INTEGER PRIMARY KEY, codec INT)''',
+]
+
+
+def shard_fname(fname, n):
+    """File name of the nth shard of a database, e.g. exp.db -> exp.shard0003.db"""
+    root, ext = os.path.splitext(fname)
+    return "%s.shard%04d%s" % (root, n, ext or ".db")
+
+
+def shard_path(main_fname, shard_fname):
+    """Full path of a shard listed in the catalog; shards are stored relative to the main database"""
+    return os.path.join(os.path.dirname(os.path.abspath(main_fname)), shard_fname)
+
+
+class ShardPolicy(object):
+    """Writes the sample data of an ExperimentLog (log, binary, binary_array, chunk and the typed column
+    tables) into shard databases, attached to the log's connection with ATTACH DATABASE. The main database
+    keeps the sessions, metadata and runs, and lists the shards in the `shards` table.
+
+    Parameters:
+        per_run: If True, every run (each ExperimentLog opened on the file) starts a new shard
+        max_size: Start a new shard once the current one is larger than this many bytes (None for no limit)
+        check_interval: Seconds between checks of the shard size, which are made after commits
+        checkpoint_size: In WAL mode, checkpoint the shard's WAL once it is larger than this many bytes
+
+    A shard is only ever switched between transactions, so each commit lands in exactly one shard.
+    """
+
+    def __init__(self, per_run=True, max_size=None, check_interval=1.0, checkpoint_size=4 << 20):
+        self.per_run = per_run
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.checkpoint_size = checkpoint_size
+
+        self.explog = None
+        self.current = None
+        self.path = None
+        self.next_check = 0
+        self.rollovers = 0
+
+    @classmethod
+    def from_option(cls, shards):
+        """Policy for the `shards` option of ExperimentLog: "run", or a maximum shard size in bytes"""
+        if shards == "run":
+            return cls(per_run=True)
+        if isinstance(shards, int) and shards > 0:
+            return cls(per_run=False, max_size=shards)
+        raise ValueError("Unknown shards option %r; should be 'run', a size in bytes or a ShardPolicy" % (shards,))
+
+    def __repr__(self):
+        return "ShardPolicy(per_run=%s, max_size=%s)" % (self.per_run, self.max_size)
+
+    # the methods below are called with the log's db_lock held, and no transaction open
+
+    def attach(self, explog):
+        """Start writing the log's sample data to a shard, reusing the last one unless it is full
+        (or per_run is set)."""
+        self.explog = explog
+        last = explog._execute("SELECT id, fname FROM shards ORDER BY id DESC LIMIT 1").fetchone()
+        if last is not None:
+            self._attach(last[0], shard_path(explog.fname, last[1]))
+            if not self.per_run and not self._full():
+                logger.debug("Continuing shard %s" % self.path)
+                explog._execute("UPDATE shards SET closed=NULL WHERE id=?", (self.current,))
+                explog.conn.commit()
+                explog.set_data_schema(SHARD_SCHEMA)
+                return
+        self.rollover()
+
+    def rollover(self):
+        """Close the current shard and start a new one."""
+        explog = self.explog
+        explog.conn.commit()
+        log_seq, binary_seq = self._sequences()
+        if self.current is not None:
+            self.close()
+            explog.conn.commit()
+            if explog.index_manager is not None:
+                explog.index_manager.shard_closing(SHARD_SCHEMA, self.path)
+            explog._execute("DETACH DATABASE %s" % SHARD_SCHEMA)
+
+        n = (explog._execute("SELECT max(id) FROM shards").fetchone()[0] or 0) + 1
+        fname = shard_fname(os.path.basename(explog.fname), n)
+        self._attach(n, shard_path(explog.fname, fname))
+        # continue the ids from the previous shard
+        explog._execute("DELETE FROM %s.sqlite_sequence" % SHARD_SCHEMA)
+        explog.cursor.executemany("INSERT INTO %s.sqlite_sequence(name, seq) VALUES (?, ?)" % SHARD_SCHEMA,
+                                  [("log", log_seq), ("binary", binary_seq)])
+        explog._execute("INSERT INTO shards(id, fname, run, created, first_log, first_binary) VALUES (?, ?, ?, ?, ?, ?)",
+                        (n, fname, explog.run_id, explog.real_time(), log_seq + 1, binary_seq + 1))
+        explog.conn.commit()
+        explog.set_data_schema(SHARD_SCHEMA)
+        self.rollovers += 1
+        logger.debug("Writing sample data to shard %s" % self.path)
+
+    def check(self):
+        """Called after each commit; starts a new shard if the current one is full."""
+        if self.current is None:
+            return
+        now = time.time()
+        if now < self.next_check:
+            return
+        self.next_check = now + self.check_interval
+        if self.explog.wal and wal_size(self.path) > self.checkpoint_size:
+            self.explog._execute("PRAGMA %s.wal_checkpoint(PASSIVE)" % SHARD_SCHEMA)
+        if self._full():
+            self.rollover()
+
+    def close(self):
+        """Mark the current shard as closed in the catalog (committed by the caller)."""
+        if self.current is not None:
+            self.explog._execute("UPDATE shards SET closed=? WHERE id=?", (self.explog.real_time(), self.current))
+
+    def _attach(self, n, path):
+        explog = self.explog
+        explog._execute("ATTACH DATABASE ? AS %s" % SHARD_SCHEMA, (path,))
+        if explog.wal:
+            explog._execute("PRAGMA %s.journal_mode=WAL" % SHARD_SCHEMA)
+        explog._execute("PRAGMA %s.synchronous=%s" % (SHARD_SCHEMA, explog.synchronous))
+        # also brings shards written by older versions up to date
+        for table in SHARD_TABLES:
+            explog._execute(table % {"schema": SHARD_SCHEMA})
+        explog._create_typed_tables(SHARD_SCHEMA)
+        self.current = n
+        self.path = path
+
+    def _full(self):
+        return self.max_size is not None and os.path.getsize(self.path) + wal_size(self.path) >= self.max_size
+
+    def _sequences(self):
+        """The last (log, binary) ids written so far, in the current shard or the main database"""
+        if self.current is None:
+            return tuple(self.explog._execute("SELECT max(id) FROM main.%s" % table).fetchone()[0] or 0
+                         for table in ("log", "binary"))
+        seqs = dict(self.explog._execute("SELECT name, seq FROM %s.sqlite_sequence" % SHARD_SCHEMA).fetchall())
+        return seqs.get("log", 0), seqs.get("binary", 0)
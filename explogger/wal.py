@@ -0,0 +1,129 @@
+import collections
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('explogger')
+
+CHECKPOINT_MODES = ("PASSIVE", "FULL", "RESTART", "TRUNCATE")
+
+# one checkpoint: when it ran, how long it took, the mode used, the WAL size before and after it,
+# and the (busy, log frames, checkpointed frames) result from SQLite
+Checkpoint = collections.namedtuple('Checkpoint', ['time', 'duration', 'mode', 'wal_before', 'wal_after',
+                                                   'busy', 'log_frames', 'checkpointed_frames'])
+
+
+def wal_size(fname):
+    """Size in bytes of the write-ahead log of a database (0 if there is none)"""
+    try:
+        return os.path.getsize(fname + "-wal")
+    except OSError:
+        return 0
+
+
+class CheckpointScheduler(object):
+    """Background thread which checkpoints a WAL mode database from its own connection, so that
+    the WAL stays bounded while the logger keeps writing and readers keep reading.
+
+    Parameters:
+        interval: seconds between checks of the WAL size
+        passive_size: run a PASSIVE checkpoint (which never waits for readers or writers)
+                      once the WAL is larger than this many bytes
+        truncate_size: run a TRUNCATE checkpoint (which waits for the writer and then resets
+                       the WAL file to zero bytes) once the WAL is larger than this many bytes.
+                       None to only use passive checkpoints.
+        busy_timeout: seconds the checkpointing connection waits for locks
+        history: number of recent checkpoints to keep in `history`
+    """
+
+    def __init__(self, interval=1.0, passive_size=4 << 20, truncate_size=64 << 20, busy_timeout=1.0, history=1000):
+        self.interval = interval
+        self.passive_size = passive_size
+        self.truncate_size = truncate_size
+        self.busy_timeout = busy_timeout
+        self.history = collections.deque(maxlen=history)
+
+        self.fname = None
+        self.conn = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+        self.checkpoints = 0
+        self.busy = 0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+        self.max_wal_size = 0
+
+    def __repr__(self):
+        return "CheckpointScheduler(interval=%s, passive_size=%s, truncate_size=%s)" % (
+            self.interval, self.passive_size, self.truncate_size)
+
+    def start(self, fname):
+        """Start checkpointing the given database file."""
+        self.fname = fname
+        self.conn = sqlite3.connect(fname, check_same_thread=False, timeout=self.busy_timeout)
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name="explogger-checkpoint")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, final_mode="TRUNCATE"):
+        """Stop the thread, running one last checkpoint (unless final_mode is None)."""
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        if final_mode is not None:
+            self.checkpoint(final_mode)
+        self.conn.close()
+        self.conn = None
+
+    def checkpoint(self, mode="PASSIVE"):
+        """Run a checkpoint now, returning its Checkpoint record."""
+        if mode not in CHECKPOINT_MODES:
+            raise ValueError("Unknown checkpoint mode '%s'; should be one of %s" % (mode, CHECKPOINT_MODES))
+        with self.lock:
+            before = wal_size(self.fname)
+            start = time.time()
+            try:
+                busy, log_frames, checkpointed = self.conn.execute("PRAGMA wal_checkpoint(%s)" % mode).fetchone()
+            except sqlite3.OperationalError as e:
+                # the writer held the lock for longer than busy_timeout
+                logger.debug("%s checkpoint failed: %s" % (mode, e))
+                busy, log_frames, checkpointed = 1, -1, -1
+            duration = time.time() - start
+            record = Checkpoint(start, duration, mode, before, wal_size(self.fname), busy, log_frames, checkpointed)
+
+            self.history.append(record)
+            self.checkpoints += 1
+            self.busy += busy
+            self.total_duration += duration
+            self.max_duration = max(self.max_duration, duration)
+            self.max_wal_size = max(self.max_wal_size, before)
+        logger.debug("%s checkpoint: %.1fms, WAL %d -> %d bytes, %d/%d frames" % (
+            mode, duration * 1000, before, record.wal_after, checkpointed, log_frames))
+        return record
+
+    def stats(self):
+        """Return a dictionary summarising the WAL size and checkpoint durations"""
+        with self.lock:
+            return {"wal_size": wal_size(self.fname) if self.fname else 0,
+                    "max_wal_size": self.max_wal_size,
+                    "checkpoints": self.checkpoints,
+                    "busy": self.busy,
+                    "total_duration": self.total_duration,
+                    "mean_duration": self.total_duration / self.checkpoints if self.checkpoints else 0.0,
+                    "max_duration": self.max_duration}
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            size = wal_size(self.fname)
+            self.max_wal_size = max(self.max_wal_size, size)
+            if self.truncate_size is not None and size > self.truncate_size:
+                self.checkpoint("TRUNCATE")
+            elif self.passive_size is not None and size > self.passive_size:
+                self.checkpoint("PASSIVE")
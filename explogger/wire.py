@@ -0,0 +1,211 @@
+import math
+import pickle
+import struct
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .core import array_header, buffer_to_np
+
+# the first byte of a call's first frame: how the rest of the frame is encoded
+PICKLE = b"p"
+MSGPACK = b"m"
+LOG = b"l"
+LOG_BATCH = b"b"
+
+# a log() call: [LOG][serializer of the body][stream id, uint32][t, NaN for None][valid][1 if a binary frame follows]
+# followed by the body, the serialized [data, tag]
+LOG_HEADER = struct.Struct(">ccIdBB")
+
+NAN = float("nan")
+
+# a batch of log records: [LOG_BATCH][serializer of the body], followed by the serialized list of
+# [stream id, t, data, tag, valid, binary] records
+
+# msgpack extension type of an array sent in a separate frame
+ARRAY_EXT = 1
+
+# pickle protocol 5 hands contiguous buffers (e.g. NumPy arrays) out as separate frames
+OUT_OF_BAND = pickle.HIGHEST_PROTOCOL >= 5
+
+
+class PickleSerializer(object):
+    """Encodes calls with pickle. NumPy arrays are passed out of band (into `buffers`), so they can be sent
+    as separate frames without being copied."""
+    format = PICKLE
+
+    def dumps(self, obj, buffers):
+        if OUT_OF_BAND:
+            return pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        return pickle.dumps(obj, protocol=-1)
+
+    def loads(self, data, buffers):
+        if OUT_OF_BAND and buffers:
+            return pickle.loads(data, buffers=buffers)
+        return pickle.loads(data)
+
+
+class MsgpackSerializer(object):
+    """Encodes calls with msgpack, which is more compact than pickle for the dicts of JSON-like values
+    logged as samples (64 rather than 95 bytes for a small log() call), but no faster. NumPy arrays are passed out of band (into `buffers`); anything
+    else msgpack cannot encode raises TypeError (and the call is then pickled instead). Tuples come back
+    as lists."""
+    format = MSGPACK
+
+    def __init__(self):
+        if msgpack is None:
+            raise ValueError("The msgpack module is not available")
+        # one packer, reused for every call; `buffers` is the list of the call being packed
+        self.packer = msgpack.Packer(default=self._default, use_bin_type=True)
+        self.buffers = None
+
+    def _default(self, value):
+        if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+            dtype, shape, fortran = array_header(value)
+            self.buffers.append(value.ravel(order='F' if fortran else 'C'))
+            return msgpack.ExtType(ARRAY_EXT, msgpack.packb([len(self.buffers) - 1, dtype, shape, fortran]))
+        if isinstance(value, np.generic):
+            return value.item()
+        raise TypeError("Cannot encode %s with msgpack" % type(value).__name__)
+
+    def dumps(self, obj, buffers):
+        self.buffers = buffers
+        try:
+            return self.packer.pack(obj)
+        finally:
+            self.buffers = None
+
+    def loads(self, data, buffers):
+        if not buffers:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+        def ext_hook(code, payload):
+            if code == ARRAY_EXT:
+                index, dtype, shape, fortran = msgpack.unpackb(payload, raw=False)
+                return buffer_to_np(buffers[index], dtype, shape, fortran)
+            return msgpack.ExtType(code, payload)
+        return msgpack.unpackb(data, ext_hook=ext_hook, raw=False, strict_map_key=False)
+
+
+SERIALIZERS = {"pickle": PickleSerializer, "msgpack": MsgpackSerializer}
+
+
+def get_serializer(serializer=None):
+    """Serializer for the `serializer` option of LogProxy and LogProxyPub: "pickle", "msgpack", a
+    serializer object, or None for pickle"""
+    if serializer is None:
+        serializer = "pickle"
+    if not isinstance(serializer, str):
+        return serializer
+    if serializer not in SERIALIZERS:
+        raise ValueError("Unknown serializer '%s'; should be one of %s" % (serializer, sorted(SERIALIZERS)))
+    return SERIALIZERS[serializer]()
+
+
+# the serializer of each format, for decoding
+_pickle = PickleSerializer()
+_decoders = {PICKLE: _pickle}
+if msgpack is not None:
+    _decoders[MSGPACK] = MsgpackSerializer()
+
+
+def _log_fields(stream, t=None, valid=True, data=None, tag="", binary=None):
+    # the signature of ExperimentLog.log(), which binds the arguments of a call
+    return stream, t, valid, data, tag, binary
+
+
+def encode_log(serializer, args, kwargs, stream_id):
+    """Frames for a log() call, or None if it cannot be packed into a LOG frame (the call is then
+    encoded like any other, and the server checks its arguments)"""
+    try:
+        stream, t, valid, data, tag, binary = _log_fields(*args, **kwargs)
+        t = NAN if t is None else float(t)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(stream, str) or (valid is not True and valid is not False):
+        return None
+    buffers = []
+    try:
+        body = serializer.dumps([data, tag], buffers)
+    except TypeError:
+        serializer = _pickle
+        buffers = []
+        body = serializer.dumps([data, tag], buffers)
+    header = LOG_HEADER.pack(LOG, serializer.format, stream_id(stream), t, valid, binary is not None)
+    # the binary goes first, then any buffers of the body
+    return [header + body] + ([binary] if binary is not None else []) + buffers
+
+
+def encode_log_batch(serializer, records):
+    """Frames for a batch of log records, lists of [stream id, t, data, tag, valid, binary], which the
+    server writes with one log_many() call"""
+    buffers = []
+    try:
+        body = serializer.dumps(records, buffers)
+    except TypeError:
+        serializer = _pickle
+        buffers = []
+        body = serializer.dumps(records, buffers)
+    return [LOG_BATCH + serializer.format + body] + buffers
+
+
+def encode_call(serializer, cmd, args, kwargs, stream_id=None):
+    """Encode a call of an ExperimentLog method as a list of frames: the encoded call, followed by the
+    raw buffers of any arrays (and binaries) it passes, which can be sent without copying.
+
+    Parameters:
+        serializer: PickleSerializer or MsgpackSerializer; calls msgpack cannot encode are pickled
+        cmd, args, kwargs: the method name and its arguments
+        stream_id: function returning the id of a stream, given its name. If given, log() calls are
+                   sent as compact LOG frames, which carry the stream id rather than its name.
+    """
+    if cmd == "log" and stream_id is not None:
+        frames = encode_log(serializer, args, kwargs, stream_id)
+        if frames is not None:
+            return frames
+    buffers = []
+    try:
+        payload = serializer.dumps([cmd, args, kwargs], buffers)
+    except TypeError:
+        serializer = _pickle
+        buffers = []
+        payload = serializer.dumps([cmd, args, kwargs], buffers)
+    return [serializer.format + payload] + buffers
+
+
+def decode_call(frames, stream_name):
+    """Decode the frames of a call made by encode_call().
+
+    Parameters:
+        frames: the frames, as bytes or buffers (e.g. zmq.Frame.buffer, so arrays are not copied)
+        stream_name: function returning the name of a stream, given its id
+
+    Returns:
+        (cmd, args, kwargs)
+    """
+    first = frames[0]
+    kind = bytes(first[:1])
+    if kind == LOG:
+        _, body_format, stream, t, valid, has_binary = LOG_HEADER.unpack_from(first)
+        data, tag = _decoder(body_format).loads(first[LOG_HEADER.size:], frames[1 + has_binary:])
+        kwargs = {"t": None if math.isnan(t) else t, "valid": bool(valid), "data": data, "tag": tag}
+        if has_binary:
+            kwargs["binary"] = frames[1]
+        return "log", (stream_name(stream),), kwargs
+    if kind == LOG_BATCH:
+        records = _decoder(bytes(first[1:2])).loads(first[2:], frames[1:])
+        for record in records:
+            record[0] = stream_name(record[0])
+        return "log_many", (records,), {}
+    cmd, args, kwargs = _decoder(kind).loads(first[1:], frames[1:])
+    return cmd, args, kwargs
+
+
+def _decoder(kind):
+    if kind not in _decoders:
+        raise ValueError("Cannot decode a call in format %r" % kind)
+    return _decoders[kind]
@@ -0,0 +1,152 @@
+import collections
+import itertools
+import logging
+import threading
+
+from six.moves import queue
+
+logger = logging.getLogger('explogger')
+
+# what to do with a new record when the queue is full
+QUEUE_POLICIES = ("block", "drop", "spill")
+
+
+class LogWriter(object):
+    """Background thread which drains queued log records into an ExperimentLog.
+
+    The caller only pays for a queue put; the writer thread takes the database lock
+    and writes everything that is waiting in one bulk insert.
+
+    Parameters:
+        explog: the ExperimentLog to write to
+        queue_size: maximum number of records waiting in the queue
+        policy: what log() does when the queue is full:
+                "block": wait for space in the queue
+                "drop":  discard the record (counted in `dropped`)
+                "spill": keep the record in an unbounded overflow list. Records logged while the
+                         list is not empty go to it too, so records are written in the order logged.
+        max_batch: maximum number of records written per bulk insert
+    """
+
+    def __init__(self, explog, queue_size=100000, policy="block", max_batch=10000):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("Unknown queue policy '%s'; should be one of %s" % (policy, QUEUE_POLICIES))
+        self.explog = explog
+        self.policy = policy
+        self.max_batch = max_batch
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.overflow = collections.deque()
+        self.dropped = 0
+        # the last write failure, and the number of records it (and any others) discarded since
+        # the last flush(); log() reports the failure once, flush() and stop() whenever records were lost
+        self.error = None
+        self.error_reported = False
+        self.lost = 0
+
+        # number of records accepted but not yet written
+        self.pending = 0
+        self.pending_cv = threading.Condition()
+
+        self.thread = threading.Thread(target=self._run, name="explogger-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, session_id, record):
+        """Queue a (stream, t, data, tag, valid, binary) record for the given session."""
+        if self.error is not None and not self.error_reported:
+            self.error_reported = True
+            raise self.error
+        with self.pending_cv:
+            self.pending += 1
+        item = (session_id, record)
+        if self.policy == "block":
+            self.queue.put(item)
+            return
+        if self.policy == "spill" and self.overflow:
+            # behind the records already spilled, which are written once the queue is empty
+            self.overflow.append(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if self.policy == "spill":
+                self.overflow.append(item)
+            else:
+                if self.dropped == 0:
+                    logger.warning("Log queue full; dropping records")
+                self.dropped += 1
+                self._done(1)
+
+    def flush(self):
+        """Block until every queued record has been written. Raises the last write failure if any records
+        were discarded since the previous flush()."""
+        with self.pending_cv:
+            while self.pending > 0 and self.thread.is_alive():
+                self.pending_cv.wait(0.1)
+            error, lost = self.error, self.lost
+            if lost:
+                self.error, self.error_reported, self.lost = None, False, 0
+        if lost:
+            logger.error("%d queued log records were not written" % lost)
+            raise error
+
+    def stop(self):
+        """Write any remaining records and stop the writer thread. Raises like flush() if records were lost."""
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+
+    def _done(self, n):
+        with self.pending_cv:
+            self.pending -= n
+            if self.pending <= 0:
+                self.pending_cv.notify_all()
+
+    def _take(self):
+        """Block for the next record, then take everything else that is waiting (up to max_batch).
+        Overflowed records are taken after the queue has been emptied; they were all logged after the
+        records in the queue."""
+        batch = []
+        if not self.overflow:
+            batch.append(self.queue.get())
+        try:
+            while len(batch) < self.max_batch:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        while self.overflow and len(batch) < self.max_batch:
+            batch.append(self.overflow.popleft())
+        return batch
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = self._take()
+            if None in batch:
+                stopping = True
+                batch = [item for item in batch if item is not None]
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    logger.error("Background log writer failed: %s" % e)
+                    with self.pending_cv:
+                        self.error, self.error_reported = e, False
+                        self.lost += len(batch)
+                self._done(len(batch))
+
+    def _write(self, batch):
+        explog = self.explog
+        with explog.db_lock:
+            if explog.multi_writer:
+                explog._retry(self._insert, batch)
+            else:
+                self._insert(batch)
+            explog.commit_policy.wrote(len(batch))
+
+    def _insert(self, batch):
+        # consecutive records from the same session go in one bulk insert
+        for session_id, items in itertools.groupby(batch, key=lambda item: item[0]):
+            self.explog._insert_many([record for _, record in items], session_id=session_id)
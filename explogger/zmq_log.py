@@ -1,26 +1,77 @@
 import time
 import sys
+import struct
+import pickle
 import logging
+import itertools
+import threading
+import uuid
+import inspect
 from multiprocessing import Process
 import zmq
 import traceback
 
 import collections
 
-from .core import ExperimentLog, MetaProxy, logger
+from .core import ExperimentLog, ExperimentException, MetaProxy, logger
 
-from .extract import meta_dataframe
+from . import extract
+from .extract import meta_dataframe, open_reader, shard_files
+from .wire import encode_call, encode_log_batch, decode_call, get_serializer
 
-# Port used for ZMQ communication
-ZMQ_PORT_REPREQ = 3149
+# Ports used for ZMQ communication
+ZMQ_PORT_ROUTER = 3149
 ZMQ_PORT_PUBSUB = 3150
+ZMQ_PORT_QUERY = 3151
+# older name of the request port, from when it was served by a REP socket
+ZMQ_PORT_REPREQ = ZMQ_PORT_ROUTER
 
+# the first frame of each message between LogProxy and the server
+# (the call itself follows, encoded by wire.encode_call())
+CALL = b"C"     # proxy -> server: a call whose result is sent back in a REPLY
+SEND = b"S"     # proxy -> server: a fire-and-forget call; only a failure is sent back (in a REPLY)
+REPLY = b"R"    # server -> proxy: the (success, value) result of one request
+ACK = b"A"      # server -> proxy: every request up to this id has been applied and committed
+CREDIT = b"K"   # server -> proxy of a LogProxyPub: the sequence number of the next published message
+                # it expects; every message before it has been applied and committed
+
+# the second frame: the request (correlation) id, numbered from 1 by each proxy
+REQUEST_ID = struct.Struct(">Q")
+
+# the query workers of the server take the queries from this socket, inside the server process
+QUERY_BACKEND = "inproc://explogger-queries"
+
+# messages published by LogProxyPub: [PUB_HEADER, call frames...]. The header holds the publisher's id
+# (32 hex digits), the message's sequence number (numbered from 1 by each publisher), the number of
+# records published before it, the number of records in it, and flags
+PUB_HEADER = struct.Struct(">32sQQIB")
+FLOW_CONTROL = 1    # the publisher waits for credit: send a CREDIT once the message is committed
+PROBE = 2           # no call follows; the sequence number is the next one, and a CREDIT is sent back
+
+# calls whose return value is not needed; LogProxy sends them without waiting, and returns None
+ONEWAY = frozenset(["log", "log_array", "log_chunk", "log_many", "set_meta", "sync_ext", "bind", "unbind"])
+
+# attributes of ExperimentLog which LogProxy reads as values rather than calls
+PROPERTIES = frozenset(['bindings', 'session_path', 'session_id', 't', 'in_run', 'random_seed', 'time_offset'])
+
+# functions of extract.py which LogProxy.query() calls on the server's database, as fn(cursor, *args, **kwargs)
+QUERY_FUNCTIONS = frozenset(['get_logs', 'dump', 'dumpflat', 'dump_flat_dataframe', 'samples_dataframe', 'iter_samples',
+                             'dump_sessions', 'dump_sessions_dataframe', 'map_children_sessions', 'session_tree',
+                             'paths', 'dump_dataframe', 'meta', 'meta_dataframe', 'stream_schemas',
+                             'typed_stream_dataframe', 'load_array', 'stream_arrays', 'chunked_stream',
+                             'chunked_stream_dataframe', 'full_scans'])
+
+
+# options of ZMQLog for the server itself (see start_experiment()), rather than the ExperimentLog
+SERVER_OPTIONS = ("max_batch", "rcvhwm", "query_workers")
 
 
 class ZMQLog(object):
     def __init__(self, *args, **kwargs):
-        """Start the log server. Objects to access the server are produced by get_proxy()"""
-        self.process = Process(target=start_experiment, args=(args, kwargs))
+        """Start the log server. Objects to access the server are produced by get_proxy().
+        The arguments are those of ExperimentLog, and the SERVER_OPTIONS of start_experiment()."""
+        options = dict((k, kwargs.pop(k)) for k in SERVER_OPTIONS if k in kwargs)
+        self.process = Process(target=start_experiment, args=(args, kwargs), kwargs=options)
         self.process.start()
 
     def get_proxy(self):
@@ -32,86 +83,457 @@ class ZMQLog(object):
     #     self.process.
 
 
+def apply_call(e, cmd, args, kwargs):
+    """Call a method of the log (or read one of its attributes) for a remote request"""
+    if cmd == "meta_dataframe":
+        return meta_dataframe(e.cursor)
+    if cmd == "stream_id":
+        # for the LOG frames of wire.encode_call()
+        with e.db_lock:
+            return e._stream_id(*args)
+    fn = getattr(e, cmd)
+    if callable(fn):
+        return fn(*args, **kwargs)
+    return fn
+
+
+def apply_query(cursor, cmd, args, kwargs):
+    """Call one of the QUERY_FUNCTIONS for a remote query; generators are read to the end, into a list"""
+    if cmd not in QUERY_FUNCTIONS:
+        raise ExperimentException("Unknown query '%s'" % cmd)
+    result = getattr(extract, cmd)(cursor, *args, **kwargs)
+    if inspect.isgenerator(result):
+        result = list(result)
+    return result
+
+
+def encode_result(result):
+    """The pickled (success, value) result of a request, for a REPLY"""
+    try:
+        return pickle.dumps(result, protocol=-1)
+    except Exception:
+        return pickle.dumps(failure(), protocol=-1)
+
+
+def failure():
+    """The (False, (exception, traceback)) result of a request which raised the exception being handled"""
+    info = sys.exc_info()
+    tb = "\n".join(traceback.format_exception(*info, limit=20))
+    return (False, (info[1], tb))
+
+
+def drain(socket, max_messages, n_copied):
+    """Receive the multipart messages waiting on a socket, without blocking, up to max_messages.
+    The first n_copied frames of each message are received as bytes; any frames after them (the
+    buffers of arrays and binaries) as memoryviews of the received zmq.Frame, so they are not copied."""
+    messages = []
+    while len(messages) < max_messages:
+        try:
+            frames = [socket.recv(zmq.NOBLOCK)]
+        except zmq.Again:
+            break
+        while socket.get(zmq.RCVMORE):
+            if len(frames) < n_copied:
+                frames.append(socket.recv())
+            else:
+                frames.append(socket.recv(copy=False).buffer)
+        messages.append(frames)
+    return messages
+
+
+class PublisherStats(object):
+    """The messages received by the server from one LogProxyPub, and those lost (dropped at a high-water
+    mark), counted from the gaps in the sequence numbers of the messages"""
+
+    def __init__(self, publisher):
+        self.publisher = publisher
+        self.next_sequence = 1
+        self.next_record = 0
+        self.messages = 0
+        self.records = 0
+        self.dropped = 0
+        self.dropped_records = 0
+        self.first_time = time.time()
+        # id of the publisher's row in the publisher_stats table, and whether the row is out of date
+        self.row_id = None
+        self.changed = True
+
+    def received(self, sequence, first_record, n_records, probe=False):
+        """Count a published message (or probe); returns the number of messages, and of records, lost before it"""
+        lost = max(0, sequence - self.next_sequence)
+        lost_records = first_record - self.next_record if lost else 0
+        if lost:
+            self.dropped += lost
+            self.dropped_records += lost_records
+            self.changed = True
+        if sequence >= self.next_sequence:
+            self.next_sequence = sequence if probe else sequence + 1
+            self.next_record = first_record + n_records
+        if not probe:
+            self.messages += 1
+            self.records += n_records
+            self.changed = True
+        return lost, lost_records
+
+    def save(self, e):
+        """Write the counts to the publisher_stats table of the log, for its current run"""
+        values = (self.messages, self.records, self.dropped, self.dropped_records, time.time())
+        if self.row_id is None:
+            self.row_id = e.execute("INSERT INTO publisher_stats(messages, records, dropped, dropped_records, last_time, "
+                                    "run, publisher, first_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    values + (e.run_id, self.publisher.decode(), self.first_time)).lastrowid
+        else:
+            e.execute("UPDATE publisher_stats SET messages=?, records=?, dropped=?, dropped_records=?, last_time=? "
+                      "WHERE id=?", values + (self.row_id,))
+        self.changed = False
+
+
+class QueryReader(object):
+    """A read-only connection to a log database for answering queries (see extract.open_reader()), with
+    all of its shards attached; reopened when the log gains shards as it is written."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.conn = open_reader(fname)
+        self.shards = shard_files(self.conn.cursor())
+
+    def query(self, cmd, args, kwargs):
+        """Answer a query in one read transaction, which sees everything committed before it started"""
+        if shard_files(self.conn.cursor()) != self.shards:
+            self.conn.close()
+            self.conn = open_reader(self.fname)
+            self.shards = shard_files(self.conn.cursor())
+        self.conn.execute("BEGIN")
+        try:
+            return apply_query(self.conn.cursor(), cmd, args, kwargs)
+        finally:
+            self.conn.rollback()
 
-def start_experiment(args, kwargs):
+    def close(self):
+        self.conn.close()
+
+
+def serve_queries(context, fname):
+    """Query worker: answers the queries passed on by the server's query socket, with a read-only
+    connection to the log database, until the context is terminated.
+
+    The messages are [identity, CALL, request id, call frames...], as LogProxy sends them."""
+    socket = context.socket(zmq.DEALER)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(QUERY_BACKEND)
+    reader = QueryReader(fname)
+    try:
+        while True:
+            frames = socket.recv_multipart()
+            identity, kind, request_id = frames[:3]
+            try:
+                cmd, cmd_args, cmd_kwargs = decode_call(frames[3:], None)
+                result = (True, reader.query(cmd, cmd_args, cmd_kwargs))
+            except Exception:
+                result = failure()
+            socket.send_multipart([identity, REPLY, request_id, encode_result(result)])
+    except zmq.ContextTerminated:
+        pass
+    finally:
+        socket.close()
+        reader.close()
+
+
+def forward_queries(frontend, backend):
+    """Pass queries from the query socket to the workers, and their replies back, until the context is terminated"""
+    try:
+        zmq.proxy(frontend, backend)
+    except zmq.ContextTerminated:
+        pass
+    finally:
+        frontend.close()
+        backend.close()
+
+
+def start_experiment(args, kwargs, max_batch=10000, rcvhwm=1000, query_workers=2):
     """Launch the ExperimentLog as a 0MQ server.
-    This expects tuples of (fn, *args, **kwargs) to come in on port ZMQ_PORT as
-    Python objects (using recv_pyobj() / send_pyobj())
 
-    It responds with a (success, return_value) tuple. Success is True if no
-    exception was thrown, and False if one was thrown. In the case of an exception,
-    the second argument (return_value) is a tuple (exception, traceback).
+    Requests come in on a ROUTER socket on port ZMQ_PORT_ROUTER, from the DEALER sockets of LogProxy
+    objects, as multipart messages [CALL or SEND, request id, call frames...], where the call frames
+    are (cmd, args, kwargs) as encoded by wire.encode_call(). Each poll
+    takes every message waiting (up to max_batch), from every proxy, applies them in the order they
+    arrived, and commits once for the whole batch.
+
+    Then, for each CALL, it responds with [REPLY, request id, pickled (success, return_value)]. Success is
+    True if no exception was thrown, and False if one was thrown. In the case of an exception, the
+    second argument (return_value) is a tuple (exception, traceback). A SEND only gets a REPLY if it
+    failed. Finally each proxy gets [ACK, request id] for the last of its requests in the batch.
+
+    Calls published by LogProxyPub to the SUB socket on port ZMQ_PORT_PUBSUB, as [PUB_HEADER, call
+    frames...], are applied in the same batches, after the requests; they get no
+    response. Gaps in each publisher's sequence numbers are messages dropped on the way, which are
+    logged as warnings and counted, for the run, in the publisher_stats table. Publishers which ask for
+    flow control (and probes) get [CREDIT, next sequence number] on the ROUTER socket, sent to the
+    proxy whose identity is the publisher id. A close() request is applied last, so the records
+    published before it are written.
+
+    Queries (LogProxy.query()) come in on a separate ROUTER socket, on port ZMQ_PORT_QUERY, as
+    [CALL, request id, call frames...], and get a REPLY. If the log is in WAL mode, they are answered
+    by query_workers threads (see serve_queries()), each with its own read-only connection, so slow
+    queries do not hold up the writes. Otherwise they are answered by the server loop between batches,
+    with the log's own connection (or, if the log is sharded, a QueryReader, which sees the shards).
+
+    Parameters:
+        args, kwargs: arguments of the ExperimentLog
+        max_batch: maximum number of messages of each kind applied in one transaction
+        rcvhwm: number of published messages queued, for each publisher, before further messages
+                are dropped (0 for no limit)
+        query_workers: number of threads answering queries, if the log is in WAL mode
     """
-
-    stopped = False
     # set up the server to handle incoming requests with polling
     context = zmq.Context()
 
-    rep = context.socket(zmq.REP)
-    rep.bind("tcp://*:%s" % ZMQ_PORT_REPREQ)
+    router = context.socket(zmq.ROUTER)
+    # a ROUTER drops messages to a proxy whose queue is full; replies must never be dropped
+    router.setsockopt(zmq.SNDHWM, 0)
+    router.bind("tcp://*:%s" % ZMQ_PORT_ROUTER)
 
+    # publishers connect to the server, so there can be any number of them
     sub = context.socket(zmq.SUB)
-    sub.connect("tcp://127.0.0.1:{}".format(ZMQ_PORT_PUBSUB))
+    sub.setsockopt(zmq.RCVHWM, rcvhwm)
     sub.setsockopt_string(zmq.SUBSCRIBE, "")
+    sub.bind("tcp://*:%s" % ZMQ_PORT_PUBSUB)
 
     poll = zmq.Poller()
-    poll.register(rep, zmq.POLLIN)
+    poll.register(router, zmq.POLLIN)
     poll.register(sub, zmq.POLLIN)
 
+    queries = context.socket(zmq.ROUTER)
+    queries.setsockopt(zmq.SNDHWM, 0)
+    queries.bind("tcp://*:%s" % ZMQ_PORT_QUERY)
+
     # create the object
     e = ExperimentLog(*args, **kwargs)
-    while not stopped:
 
+    threads = []
+    if e.wal and query_workers > 0:
+        # the proxy thread and the workers own the query sockets from now on
+        backend = context.socket(zmq.DEALER)
+        backend.bind(QUERY_BACKEND)
+        for socket in (queries, backend):
+            socket.setsockopt(zmq.LINGER, 0)
+        threads.append(threading.Thread(target=forward_queries, args=(queries, backend), name="explogger-queries"))
+        threads += [threading.Thread(target=serve_queries, args=(context, e.fname), name="explogger-query-%d" % i)
+                    for i in range(query_workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        queries = None
+    else:
+        poll.register(queries, zmq.POLLIN)
+    # the sample data of a sharded log is only visible through a connection with the shards attached
+    reader = QueryReader(e.fname) if queries is not None and e.shard_policy is not None else None
+
+    # names of the streams given by id in LOG frames
+    stream_names = {}
+    def stream_name(stream_id):
+        if stream_id not in stream_names:
+            row = e.execute("SELECT name FROM stream WHERE id=?", (stream_id,)).fetchone()
+            if row is None:
+                raise ExperimentException("No stream with id %d" % stream_id)
+            stream_names[stream_id] = row[0]
+        return stream_names[stream_id]
+
+    # publisher id -> PublisherStats
+    publishers = {}
+
+    while e.opened:
         # poll
         socks = dict(poll.poll(500))  # 500 ms for timeout
-
-        if socks.get(rep) == zmq.POLLIN:
-            # loop, waiting for a request
-            cmd, args, kwargs = rep.recv_pyobj()
+        # [identity, kind, request id, call, buffers...] and [header, call, buffers...]
+        requests = drain(router, max_batch, 4) if socks.get(router) == zmq.POLLIN else []
+        published = drain(sub, max_batch, 2) if socks.get(sub) == zmq.POLLIN else []
+        if queries is not None and socks.get(queries) == zmq.POLLIN:
+            answer_queries(e, reader, queries, max_batch)
+        if not requests and not published:
+            continue
+
+        replies = []
+        # identity -> last request id, for the acknowledgements
+        acks = collections.OrderedDict()
+        # requests to close the log, applied after the rest of the batch
+        closing = []
+        for frames in requests:
+            identity, kind, request_id = frames[:3]
             try:
-
-                if cmd == "meta_dataframe":
-                    retval = meta_dataframe(e.cursor)
-                else:
-                    fn = getattr(e,cmd)
-                    if isinstance(fn, collections.Callable):
-                        retval = fn(*args, **kwargs)
-                    else:
-                        retval = fn
-
-                # send back the return value
-                rep.send_pyobj((True, retval), protocol=-1)
-
-            except:
-                # exception, return the full exception info
-                info = sys.exc_info()
-                tb = "\n".join(traceback.format_exception(*info, limit=20))
-                rep.send_pyobj((False, (info[1], tb)), protocol=-1)
-
-        if socks.get(sub) == zmq.POLLIN:
-            cmd, args, kwargs = sub.recv_pyobj()
+                cmd, cmd_args, cmd_kwargs = decode_call(frames[3:], stream_name)
+                if cmd == "close":
+                    # so that records published before close() are written first
+                    closing.append((identity, kind, request_id, cmd_args, cmd_kwargs))
+                    continue
+                result = (True, apply_call(e, cmd, cmd_args, cmd_kwargs))
+            except Exception:
+                result = failure()
+            if kind == CALL or not result[0]:
+                replies.append((identity, request_id, result))
+            acks[identity] = request_id
+
+        # publisher id -> sequence number to credit, and [messages, records] lost
+        credits = {}
+        lost = collections.OrderedDict()
+        for frames in published:
+            publisher, sequence, first_record, n_records, flags = PUB_HEADER.unpack(frames[0])
+            if publisher not in publishers:
+                publishers[publisher] = PublisherStats(publisher)
+            stats = publishers[publisher]
+            lost_messages, lost_records = stats.received(sequence, first_record, n_records, flags & PROBE)
+            if lost_messages:
+                counts = lost.setdefault(publisher, [0, 0])
+                counts[0] += lost_messages
+                counts[1] += lost_records
+            if flags & (FLOW_CONTROL | PROBE):
+                credits[publisher] = stats.next_sequence
+            if flags & PROBE:
+                continue
+            try:
+                cmd, cmd_args, cmd_kwargs = decode_call(frames[1:], stream_name)
+                apply_call(e, cmd, cmd_args, cmd_kwargs)
+            except Exception:
+                logger.error(failure()[1][1])
+
+        for publisher, (lost_messages, lost_records) in lost.items():
+            logger.warning("Lost %d messages (%d records) published by %s" % (lost_messages, lost_records, publisher.decode()))
+        if e.opened and e.in_run:
+            for stats in publishers.values():
+                if stats.changed:
+                    stats.save(e)
+
+        for identity, kind, request_id, cmd_args, cmd_kwargs in closing:
+            try:
+                result = (True, apply_call(e, "close", cmd_args, cmd_kwargs))
+            except Exception:
+                result = failure()
+            if kind == CALL or not result[0]:
+                replies.append((identity, request_id, result))
+            acks[identity] = request_id
+
+        # one commit for the batch (the log's commit policy may also have committed part-way through)
+        committed = True
+        if e.opened:
             try:
-                fn = getattr(e,cmd)
-                if isinstance(fn, collections.Callable):
-                    retval = fn(*args, **kwargs)
-            except:
-                print('error')
+                e.commit()
+            except Exception:
+                logger.error(failure()[1][1])
+                committed = False
+
+        for identity, request_id, result in replies:
+            router.send_multipart([identity, REPLY, request_id, encode_result(result)])
+        if committed:
+            for identity, request_id in acks.items():
+                router.send_multipart([identity, ACK, request_id])
+            for publisher, sequence in credits.items():
+                router.send_multipart([publisher, CREDIT, REQUEST_ID.pack(sequence)])
+
+    # give the last replies (e.g. to close()) time to be delivered
+    router.close(linger=1000)
+    sub.close(linger=0)
+    if queries is not None:
+        queries.close(linger=0)
+    if reader is not None:
+        reader.close()
+    # stops the query threads, which close their sockets
+    context.term()
+    for thread in threads:
+        thread.join()
+
+
+def answer_queries(e, reader, queries, max_batch):
+    """Answer the queries waiting on the query socket with the log's own connection, or with reader
+    (a QueryReader) if one is given"""
+    for frames in drain(queries, max_batch, 4):
+        identity, kind, request_id = frames[:3]
+        try:
+            cmd, cmd_args, cmd_kwargs = decode_call(frames[3:], None)
+            if reader is not None:
+                result = (True, reader.query(cmd, cmd_args, cmd_kwargs))
+            else:
+                with e.db_lock:
+                    result = (True, apply_query(e.cursor, cmd, cmd_args, cmd_kwargs))
+        except Exception:
+            result = failure()
+        queries.send_multipart([identity, REPLY, request_id, encode_result(result)])
+
+
+class PendingCall(object):
+    """The result of a call made with LogProxy.call_async(), which arrives later"""
 
-        # update stopped flag
-        stopped = not e.opened
+    def __init__(self, proxy, request_id):
+        self.proxy = proxy
+        self.request_id = request_id
 
+    def done(self):
+        """True if the reply has arrived"""
+        self.proxy._receive_ready()
+        return self.request_id in self.proxy.results
 
+    def result(self, timeout=None):
+        """Wait for the reply and return the call's return value, or raise the exception it raised"""
+        return self.proxy._wait(self.request_id, timeout)
 
 
 class LogProxy(object):
     """Proxy for an ExperimentLog object.
     Redirects calls and property accesses to the real, remote logging object
+
+    Calls which do not need a return value (those in ONEWAY: log(), log_many(), set_meta()...) are
+    sent without waiting for the server, and return None. If one of them fails, the exception is
+    raised by the next call that waits for the server. Other calls wait for their result; use
+    call_async() to send several of them before waiting. The calls from one proxy are applied
+    in the order they were made.
+
+    Calls are encoded with the serializer (see wire.encode_call()); log() calls carry the stream's id,
+    which is looked up once per stream. NumPy arrays (and binaries), whatever their size, are sent as
+    separate frames without being copied, so they must not be modified until the server has acknowledged them.
+
+    Queries (the QUERY_FUNCTIONS of extract.py, such as meta_dataframe() or samples_dataframe(), called
+    as proxy methods or with query()) go to the server's query socket, where they run alongside the
+    writes, and see everything sent by the proxy before them.
+
+    Parameters:
+        host: host running the server
+        port: port of the server's ROUTER socket
+        query_port: port of the server's query socket
+        timeout: seconds to wait for a reply before raising ExperimentException (None waits forever)
+        serializer: "pickle" (the default) or "msgpack" (see wire.get_serializer())
+        identity: identity of the proxy's socket, for the server; that of a LogProxyPub's proxy is its
+                  publisher id, so that the server can send it credit
     """
-    def __init__(self):
-        # connect to the server
-        self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REQ)
-        self.socket.connect("tcp://localhost:%s" % ZMQ_PORT_REPREQ)
+    def __init__(self, host="localhost", port=ZMQ_PORT_ROUTER, timeout=None, serializer=None, identity=None,
+                 query_port=ZMQ_PORT_QUERY):
+        # connect to the server; the process-wide context is shared by all proxies, so that a proxy
+        # which is garbage collected does not terminate a context of its own (which can block)
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.DEALER)
+        # unsent calls get this long (in ms) to reach the server when the proxy is disconnected
+        self.socket.setsockopt(zmq.LINGER, 1000)
+        # replies are never more than the requests sent, and must not be dropped
+        self.socket.setsockopt(zmq.RCVHWM, 0)
+        if identity is not None:
+            self.socket.setsockopt(zmq.IDENTITY, identity)
+        self.socket.connect("tcp://%s:%s" % (host, port))
+        # connected by the first query
+        self.query_socket = None
+        self.query_address = "tcp://%s:%s" % (host, query_port)
+        self.timeout = timeout
+        self.serializer = get_serializer(serializer)
+        self.stream_ids = {}
+
+        self.request_ids = itertools.count(1)
+        self.last_sent = 0
+        self.acknowledged = 0
+        # the sequence number of the next published message the server expects, from the LogProxyPub
+        # using this proxy (0 until the server has sent any CREDIT)
+        self.published = 0
+        # ids of the calls waiting for a reply, and the replies which have arrived but not been collected
+        self.waiting = set()
+        self.results = {}
+        # (exception, traceback) of failed fire-and-forget calls, not raised yet
+        self.errors = []
         # make metadata work the same way as in the ExperimentLog
         self.meta = MetaProxy(self)
 
@@ -120,51 +542,307 @@ class LogProxy(object):
             return
 
         # redirect properties
-        if attr in ['bindings', 'session_path', 'session_id', 't', 'in_run', 'random_seed']:
-            self.socket.send_pyobj((attr,(),()))
-            success, value = self.socket.recv_pyobj()
-            if success:
-                return value
-            else:
-                # deal with exceptions in the remote process
-                logging.error(value[1])
-                raise value[0]
+        if attr in PROPERTIES:
+            return self._call(attr, (), {})
+        elif attr in ONEWAY:
+            def send(*args, **kwargs):
+                self._raise_errors()
+                request_id = self._send(SEND, attr, args, kwargs)
+                # pick up acknowledgements (and failures) now and then, so they do not pile up unread
+                if request_id % 64 == 0:
+                    self._receive_ready()
+            # cached, as these are called at high rates
+            self.__dict__[attr] = send
+            return send
+        elif attr in QUERY_FUNCTIONS:
+            def query(*args, **kwargs):
+                return self.query(attr, *args, **kwargs)
+            return query
         else:
             # redirect calls to the remote object
             def proxy(*args, **kwargs):
-                self.socket.send_pyobj((attr, args, kwargs), protocol=-1)
-                success, value = self.socket.recv_pyobj()
-                if success:
-                    return value
-                else:
-                    # deal with exceptions in the remote process
-                    logger.error(value[1])
-                    raise value[0]
-
+                return self._call(attr, args, kwargs)
             return proxy
 
+    def call_async(self, cmd, *args, **kwargs):
+        """Send a call to the remote log without waiting for its result.
+
+        Returns:
+            PendingCall, whose result() waits for the return value
+        """
+        self._raise_errors()
+        request_id = self._send(CALL, cmd, args, kwargs)
+        self.waiting.add(request_id)
+        return PendingCall(self, request_id)
+
+    def unacknowledged(self):
+        """Number of requests sent which the server has not yet applied and committed"""
+        self._receive_ready()
+        return self.last_sent - self.acknowledged
+
+    def wait_acknowledged(self, timeout=None):
+        """Wait until the server has applied and committed every request sent so far, raising the
+        exception of any fire-and-forget call which failed"""
+        deadline = None if timeout is None else time.time() + timeout
+        while self.acknowledged < self.last_sent:
+            self._receive_one(deadline)
+        self._raise_errors()
+
+    def query(self, fn, *args, **kwargs):
+        """Call fn(cursor, *args, **kwargs), one of the QUERY_FUNCTIONS of extract.py, on the server's
+        database, and return its result (generators are returned as lists). Waits until everything sent
+        before has been committed, so the query sees it."""
+        self.wait_acknowledged(self.timeout)
+        if self.query_socket is None:
+            self.query_socket = self.context.socket(zmq.DEALER)
+            self.query_socket.setsockopt(zmq.LINGER, 0)
+            self.query_socket.connect(self.query_address)
+        request_id = next(self.request_ids)
+        frames = encode_call(self.serializer, fn, args, kwargs)
+        self.query_socket.send_multipart([CALL, REQUEST_ID.pack(request_id)] + frames, copy=False)
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        while True:
+            if deadline is not None and not self.query_socket.poll(max(0, int((deadline - time.time()) * 1000))):
+                raise ExperimentException("No reply from the log server")
+            frames = self.query_socket.recv_multipart()
+            # replies to earlier queries which timed out are skipped
+            if REQUEST_ID.unpack(frames[1])[0] == request_id:
+                return self._result(pickle.loads(frames[2]))
+
+    def disconnect(self):
+        """Close the connection to the server (the remote log stays open)"""
+        self.socket.close()
+        if self.query_socket is not None:
+            self.query_socket.close()
+
+    def _send(self, kind, cmd, args, kwargs):
+        # encoded first, as the stream id lookup is a request of its own
+        frames = encode_call(self.serializer, cmd, args, kwargs, self._stream_id)
+        request_id = next(self.request_ids)
+        self.socket.send_multipart([kind, REQUEST_ID.pack(request_id)] + frames, copy=False)
+        self.last_sent = request_id
+        return request_id
+
+    def _stream_id(self, stream):
+        if stream not in self.stream_ids:
+            self.stream_ids[stream] = self._call("stream_id", (stream,), {})
+        return self.stream_ids[stream]
+
+    def _call(self, cmd, args, kwargs):
+        self._raise_errors()
+        request_id = self._send(CALL, cmd, args, kwargs)
+        self.waiting.add(request_id)
+        return self._wait(request_id, self.timeout)
+
+    def _wait(self, request_id, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while request_id not in self.results:
+            self._receive_one(deadline)
+        self.waiting.discard(request_id)
+        result = self.results.pop(request_id)
+        # failures of earlier fire-and-forget calls are raised first
+        self._raise_errors()
+        return self._result(result)
+
+    def _result(self, result):
+        success, value = result
+        if success:
+            return value
+        else:
+            # deal with exceptions in the remote process
+            logger.error(value[1])
+            raise value[0]
+
+    def _receive_one(self, deadline):
+        """Block for the next message from the server (until the deadline, if one is given)"""
+        if deadline is not None:
+            if not self.socket.poll(max(0, int((deadline - time.time()) * 1000))):
+                raise ExperimentException("No reply from the log server")
+        self._handle(self.socket.recv_multipart())
+
+    def _receive_ready(self):
+        """Handle the messages that have already arrived"""
+        while self.socket.get(zmq.EVENTS) & zmq.POLLIN:
+            self._handle(self.socket.recv_multipart())
+
+    def _handle(self, frames):
+        kind = frames[0]
+        request_id = REQUEST_ID.unpack(frames[1])[0]
+        if kind == ACK:
+            self.acknowledged = max(self.acknowledged, request_id)
+        elif kind == CREDIT:
+            self.published = max(self.published, request_id)
+        elif kind == REPLY:
+            result = pickle.loads(frames[2])
+            if request_id in self.waiting:
+                self.results[request_id] = result
+            else:
+                # a fire-and-forget call failed
+                self.errors.append(result[1])
+
+    def _raise_errors(self):
+        if self.errors:
+            errors, self.errors = self.errors, []
+            for exc, tb in errors:
+                logger.error(tb)
+            raise errors[0][0]
 
 
 class LogProxyPub(object):
     """Proxy for an ExperimentLog object.
     Redirects calls and property accesses to the real, remote logging object
+
+    log() records are collected into batches, which are published once batch_size records are waiting,
+    or once the oldest has waited flush_interval seconds (checked by a background thread), or when
+    flush() or close() is called. The server writes each batch with one log_many() call. As records wait
+    in the batch, those logged without a timestamp are stamped by log() (with the server's clock offset),
+    not by the server.
+
+    Calls are encoded as by LogProxy; the stream ids are looked up through a LogProxy connected to
+    the server's ROUTER socket. Any number of publishers can connect to one server.
+
+    Each message is numbered, so the server can count the messages dropped when a publisher gets ahead
+    of it (once sndhwm messages are queued here, or the server's rcvhwm there); see the publisher_stats
+    table. With credit, nothing is dropped: publishing waits once credit messages have not yet been
+    committed by the server, slowing log() down to the server's pace.
+
+    Parameters:
+        serializer: "pickle" (the default) or "msgpack" (see wire.get_serializer())
+        batch_size: maximum number of records per batch; 1 publishes every log() call as it is made
+        flush_interval: longest time (in seconds) a record waits before its batch is published;
+                        None only publishes full batches (and on flush())
+        host: host running the server
+        sndhwm: number of messages queued before further messages are dropped (0 for no limit)
+        credit: None to publish without waiting for the server; or the number of messages which may
+                be in flight, which should be no more than the server's rcvhwm
     """
-    def __init__(self):
+    def __init__(self, serializer=None, batch_size=1000, flush_interval=0.05, host="localhost", sndhwm=1000,
+                 credit=None):
         # connect to the server
         self.context = zmq.Context()
         self.socket = self.context.socket(zmq.PUB)
-        self.socket.bind("tcp://127.0.0.1:{}".format(ZMQ_PORT_PUBSUB))
+        # with credit, the messages waiting are already limited
+        self.socket.setsockopt(zmq.SNDHWM, 0 if credit else sndhwm)
+        self.socket.connect("tcp://%s:%s" % (host, ZMQ_PORT_PUBSUB))
+        self.host = host
+        self.serializer = get_serializer(serializer)
+        self.proxy = None
+        self.time_offset = 0
+
+        # the sequence number of the next message, and the number of records published so far
+        self.publisher_id = uuid.uuid4().hex.encode()
+        self.sequence = 1
+        self.records = 0
+        self.credit = credit
+        self.flags = FLOW_CONTROL if credit else 0
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # records waiting to be published, and when the first of them was logged;
+        # the batch and the sockets are guarded by lock, as the timer thread also publishes
+        self.batch = []
+        self.first_time = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        if batch_size > 1 and flush_interval is not None:
+            self.thread = threading.Thread(target=self._run_timer, args=(max(0.001, flush_interval / 4.0),),
+                                           name="explogger-publisher")
+            self.thread.daemon = True
+            self.thread.start()
 
         # make metadata work the same way as in the ExperimentLog
         self.meta = MetaProxy(self)
 
-    def log(self, *args, **kwargs):
-        self.socket.send_pyobj(('log', args, kwargs), protocol=-1)
-
-    def close(self):
+    def log(self, stream, t=None, valid=True, data=None, tag="", binary=None):
+        """Log the given data in the server's active session, as ExperimentLog.log(); returns None"""
+        with self.lock:
+            if self.batch_size <= 1:
+                self._send(encode_call(self.serializer, 'log', (stream, t, valid, data, tag, binary), {},
+                                       self._stream_id), 1)
+                return
+            record = [self._stream_id(stream), t or self.real_time(), data, tag, valid, binary]
+            if not self.batch:
+                self.first_time = time.time()
+            self.batch.append(record)
+            if len(self.batch) >= self.batch_size:
+                self._publish()
+
+    def real_time(self):
+        """The time on the server's clock (which may be synchronised by NTP)"""
+        self._connect()
+        return time.time() + self.time_offset
+
+    def flush(self):
+        """Publish the records waiting in the batch now."""
+        with self.lock:
+            self._publish()
+
+    def close(self, timeout=10.0):
+        """Publish the records waiting, and wait (up to timeout seconds) for the server to receive
+        everything published, so that any messages lost at the end are also counted."""
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        self.flush()
+        if self.proxy is not None:
+            deadline = time.time() + timeout
+            while self.proxy.published < self.sequence and time.time() < deadline:
+                self._probe()
+                self._receive_credit(100)
+            self.proxy.disconnect()
         self.socket.close()
         self.context.term()
 
+    def _connect(self):
+        if self.proxy is None:
+            self.proxy = LogProxy(self.host, serializer=self.serializer, identity=self.publisher_id)
+            self.time_offset = self.proxy.time_offset
+            # messages published before the server has subscribed are dropped: probe until it answers
+            while self.proxy.published == 0:
+                self._probe()
+                self._receive_credit(100)
+        return self.proxy
+
+    def _stream_id(self, stream):
+        return self._connect()._stream_id(stream)
+
+    def _publish(self):
+        # called with lock held
+        if self.batch:
+            batch, self.batch = self.batch, []
+            self._send(encode_log_batch(self.serializer, batch), len(batch))
+
+    def _send(self, frames, n_records):
+        # called with lock held
+        if self.credit:
+            while self.sequence - self.proxy.published >= self.credit:
+                # with no credit for a second, the messages in flight may have been dropped, and would
+                # never be credited; the server credits up to the probe's sequence number
+                if not self._receive_credit(1000):
+                    self._probe()
+        header = PUB_HEADER.pack(self.publisher_id, self.sequence, self.records, n_records, self.flags)
+        self.socket.send_multipart([header] + frames, copy=False)
+        self.sequence += 1
+        self.records += n_records
+
+    def _probe(self):
+        self.socket.send(PUB_HEADER.pack(self.publisher_id, self.sequence, self.records, 0, self.flags | PROBE))
+
+    def _receive_credit(self, timeout):
+        """Handle the next message to the proxy, waiting up to timeout ms; False if none arrived"""
+        if not self.proxy.socket.poll(timeout):
+            return False
+        self.proxy._handle(self.proxy.socket.recv_multipart())
+        return True
+
+    def _run_timer(self, interval):
+        while not self.stopped.wait(interval):
+            with self.lock:
+                if self.batch and time.time() - self.first_time >= self.flush_interval:
+                    self._publish()
+
     # def __getattr__(self, attr):
     #     if attr!='log':
     #         logger.warning('only function log supported')
@@ -175,4 +853,3 @@ class LogProxyPub(object):
 
     #     return proxy
 
-